@@ -9,32 +9,39 @@ from werkzeug.security import check_password_hash
 import config
 import models
 import extensions # Import extensions module
-
-from models import get_db_connection
+import extraction  # noqa: F401 Registers the text-extraction job handlers
+import refcache
+import audit_writer
+import uploads
+import jobs
+import renditions
+import conversions  # noqa: F401 Registers the format-conversion job handlers
+import storage # Registers the remove_file job handler
+import partitions  # noqa: F401 Registers the maintain_partitions job handler
+import download_stats  # noqa: F401 Registers the rollup_downloads job handler
+import document_counts  # noqa: F401 Registers the counter fold/reconcile job handlers
 
 # Configure logging
 logging.basicConfig(filename='app.log', level=logging.DEBUG, format=f'%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
 
 # Define log_audit function here
 def log_audit(app, action, user_id=None, details=None):
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO audit_logs (user_id, action, details) VALUES (%s, %s, %s)',
-            (user_id, action, details)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        current_app.logger.error(f"Failed to log audit event: {e}")
+    # Queued and written in batches by audit_writer; independent of the
+    # caller's transaction
+    audit_writer.log_audit(user_id, action, details)
 
 app = Flask(__name__)
+app.request_class = storage.BlobRequest # Spool multipart uploads straight into the blob store
 app.config.from_object(config)
 app.secret_key = app.config['SECRET_KEY']
 app.debug = os.environ.get('FLASK_DEBUG') == '1'
 extensions.init_app(app) # Initialize extensions here
+models.init_app(app) # Return pooled DB connections at the end of each request
+refcache.init_app(app) # Listen for reference-data changes made by other processes
+audit_writer.init_app(app) # Batched audit/download log inserts
+uploads.init_app(app) # Garbage-collect abandoned resumable uploads
+jobs.init_app(app) # Job worker threads (extraction, file cleanup)
+renditions.init_app(app) # Thumbnail/preview cache
 app.log_audit = log_audit
 
 # Trust Railway's proxy so HTTPS redirects work correctly
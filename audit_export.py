@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Export the audit and download history
+
+    python -m audit_export --start-date 2025-01-01 --end-date 2025-03-31 -o q1.csv.gz
+    python -m audit_export --format jsonl --action document_download > downloads.jsonl
+
+Takes the same filters as the audit log page. Rows are streamed oldest
+first through server-side cursors; output ending in .gz is compressed.
+"""
+
+import sys
+import argparse
+
+import models
+import auditlog
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export audit and download logs as CSV or JSON lines')
+    parser.add_argument('--format', choices=auditlog.EXPORT_FORMATS, default='csv')
+    parser.add_argument('--user-id', type=int, default=None)
+    parser.add_argument('--document-id', type=int, default=None)
+    parser.add_argument('--action', default=None, help='e.g. user_login or document_download')
+    parser.add_argument('--start-date', default=None, help='earliest timestamp (YYYY-MM-DD)')
+    parser.add_argument('--end-date', default=None, help='last day included (YYYY-MM-DD), or latest timestamp')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument('--gzip', action=argparse.BooleanOptionalAction, default=None,
+                        help='gzip the output (default: when the output file ends in .gz)')
+    args = parser.parse_args(argv)
+
+    filters = {
+        'user_id': args.user_id,
+        'document_id': args.document_id,
+        'action': args.action,
+        'start_date': args.start_date,
+        'end_date': args.end_date,
+    }
+    compress = args.gzip if args.gzip is not None else args.output.endswith('.gz')
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        with models.pooled_connection() as conn:
+            chunks = auditlog.export_chunks(auditlog.iter_history(conn, filters), args.format)
+            if compress:
+                chunks = auditlog.gzip_chunks(chunks)
+            for chunk in chunks:
+                out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Columns written for each log table; the last one is the event timestamp,
+# captured when the event is queued rather than when the batch is flushed
+LOG_TABLES = {
+    'audit_logs': ('user_id', 'action', 'details', 'timestamp'),
+    'download_logs': ('document_id', 'user_id', 'downloaded_at'),
+}
+
+
+class LogWriter:
+    """Buffered writer for audit_logs and download_logs.
+
+    Events go into a bounded queue and a background thread inserts them with
+    one multi-row INSERT per table every ``flush_interval`` seconds or
+    ``batch_size`` events, whichever comes first. When the queue is full the
+    caller writes its event synchronously instead, so memory stays bounded
+    and no event is dropped without an error being logged.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.2, max_retries=5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def write(self, table, values):
+        """Queue one row for ``table``; ``values`` excludes the timestamp"""
+        row = tuple(values) + (datetime.now(timezone.utc),)
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.put_nowait((table, row))
+                return
+            except queue.Full:
+                logger.warning(f'Log queue full, writing {table} event synchronously')
+        self._insert_now({table: [row]})
+
+    def write_many(self, table, values_list):
+        """Queue several rows for ``table``; they share one timestamp and
+        are written with a single INSERT (or a synchronous one if the
+        writer is not running)"""
+        now = datetime.now(timezone.utc)
+        rows = [tuple(values) + (now,) for values in values_list]
+        if not rows:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                for i, row in enumerate(rows):
+                    self._queue.put_nowait((table, row))
+                return
+            except queue.Full:
+                logger.warning(f'Log queue full, writing {len(rows) - i} {table} events synchronously')
+                rows = rows[i:]
+        self._insert_now({table: rows})
+
+    def flush(self, timeout=10):
+        """Block until every event queued so far has been written"""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        # Anything queued after the final flush marker
+        self._drain_sync()
+
+    def _drain_sync(self):
+        batch = {}
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+            else:
+                batch.setdefault(item[0], []).append(item[1])
+        if batch:
+            self._insert_now(batch)
+
+    def _collect(self):
+        """Wait for the first event, then gather a batch until the interval ends"""
+        batch = {}
+        markers = []
+        count = 0
+        try:
+            item = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return batch, markers
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if isinstance(item, threading.Event):
+                # Flush marker: write what we have now and release the waiter
+                markers.append(item)
+                break
+            batch.setdefault(item[0], []).append(item[1])
+            count += 1
+            if count >= self.batch_size:
+                break
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return batch, markers
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch, markers = self._collect()
+            if batch:
+                self._flush_batch(batch)
+            for marker in markers:
+                marker.set()
+
+    def _flush_batch(self, batch):
+        delay = 0.5
+        for attempt in range(self.max_retries):
+            try:
+                self._insert_now(batch, raise_errors=True)
+                return
+            except psycopg2.OperationalError as e:
+                # Database unreachable: keep the batch and retry; new events
+                # pile up in the bounded queue meanwhile
+                logger.warning(f'Log flush failed (attempt {attempt + 1}): {e}')
+                self._stop.wait(delay)
+                delay = min(delay * 2, 10)
+            except psycopg2.Error as e:
+                self._log_lost(batch, e)
+                return
+        self._log_lost(batch, 'database unavailable')
+
+    def _insert_now(self, batch, raise_errors=False):
+        try:
+            with models.pooled_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    for table, rows in batch.items():
+                        self._insert_rows(cursor, table, rows)
+                    conn.commit()
+                except (psycopg2.IntegrityError, psycopg2.DataError):
+                    # One bad row (e.g. a log for a document deleted meanwhile)
+                    # must not take the whole batch down with it
+                    conn.rollback()
+                    self._insert_one_by_one(conn, cursor, batch)
+                finally:
+                    cursor.close()
+        except psycopg2.Error as e:
+            if raise_errors:
+                raise
+            self._log_lost(batch, e)
+
+    @staticmethod
+    def _insert_rows(cursor, table, rows):
+        columns = ', '.join(LOG_TABLES[table])
+        execute_values(cursor, f'INSERT INTO {table} ({columns}) VALUES %s', rows, page_size=len(rows))
+
+    def _insert_one_by_one(self, conn, cursor, batch):
+        for table, rows in batch.items():
+            for row in rows:
+                try:
+                    self._insert_rows(cursor, table, [row])
+                    conn.commit()
+                except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                    conn.rollback()
+                    self._log_lost({table: [row]}, e)
+
+    @staticmethod
+    def _log_lost(batch, reason):
+        for table, rows in batch.items():
+            for row in rows:
+                logger.error(f'Failed to write {table} event {dict(zip(LOG_TABLES[table], row))}: {reason}')
+
+
+log_writer = LogWriter()
+
+
+def init_app(app):
+    global log_writer
+    log_writer = LogWriter(
+        max_queue=app.config.get('LOG_WRITER_QUEUE_SIZE', 10000),
+        batch_size=app.config.get('LOG_WRITER_BATCH_SIZE', 500),
+        flush_interval=app.config.get('LOG_WRITER_FLUSH_MS', 200) / 1000.0,
+    )
+    if app.config.get('LOG_WRITER_ASYNC', True):
+        log_writer.start()
+        atexit.register(log_writer.close)
+
+
+def log_audit(user_id, action, details=None):
+    log_writer.write('audit_logs', (user_id, action, details))
+
+
+def log_download(document_id, user_id):
+    log_writer.write('download_logs', (document_id, user_id))
+
+
+def log_downloads(document_ids, user_id):
+    log_writer.write_many('download_logs', [(document_id, user_id) for document_id in document_ids])
+
+
+def flush(timeout=10):
+    """Wait until queued events are in the database"""
+    return log_writer.flush(timeout)
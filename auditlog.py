@@ -0,0 +1,261 @@
+import io
+import csv
+import json
+import zlib
+import heapq
+import base64
+import binascii
+from datetime import date, datetime
+
+from listing import InvalidCursor
+
+DOWNLOAD_ACTION = 'document_download'
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = ('log_type', 'id', 'timestamp', 'username', 'action', 'details', 'document_id', 'document_title')
+EXPORT_FETCH_SIZE = 2000  # rows per round trip of each server-side cursor
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# The viewer shows audit_logs and download_logs as one stream ordered by
+# (timestamp, rank, id) descending; rank breaks timestamp ties between the
+# two tables, whose ids overlap.
+STREAMS = {
+    'audit': {
+        'rank': 1,
+        'timestamp': 'al.timestamp',
+        'id': 'al.id',
+        'select': '''
+            SELECT al.id, al.timestamp, al.action, al.details, u.username AS username,
+                   NULL::text AS document_title, NULL::integer AS document_id, 'audit' AS log_type
+            FROM audit_logs al
+            LEFT JOIN users u ON u.id = al.user_id
+        ''',
+    },
+    'download': {
+        'rank': 0,
+        'timestamp': 'dl.downloaded_at',
+        'id': 'dl.id',
+        'select': '''
+            SELECT dl.id, dl.downloaded_at AS timestamp, 'document_download' AS action,
+                   COALESCE(d.title, '(deleted document)') AS details, u.username AS username,
+                   COALESCE(d.title, '(deleted document)') AS document_title, dl.document_id, 'download' AS log_type
+            FROM download_logs dl
+            LEFT JOIN users u ON u.id = dl.user_id
+            LEFT JOIN documents d ON d.id = dl.document_id
+        ''',
+    },
+}
+
+
+def parse_filters(args):
+    """Audit viewer filters from the query string; malformed ids are ignored"""
+    def int_arg(name):
+        try:
+            return int(args.get(name) or '')
+        except ValueError:
+            return None
+    return {
+        'user_id': int_arg('user_id'),
+        'document_id': int_arg('document_id'),
+        'action': args.get('action') or None,
+        'start_date': args.get('start_date') or None,
+        'end_date': args.get('end_date') or None,
+    }
+
+
+def stream_filters(kind, filters):
+    """``(where clauses, params)`` for one stream, or None if it cannot match.
+
+    Every combination is served by a ``(filter column, timestamp, id)``
+    index, and the timestamp bounds prune monthly partitions.
+    """
+    action = filters['action']
+    where, params = [], []
+    if kind == 'audit':
+        # Audit entries are not linked to documents, as before
+        if action == DOWNLOAD_ACTION:
+            return None
+        if filters['user_id'] is not None:
+            where.append('al.user_id = %s')
+            params.append(filters['user_id'])
+        if action:
+            where.append('al.action = %s')
+            params.append(action)
+    else:
+        if action and action != DOWNLOAD_ACTION:
+            return None
+        if filters['user_id'] is not None:
+            where.append('dl.user_id = %s')
+            params.append(filters['user_id'])
+        if filters['document_id'] is not None:
+            where.append('dl.document_id = %s')
+            params.append(filters['document_id'])
+    column = STREAMS[kind]['timestamp']
+    if filters['start_date']:
+        where.append(f'{column} >= %s')
+        params.append(filters['start_date'])
+    if filters['end_date']:
+        where.append(f'{column} {_end_bound(filters["end_date"])}')
+        params.append(filters['end_date'])
+    return where, params
+
+
+def _end_bound(end_date):
+    """Comparison for an end date; a bare date covers that whole day"""
+    try:
+        date.fromisoformat(end_date)
+    except (TypeError, ValueError):
+        return '<= %s'
+    return "< %s::date + INTERVAL '1 day'"
+
+
+def encode_cursor(direction, row):
+    payload = {'d': direction, 't': row['timestamp'].isoformat(), 'k': row['log_type'], 'id': row['id']}
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """``(direction, timestamp, rank, id)`` from a cursor made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+        direction = payload['d']
+        timestamp = datetime.fromisoformat(payload['t'])
+        rank = STREAMS[payload['k']]['rank']
+        log_id = int(payload['id'])
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise InvalidCursor('Malformed cursor')
+    if direction not in ('next', 'prev'):
+        raise InvalidCursor('Malformed cursor')
+    return direction, timestamp, rank, log_id
+
+
+def _keyset(spec, forward, timestamp, rank, log_id):
+    """Clause selecting one stream's rows past the cursor key in scan order"""
+    ts, key = spec['timestamp'], spec['id']
+    if spec['rank'] == rank:
+        return f'({ts}, {key}) {"<" if forward else ">"} (%s, %s)', [timestamp, log_id]
+    # The whole stream sorts on one side of the cursor's rank at equal timestamps
+    inclusive = (spec['rank'] < rank) == forward
+    op = ('<' if forward else '>') + ('=' if inclusive else '')
+    return f'{ts} {op} %s', [timestamp]
+
+
+def _sort_key(row):
+    return row['timestamp'], STREAMS[row['log_type']]['rank'], row['id']
+
+
+def fetch_page(cursor, filters, per_page, cursor_token=None):
+    """One page of the merged audit/download history, newest first.
+
+    Each stream is read with its own index-ordered ``LIMIT per_page + 1``
+    query and the two pre-sorted results are merged, so a page never sorts
+    or counts either table. Returns the rows and next/previous cursors.
+    """
+    direction, key = 'next', None
+    if cursor_token:
+        direction, *key = decode_cursor(cursor_token)
+    forward = direction == 'next'
+    scan = 'DESC' if forward else 'ASC'
+
+    results = []
+    for kind, spec in STREAMS.items():
+        clauses = stream_filters(kind, filters)
+        if clauses is None:
+            continue
+        where, params = clauses
+        if key:
+            clause, key_params = _keyset(spec, forward, *key)
+            where = where + [clause]
+            params = params + key_params
+        query = spec['select']
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += f" ORDER BY {spec['timestamp']} {scan}, {spec['id']} {scan} LIMIT %s"
+        cursor.execute(query, params + [per_page + 1])
+        results.append(cursor.fetchall())
+
+    rows = list(heapq.merge(*results, key=_sort_key, reverse=forward))[:per_page + 1]
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, bool(cursor_token)
+
+    return {
+        'rows': rows,
+        'next_cursor': encode_cursor('next', rows[-1]) if rows and has_next else None,
+        'prev_cursor': encode_cursor('prev', rows[0]) if rows and has_prev else None,
+    }
+
+
+def iter_history(conn, filters, fetch_size=EXPORT_FETCH_SIZE):
+    """Yield every matching entry, oldest first, through server-side cursors.
+
+    Both streams are read in one REPEATABLE READ, READ ONLY transaction, so
+    they come from the same snapshot; it is rolled back when the generator
+    finishes or is closed. Memory use does not depend on the row count.
+    """
+    conn.rollback()
+    cursor = conn.cursor()
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+    cursor.close()
+    named = []
+    try:
+        for kind, spec in STREAMS.items():
+            clauses = stream_filters(kind, filters)
+            if clauses is None:
+                continue
+            where, params = clauses
+            query = spec['select']
+            if where:
+                query += ' WHERE ' + ' AND '.join(where)
+            query += f" ORDER BY {spec['timestamp']}, {spec['id']}"
+            stream = conn.cursor(name=f'audit_export_{kind}')
+            stream.itersize = fetch_size
+            stream.execute(query, params)
+            named.append(stream)
+        yield from heapq.merge(*named, key=_sort_key)
+    finally:
+        # Ending the transaction drops the server-side cursors
+        conn.rollback()
+        for stream in named:
+            stream.close()
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_chunks(rows, fmt='csv'):
+    """Encode entries as CSV (with a header row) or JSON lines, in chunks of
+    about ``EXPORT_CHUNK_SIZE`` bytes"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        values = [_export_value(row[column]) for column in EXPORT_COLUMNS]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values)), ensure_ascii=False) + '\n')
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of byte chunks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,130 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+import extraction
+from models import add_links
+
+logger = logging.getLogger(__name__)
+
+# Reasons reported for files a failed bulk upload did not store
+ROLLED_BACK = 'Rolled back: the upload failed while storing this file'
+NOT_ATTEMPTED = 'Not attempted: the upload failed before this file was stored'
+
+
+def ingest_all(store, streams, max_workers=None):
+    """``Ingested`` for each upload stream, computed concurrently.
+
+    Returns one ``Ingested`` (or the exception raised) per stream, in input
+    order. Streams spooled by ``storage.BlobRequest`` were hashed while the
+    request was parsed and are only sniffed here; other streams are copied
+    by ``write_temp()``. hashlib, libmagic and file I/O release the GIL on
+    large buffers, so a thread pool keeps every core busy.
+    """
+    def run(stream):
+        try:
+            return store.ingest(stream)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 4) as pool:
+        return list(pool.map(run, streams))
+
+
+def existing_documents(cursor, content_hashes):
+    """Map content hash -> id of an existing document with that content"""
+    if not content_hashes:
+        return {}
+    cursor.execute('''
+        SELECT content_hash, MIN(id) AS id FROM documents
+        WHERE content_hash = ANY(%s) GROUP BY content_hash
+    ''', (list(content_hashes),))
+    return {row['content_hash']: row['id'] for row in cursor.fetchall()}
+
+
+def insert_batch(cursor, store, items, uploaded_by, document_type_id, plant_ids, department_ids):
+    """Store and insert a batch of accepted files with three set-based INSERTs.
+
+    ``items`` are dicts with ``title``, ``description``, ``filename``,
+    ``mime_type`` and ``ingested``; returns the new document ids in order.
+    Each item gets the ``added`` handle of its stored file (see ``rollback``).
+    """
+    rows = []
+    for item in items:
+        ingested = item['ingested']
+        # Temp files are kept so a rolled-back chunk can be retried file by file
+        added = item['added'] = store.add(cursor, ingested.tmp_path, ingested.content_hash, ingested.size,
+                                          item['mime_type'], keep_temp=True)
+        rows.append((item['title'], item['description'], item['filename'], added.path, ingested.size,
+                     item['mime_type'], ingested.content_hash, uploaded_by, document_type_id))
+    inserted = execute_values(cursor, '''
+        INSERT INTO documents (title, description, filename, file_path, file_size, mime_type, content_hash, uploaded_by, document_type_id)
+        VALUES %s RETURNING id
+    ''', rows, page_size=len(rows), fetch=True)
+    document_ids = [row['id'] for row in inserted]
+    add_links(cursor, 'document_plants', document_ids, plant_ids)
+    add_links(cursor, 'document_departments', document_ids, department_ids)
+    extraction.enqueue(cursor, document_ids)
+    return document_ids
+
+
+def rollback(conn, store, items):
+    """Roll back a failed batch, first moving its new files out of the store"""
+    for item in items:
+        store.undo_add(item.pop('added', None))
+    conn.rollback()
+
+
+def insert_in_chunks(conn, store, items, chunk_size, **fields):
+    """Insert ``items`` committing every ``chunk_size`` files.
+
+    A chunk that fails is rolled back and retried file by file, so one bad
+    row only costs itself. Each item gets ``status`` ``'accepted'`` with a
+    ``document_id``, or ``'error'`` with a ``reason``. If something else
+    fails (e.g. the connection drops), earlier chunks stay committed: the
+    items left are marked rolled back or not attempted before re-raising.
+    """
+    cursor = conn.cursor()
+    chunk = []
+    try:
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            try:
+                document_ids = insert_batch(cursor, store, chunk, **fields)
+                conn.commit()
+            except Exception as e:
+                rollback(conn, store, chunk)
+                logger.warning(f'Bulk insert chunk failed, retrying file by file: {e}')
+                for item in chunk:
+                    try:
+                        item['document_id'] = insert_batch(cursor, store, [item], **fields)[0]
+                        conn.commit()
+                        item['status'] = 'accepted'
+                    except Exception as e:
+                        rollback(conn, store, [item])
+                        item['status'] = 'error'
+                        item['reason'] = getattr(getattr(e, 'diag', None), 'message_primary', None) or str(e)
+                    item.pop('added', None)
+                    store.discard_temp(item['ingested'].tmp_path)
+                continue
+            for item, document_id in zip(chunk, document_ids):
+                item.pop('added', None)
+                store.discard_temp(item['ingested'].tmp_path)
+                item['status'] = 'accepted'
+                item['document_id'] = document_id
+    except Exception:
+        try:
+            rollback(conn, store, chunk)
+        except Exception as e:
+            logger.warning(f'Bulk insert rollback failed: {e}')
+        in_chunk = {id(item) for item in chunk}
+        for item in items:
+            if 'status' not in item:
+                item['status'] = 'error'
+                item['reason'] = ROLLED_BACK if id(item) in in_chunk else NOT_ATTEMPTED
+        raise
+    finally:
+        cursor.close()
+    return items
@@ -0,0 +1,110 @@
+import os
+import zipfile
+import logging
+from datetime import datetime
+
+from storage import CHUNK_SIZE, open_stored
+
+logger = logging.getLogger(__name__)
+
+# Already compressed: deflating them again costs CPU and saves nothing
+STORED_MIMETYPES = {
+    'image/jpeg',
+    'image/png',
+    'application/pdf',
+    'application/zip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+
+
+class _Pipe:
+    """Write-only, unseekable sink that hands written bytes to the generator.
+
+    ``zipfile`` falls back to data descriptors on unseekable output, so each
+    entry is written in one pass and nothing is ever staged.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_names(documents):
+    """Unique file names inside the archive, in document order"""
+    seen = {}
+    names = []
+    for document in documents:
+        name = os.path.basename(document['filename'].replace('\\', '/')) or f"document-{document['id']}"
+        stem, ext = os.path.splitext(name)
+        count = seen.get(name.lower(), 0)
+        seen[name.lower()] = count + 1
+        if count:
+            name = f'{stem} ({count + 1}){ext}'
+            while name.lower() in seen:
+                count += 1
+                name = f'{stem} ({count + 1}){ext}'
+            seen[name.lower()] = 1
+        names.append(name)
+    return names
+
+
+def stream_zip(documents, on_complete=None):
+    """Yield a ZIP archive of ``documents`` chunk by chunk.
+
+    ``documents`` are rows with ``id``, ``filename``, ``file_path``,
+    ``file_size`` and ``mime_type``. Memory use is bounded by ``CHUNK_SIZE`` regardless of the
+    archive size. ``on_complete`` is called with the ids of the documents
+    that were fully written, once the archive is finished; a client that
+    disconnects early closes the generator and nothing is reported.
+    """
+    pipe = _Pipe()
+    written = []
+    missing = []
+    with zipfile.ZipFile(pipe, 'w', allowZip64=True) as archive:
+        for document, name in zip(documents, archive_names(documents)):
+            try:
+                source = open_stored(document['file_path'])
+            except OSError as e:
+                logger.warning(f"Bundle: skipping document {document['id']}: {e}")
+                missing.append(name)
+                continue
+            with source:
+                mtime = os.path.getmtime(document['file_path'])
+                info = zipfile.ZipInfo(name, datetime.fromtimestamp(mtime).timetuple()[:6])
+                info.compress_type = (zipfile.ZIP_STORED if document['mime_type'] in STORED_MIMETYPES
+                                      else zipfile.ZIP_DEFLATED)
+                # Known up front so zipfile picks ZIP64 headers for big files;
+                # file_size is the original size even for compressed blobs
+                info.file_size = document['file_size'] or 0
+                with archive.open(info, 'w') as entry:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        entry.write(chunk)
+                        data = pipe.drain()
+                        if data:
+                            yield data
+            written.append(document['id'])
+        if missing:
+            archive.writestr('MISSING.txt', 'These files could not be read and are not included:\n'
+                             + '\n'.join(missing) + '\n')
+    # Central directory
+    yield pipe.drain()
+    if on_complete is not None:
+        on_complete(written)
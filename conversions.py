@@ -0,0 +1,321 @@
+import os
+import re
+import uuid
+import logging
+import textwrap
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+
+import config
+import jobs
+import storage
+import extraction
+import audit_writer
+from renditions import flatten
+
+logger = logging.getLogger(__name__)
+
+# Spellings users type into the "Desired Format" box -> canonical target
+FORMAT_ALIASES = {
+    'jpg': 'jpg', 'jpeg': 'jpg', 'png': 'png', 'webp': 'webp', 'gif': 'gif', 'bmp': 'bmp',
+    'tif': 'tiff', 'tiff': 'tiff', 'pdf': 'pdf', 'txt': 'txt', 'text': 'txt',
+}
+IMAGE_TARGETS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'gif': 'GIF', 'bmp': 'BMP', 'tiff': 'TIFF', 'pdf': 'PDF'}
+MAX_DIMENSION = 10000
+
+# Source kind -> formats it can be converted to locally
+TARGETS = {
+    'image': set(IMAGE_TARGETS),
+    'txt': {'pdf'},
+    'ooxml': {'txt', 'pdf'},
+    'pdf': {'txt'},
+}
+
+_FORMAT_RE = re.compile(r'[a-z]+')
+# "800px", "800 pixels" or "800x600"; a bare number ("300 dpi") is not a size
+_DIMENSION_RE = re.compile(r'\b(\d{2,5})\s*(?:px|pixels?)\b|\b(\d{2,5})\s*[x\u00d7]\s*(\d{2,5})\b')
+
+CONVERT_PENDING_INTERVAL = 300
+
+
+def source_kind(mime_type):
+    if mime_type in ('image/jpeg', 'image/png'):
+        return 'image'
+    if mime_type == 'text/plain':
+        return 'txt'
+    if mime_type in extraction.OOXML_MIMETYPES:
+        return 'ooxml'
+    if mime_type == 'application/pdf':
+        return 'pdf'
+    return None
+
+
+def plan(mime_type, requested_format):
+    """Canonical target such as ``'png'`` or ``'jpg-1024'`` for a request, or
+    None if it cannot be produced locally.
+
+    A size in the request ("PNG 800px", "JPG 1024x768") bounds the longest
+    side of the output; it only applies to images.
+    """
+    kind = source_kind(mime_type)
+    if kind is None or not requested_format:
+        return None
+    text = requested_format.lower()
+    fmt = next((FORMAT_ALIASES[w] for w in _FORMAT_RE.findall(text) if w in FORMAT_ALIASES), None)
+    if fmt is None or fmt not in TARGETS[kind]:
+        return None
+    match = _DIMENSION_RE.search(text)
+    if match and kind == 'image' and fmt != 'pdf':
+        dimension = max(int(n) for n in match.groups() if n)
+        return f'{fmt}-{min(dimension, MAX_DIMENSION)}'
+    if kind == 'image' and fmt == {'image/jpeg': 'jpg', 'image/png': 'png'}[mime_type]:
+        # Same format and size: nothing to convert
+        return None
+    return fmt
+
+
+def target_extension(target):
+    return target.split('-', 1)[0]
+
+
+def text_to_pdf(text, out_path, font_size=10, page_size=(595, 842), margin=56):
+    """Write plain text as a minimal paginated PDF (Courier, A4)"""
+    width, height = page_size
+    leading = font_size * 1.25
+    # Courier glyphs are 0.6 em wide, so wrapping by characters is exact
+    columns = int((width - 2 * margin) / (font_size * 0.6))
+    rows = int((height - 2 * margin) / leading)
+
+    lines = []
+    for line in text.expandtabs(4).splitlines() or ['']:
+        lines.extend(textwrap.wrap(line, columns, drop_whitespace=False) or [''])
+    pages = [lines[i:i + rows] for i in range(0, len(lines), rows)] or [[]]
+
+    def escape(line):
+        encoded = line.encode('cp1252', errors='replace')
+        return encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        None,  # page tree, filled in below
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>',
+    ]
+    kids = []
+    for page in pages:
+        stream = b'BT /F1 %d Tf %.2f TL %d %.2f Td\n' % (font_size, leading, margin, height - margin - font_size)
+        stream += b''.join(b'(' + escape(line) + b') Tj T*\n' for line in page) + b'ET'
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>'
+                       % (width, height, len(objects)))
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [' + b' '.join(kids) + b'] /Count %d >>' % len(kids)
+
+    with open(out_path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        f.writelines(b'%010d 00000 n \n' % offset for offset in offsets)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+
+
+def _convert_image(source_path, target, out_path):
+    fmt, _, dimension = target.partition('-')
+    with storage.open_stored(source_path) as f, Image.open(f) as image:
+        image = ImageOps.exif_transpose(image)
+        if dimension:
+            image.thumbnail((int(dimension), int(dimension)), Image.LANCZOS)
+        if fmt in ('jpg', 'pdf', 'bmp'):
+            image = flatten(image)
+        elif fmt == 'gif':
+            image = image.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+        image.save(out_path, IMAGE_TARGETS[fmt])
+
+
+def convert(source_path, mime_type, target, out_path):
+    """Produce ``target`` from the file at ``source_path``; runs in the pool"""
+    kind = source_kind(mime_type)
+    fmt = target_extension(target)
+    if kind == 'image':
+        _convert_image(source_path, target, out_path)
+        return
+    text = extraction.extract_text(source_path, mime_type, config.TEXT_EXTRACTION_MAX_CHARS) or ''
+    if fmt == 'txt':
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        text_to_pdf(text, out_path)
+
+
+class ConversionCache:
+    """Converted files under ``root``, one per (content hash, target).
+
+    The ``conversions`` table records what exists so fulfilled requests and
+    the document page can link to it; conversions run in a process pool so
+    CPU-heavy Pillow/PDF work neither holds the worker's GIL nor takes the
+    worker down if a malformed file crashes the converter.
+    """
+
+    def __init__(self, root, max_workers=2, timeout=300):
+        self.root = root
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def path_for(self, content_hash, target):
+        return os.path.join(self.root, content_hash[:2], f'{content_hash}.{target}.{target_extension(target)}')
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a process that runs threads (waitress, the
+                # log writer) can deadlock the child
+                self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _reset(self, terminate=False):
+        """Drop the pool; with ``terminate`` its workers are killed first.
+
+        A conversion that timed out keeps running in its worker (futures
+        cannot be cancelled once started), so it has to be killed, or a
+        few pathological files would occupy every worker for good.
+        Conversions running alongside fail with BrokenProcessPool and
+        their jobs are retried.
+        """
+        with self._lock:
+            if self._pool is None:
+                return
+            processes = list((self._pool._processes or {}).values()) if terminate else []
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(5)
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def get(self, cursor, source_path, mime_type, content_hash, target):
+        """Path of the converted file, converting and registering it if needed"""
+        cursor.execute('SELECT file_path FROM conversions WHERE content_hash = %s AND target = %s',
+                       (content_hash, target))
+        row = cursor.fetchone()
+        if row and os.path.exists(row['file_path']):
+            return row['file_path']
+
+        path = self.path_for(content_hash, target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            self._executor().submit(convert, source_path, mime_type, target, tmp_path).result(self.timeout)
+            os.replace(tmp_path, path)
+        except FutureTimeout:
+            # Kill the worker before the finally removes the file it writes
+            self._reset(terminate=True)
+            raise
+        except BrokenProcessPool:
+            self._reset()
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        cursor.execute('''
+            INSERT INTO conversions (content_hash, target, file_path, file_size)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (content_hash, target) DO UPDATE
+            SET file_path = EXCLUDED.file_path, file_size = EXCLUDED.file_size, created_at = CURRENT_TIMESTAMP
+        ''', (content_hash, target, path, os.path.getsize(path)))
+        return path
+
+
+cache = ConversionCache(
+    config.CONVERSION_DIR,
+    max_workers=config.CONVERSION_WORKERS,
+    timeout=config.CONVERSION_TIMEOUT,
+)
+
+
+def enqueue(cursor, request_id):
+    """Queue automatic fulfilment of a format request in the caller's transaction"""
+    if config.CONVERSIONS_ENABLED:
+        jobs.enqueue(cursor, 'convert_request', {'request_id': request_id}, dedupe_key=str(request_id))
+
+
+@jobs.handler('convert_request')
+def run_convert_request(conn, payload):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT dr.id, dr.status, dr.requested_format,
+                   d.id AS document_id, d.filename, d.file_path, d.mime_type, d.content_hash
+            FROM document_requests dr
+            JOIN documents d ON d.id = dr.document_id
+            WHERE dr.id = %s
+        ''', (payload['request_id'],))
+        req = cursor.fetchone()
+        if req is None or req['status'] != 'pending':
+            conn.rollback()
+            return
+        target = plan(req['mime_type'], req['requested_format'])
+        if target is None:
+            # Not something we can produce: left for an admin
+            conn.rollback()
+            return
+
+        content_hash = req['content_hash']
+        if not content_hash:
+            content_hash = extraction.file_sha256(req['file_path'])
+            cursor.execute('UPDATE documents SET content_hash = %s WHERE id = %s AND content_hash IS NULL',
+                           (content_hash, req['document_id']))
+        cache.get(cursor, req['file_path'], req['mime_type'], content_hash, target)
+        cursor.execute('''
+            UPDATE document_requests SET status = 'fulfilled', conversion_target = %s, fulfilled_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'pending'
+        ''', (target, req['id']))
+        fulfilled = cursor.rowcount
+        conn.commit()
+        if fulfilled:
+            audit_writer.log_audit(None, 'document_request_auto_fulfill',
+                                   f"Request ID {req['id']}: '{req['filename']}' converted to {target}")
+            logger.info(f"Fulfilled request {req['id']}: document {req['document_id']} -> {target}")
+    finally:
+        cursor.close()
+
+
+@jobs.handler('convert_pending')
+def run_convert_pending(conn, payload):
+    """Queue every pending format request that can be converted locally.
+
+    Requests whose conversion job is running, or has used up its attempts
+    and parked as failed, are skipped: the dedupe key only covers queued
+    jobs, and a request that never converts is left for an admin.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT dr.id, dr.requested_format, d.mime_type
+            FROM document_requests dr
+            JOIN documents d ON d.id = dr.document_id
+            WHERE dr.status = 'pending'
+              AND NOT EXISTS (
+                  SELECT 1 FROM jobs j
+                  WHERE j.kind = 'convert_request' AND j.dedupe_key = dr.id::text
+                    AND j.status IN ('running', 'failed')
+              )
+        ''')
+        for req in cursor.fetchall():
+            if plan(req['mime_type'], req['requested_format']):
+                enqueue(cursor, req['id'])
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+if config.CONVERSIONS_ENABLED:
+    jobs.every(CONVERT_PENDING_INTERVAL, 'convert_pending')
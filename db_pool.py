@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+import logging
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Raised when no connection could be acquired within the timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe PostgreSQL connection pool.
+
+    Connections are health-checked on checkout and recycled once they are
+    older than ``max_lifetime`` seconds. Callers that cannot get a connection
+    within ``timeout`` seconds receive a ``PoolTimeout``.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=30, max_lifetime=3600,
+                 health_check=True, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size: min_size must be between 0 and max_size')
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []          # stack of (conn, created_at), most recently used last
+        self._created = {}       # id(conn) -> created_at for every open connection
+        self._pid = os.getpid()
+        self._closed = False
+
+        for _ in range(min_size):
+            conn = self._connect()
+            with self._cond:
+                self._created[id(conn)] = created_at = time.monotonic()
+                self._idle.append((conn, created_at))
+
+    def _connect(self):
+        # Bookkeeping in _created is left to the caller, under the lock
+        return psycopg2.connect(self.dsn, **self.connect_kwargs)
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, created_at):
+        return self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _check_fork(self):
+        # Connections must never be shared across processes: drop the parent's
+        # bookkeeping (without closing its sockets) after a fork.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._created = {}
+
+    def getconn(self, timeout=None):
+        """Check out a healthy connection, waiting up to ``timeout`` seconds.
+
+        The health check runs after the connection has left the idle stack,
+        outside the lock, so a slow or dead server only stalls the callers
+        that actually hit a bad connection.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            conn = placeholder = None
+            with self._cond:
+                self._check_fork()
+                while True:
+                    if self._closed:
+                        raise psycopg2.InterfaceError('Connection pool is closed')
+                    if self._idle:
+                        conn, created_at = self._idle.pop()
+                        break
+                    if len(self._created) < self.max_size:
+                        # Reserve the slot before connecting so concurrent callers
+                        # cannot overshoot max_size while the handshake is running.
+                        placeholder = object()
+                        self._created[id(placeholder)] = time.monotonic()
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f'Timed out after {timeout}s waiting for a database connection')
+                    self._cond.wait(remaining)
+
+            if conn is not None:
+                if not self._expired(created_at) and self._is_healthy(conn):
+                    return conn
+                with self._cond:
+                    self._created.pop(id(conn), None)
+                    self._cond.notify()
+                self._close(conn)
+                continue
+
+            try:
+                conn = self._connect()
+            finally:
+                with self._cond:
+                    # The new connection takes over the reserved slot
+                    self._created.pop(id(placeholder), None)
+                    if conn is not None:
+                        self._created[id(conn)] = time.monotonic()
+                    self._cond.notify()
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction"""
+        with self._cond:
+            if self._pid != os.getpid() or id(conn) not in self._created:
+                return
+        # Rolled back outside the lock, like the checkout health check
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            created_at = self._created.get(id(conn))
+            if created_at is None:
+                return
+            if discard or conn.closed or self._closed or self._expired(created_at):
+                self._discard(conn)
+            else:
+                self._idle.append((conn, created_at))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'open': len(self._created), 'idle': len(self._idle), 'max_size': self.max_size}
+
+
+class PooledConnection:
+    """Proxy for a request-scoped pooled connection.
+
+    Route code written against plain connections calls ``conn.close()`` when
+    it is done; for a pooled connection that is a no-op and the connection is
+    handed back to the pool by the app's teardown handler instead.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        pass
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
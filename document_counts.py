@@ -0,0 +1,107 @@
+import logging
+
+import config
+import jobs
+
+logger = logging.getLogger(__name__)
+
+# Counters plus deltas not folded yet: always exact, and never more than a
+# fold interval's worth of delta rows
+CURRENT_COUNTS = '''
+    SELECT plant_ids, department_ids, document_type_id, documents FROM document_counts
+    UNION ALL
+    SELECT plant_ids, department_ids, document_type_id, delta FROM document_count_deltas
+'''
+
+
+def total(cursor, plant_ids=None, department_ids=None):
+    """Documents visible to a user with these plants and departments; all
+    documents when both are None (admins)"""
+    if plant_ids is None and department_ids is None:
+        cursor.execute(f'SELECT COALESCE(SUM(documents), 0)::bigint AS count FROM ({CURRENT_COUNTS}) c')
+    else:
+        cursor.execute(f'''
+            SELECT COALESCE(SUM(documents), 0)::bigint AS count FROM ({CURRENT_COUNTS}) c
+            WHERE c.plant_ids && %s::int[] AND c.department_ids && %s::int[]
+        ''', (plant_ids, department_ids))
+    return cursor.fetchone()['count']
+
+
+def per_department(cursor, plant_ids=None, department_ids=None):
+    """``name``/``document_count`` rows per department, by name.
+
+    Admins (both None) get every department; users get their own
+    departments, counting documents in one of their plants.
+    """
+    if plant_ids is None and department_ids is None:
+        cursor.execute(f'''
+            SELECT dept.name, COALESCE(SUM(c.documents), 0)::bigint AS document_count
+            FROM departments dept
+            LEFT JOIN ({CURRENT_COUNTS}) c ON c.department_ids @> ARRAY[dept.id]
+            GROUP BY dept.name
+            ORDER BY dept.name
+        ''')
+    else:
+        cursor.execute(f'''
+            SELECT dept.name, COALESCE(SUM(c.documents), 0)::bigint AS document_count
+            FROM departments dept
+            LEFT JOIN ({CURRENT_COUNTS}) c ON c.department_ids @> ARRAY[dept.id] AND c.plant_ids && %s::int[]
+            WHERE dept.id = ANY(%s)
+            GROUP BY dept.name
+            ORDER BY dept.name
+        ''', (plant_ids, department_ids))
+    return cursor.fetchall()
+
+
+def fold(conn):
+    """Merge pending deltas into the counters; returns the number merged"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT fold_document_counts() AS merged')
+        merged = cursor.fetchone()['merged']
+        conn.commit()
+        return merged
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def reconcile(conn):
+    """Correct drift between the counters and the documents table.
+
+    Runs in a REPEATABLE READ snapshot: documents, counters and deltas are
+    read consistently and corrections are appended as deltas, so concurrent
+    writers are neither blocked nor double counted.
+    """
+    cursor = conn.cursor()
+    try:
+        conn.rollback()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT reconcile_document_counts() AS corrected')
+        corrected = cursor.fetchone()['corrected']
+        conn.commit()
+        return corrected
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+@jobs.handler('fold_document_counts')
+def run_fold_document_counts(conn, payload):
+    fold(conn)
+
+
+@jobs.handler('reconcile_document_counts')
+def run_reconcile_document_counts(conn, payload):
+    corrected = reconcile(conn)
+    if corrected:
+        logger.warning(f'Document counters had drifted: corrected {corrected} signatures')
+    fold(conn)
+
+
+jobs.every(config.DOCUMENT_COUNTS_FOLD_INTERVAL, 'fold_document_counts')
+jobs.every(config.DOCUMENT_COUNTS_RECONCILE_INTERVAL, 'reconcile_document_counts')
@@ -0,0 +1,220 @@
+import logging
+from datetime import date, timedelta
+
+import config
+import jobs
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_NAME = 'download_logs'
+GROUPS = ('document', 'user', 'plant', 'department')
+INTERVALS = ('day', 'week', 'month')
+# At most this many batches per job run, so a large backfill spreads over
+# several runs instead of outliving the job's visibility timeout
+MAX_BATCHES_PER_RUN = 20
+
+
+def _state(cursor):
+    cursor.execute('INSERT INTO rollup_state (name) VALUES (%s) ON CONFLICT (name) DO NOTHING', (ROLLUP_NAME,))
+    cursor.execute('SELECT last_id, seen_id FROM rollup_state WHERE name = %s FOR UPDATE', (ROLLUP_NAME,))
+    return cursor.fetchone()
+
+
+def fold_batch(cursor, low, high):
+    """Add download_logs rows with ``low < id <= high`` to the daily rollups"""
+    cursor.execute('''
+        WITH batch AS MATERIALIZED (
+            SELECT downloaded_at::date AS day, document_id, user_id, COUNT(*) AS downloads
+            FROM download_logs
+            WHERE id > %s AND id <= %s
+            GROUP BY 1, 2, 3
+        ),
+        by_document AS (
+            INSERT INTO download_daily_documents (day, document_id, downloads)
+            SELECT day, document_id, SUM(downloads) FROM batch GROUP BY 1, 2
+            ON CONFLICT (day, document_id)
+            DO UPDATE SET downloads = download_daily_documents.downloads + EXCLUDED.downloads
+        ),
+        by_user AS (
+            INSERT INTO download_daily_users (day, user_id, downloads)
+            SELECT day, user_id, SUM(downloads) FROM batch GROUP BY 1, 2
+            ON CONFLICT (day, user_id)
+            DO UPDATE SET downloads = download_daily_users.downloads + EXCLUDED.downloads
+        ),
+        by_plant AS (
+            INSERT INTO download_daily_plants (plant_id, day, document_id, downloads)
+            SELECT dp.plant_id, b.day, b.document_id, SUM(b.downloads)
+            FROM batch b JOIN document_plants dp ON dp.document_id = b.document_id
+            GROUP BY 1, 2, 3
+            ON CONFLICT (plant_id, day, document_id)
+            DO UPDATE SET downloads = download_daily_plants.downloads + EXCLUDED.downloads
+        )
+        INSERT INTO download_daily_departments (department_id, day, document_id, downloads)
+        SELECT dd.department_id, b.day, b.document_id, SUM(b.downloads)
+        FROM batch b JOIN document_departments dd ON dd.document_id = b.document_id
+        GROUP BY 1, 2, 3
+        ON CONFLICT (department_id, day, document_id)
+        DO UPDATE SET downloads = download_daily_departments.downloads + EXCLUDED.downloads
+    ''', (low, high))
+
+
+def fold(conn, batch_size=None, max_batches=MAX_BATCHES_PER_RUN):
+    """Fold new download_logs rows into the rollups; returns the id range folded.
+
+    The high-water mark only advances to the largest id seen by the
+    *previous* run: ids are handed out before their transactions commit, so
+    a row with a lower id can still appear after a higher one has been read.
+    Waiting one run gives those transactions time to commit. Each batch
+    commits together with its watermark, so a crash never counts a row twice.
+    """
+    batch_size = batch_size or config.DOWNLOAD_ROLLUP_BATCH_SIZE
+    cursor = conn.cursor()
+    try:
+        first = None
+        last = None
+        for _ in range(max_batches):
+            state = _state(cursor)
+            high = min(state['last_id'] + batch_size, state['seen_id'])
+            if high <= state['last_id']:
+                conn.rollback()
+                break
+            fold_batch(cursor, state['last_id'], high)
+            cursor.execute('UPDATE rollup_state SET last_id = %s, updated_at = CURRENT_TIMESTAMP WHERE name = %s',
+                           (high, ROLLUP_NAME))
+            conn.commit()
+            first = state['last_id'] if first is None else first
+            last = high
+        else:
+            # Not caught up yet: leave seen_id alone until the backlog is folded
+            return first, last
+
+        _state(cursor)
+        cursor.execute('''
+            UPDATE rollup_state SET seen_id = GREATEST(seen_id, COALESCE((SELECT MAX(id) FROM download_logs), 0)),
+                                    updated_at = CURRENT_TIMESTAMP
+            WHERE name = %s
+        ''', (ROLLUP_NAME,))
+        conn.commit()
+        return first, last
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+@jobs.handler('rollup_downloads')
+def run_rollup_downloads(conn, payload):
+    first, last = fold(conn)
+    if last is not None:
+        logger.info(f'Folded download_logs ids {first + 1}..{last} into the daily rollups')
+
+
+jobs.every(config.DOWNLOAD_ROLLUP_INTERVAL, 'rollup_downloads')
+
+
+def as_of(cursor):
+    """When the rollups last advanced, or None before the first fold"""
+    cursor.execute('SELECT updated_at FROM rollup_state WHERE name = %s', (ROLLUP_NAME,))
+    row = cursor.fetchone()
+    return row['updated_at'] if row else None
+
+
+def default_range(days=30, today=None):
+    end = today or date.today()
+    return end - timedelta(days=days - 1), end
+
+
+def top(cursor, start, end, group='document', limit=10, plant_id=None, department_id=None):
+    """Most downloaded documents (or users, plants, departments) between two dates, inclusive"""
+    if group == 'user':
+        cursor.execute('''
+            SELECT r.user_id AS id, u.username AS name, SUM(r.downloads)::bigint AS downloads
+            FROM download_daily_users r
+            LEFT JOIN users u ON u.id = r.user_id
+            WHERE r.day BETWEEN %s AND %s
+            GROUP BY r.user_id, u.username
+            ORDER BY downloads DESC, r.user_id
+            LIMIT %s
+        ''', (start, end, limit))
+        return cursor.fetchall()
+    if group in ('plant', 'department'):
+        table, key, names = {
+            'plant': ('download_daily_plants', 'plant_id', 'plants'),
+            'department': ('download_daily_departments', 'department_id', 'departments'),
+        }[group]
+        cursor.execute(f'''
+            SELECT r.{key} AS id, n.name, SUM(r.downloads)::bigint AS downloads
+            FROM {table} r
+            LEFT JOIN {names} n ON n.id = r.{key}
+            WHERE r.day BETWEEN %s AND %s
+            GROUP BY r.{key}, n.name
+            ORDER BY downloads DESC, r.{key}
+            LIMIT %s
+        ''', (start, end, limit))
+        return cursor.fetchall()
+
+    # Documents, optionally within one plant or department
+    if plant_id:
+        source, where, params = 'download_daily_plants', 'r.plant_id = %s AND ', [plant_id]
+    elif department_id:
+        source, where, params = 'download_daily_departments', 'r.department_id = %s AND ', [department_id]
+    else:
+        source, where, params = 'download_daily_documents', '', []
+    cursor.execute(f'''
+        SELECT t.document_id AS id, COALESCE(d.title, '(deleted document)') AS name, t.downloads
+        FROM (
+            SELECT r.document_id, SUM(r.downloads)::bigint AS downloads
+            FROM {source} r
+            WHERE {where}r.day BETWEEN %s AND %s
+            GROUP BY r.document_id
+            ORDER BY downloads DESC, r.document_id
+            LIMIT %s
+        ) t
+        LEFT JOIN documents d ON d.id = t.document_id
+        ORDER BY t.downloads DESC, t.document_id
+    ''', params + [start, end, limit])
+    return cursor.fetchall()
+
+
+def series(cursor, start, end, interval='day', document_id=None, plant_id=None, department_id=None):
+    """Downloads per day, week or month between two dates, inclusive"""
+    if plant_id:
+        source, where, params = 'download_daily_plants', 'plant_id = %s AND ', [plant_id]
+    elif department_id:
+        source, where, params = 'download_daily_departments', 'department_id = %s AND ', [department_id]
+    else:
+        source, where, params = 'download_daily_documents', '', []
+    if document_id:
+        where += 'document_id = %s AND '
+        params.append(document_id)
+    cursor.execute(f'''
+        SELECT date_trunc(%s, day)::date AS period, SUM(downloads)::bigint AS downloads
+        FROM {source}
+        WHERE {where}day BETWEEN %s AND %s
+        GROUP BY 1
+        ORDER BY 1
+    ''', [interval] + params + [start, end])
+    return cursor.fetchall()
+
+
+def departments(cursor, start, end, plant_id=None):
+    """Downloads per department between two dates, inclusive.
+
+    With ``plant_id`` only documents of that plant count.
+    """
+    join, params = '', []
+    if plant_id:
+        join = 'JOIN document_plants dp ON dp.document_id = r.document_id AND dp.plant_id = %s'
+        params.append(plant_id)
+    cursor.execute(f'''
+        SELECT r.department_id AS id, n.name, SUM(r.downloads)::bigint AS downloads,
+               COUNT(DISTINCT r.document_id) AS documents
+        FROM download_daily_departments r
+        {join}
+        LEFT JOIN departments n ON n.id = r.department_id
+        WHERE r.day BETWEEN %s AND %s
+        GROUP BY r.department_id, n.name
+        ORDER BY downloads DESC, r.department_id
+    ''', params + [start, end])
+    return cursor.fetchall()
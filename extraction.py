@@ -0,0 +1,275 @@
+import io
+import os
+import re
+import zlib
+import zipfile
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+
+import psycopg2
+
+import config
+import jobs
+import storage
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Advisory lock namespace so two processes never extract the same document
+EXTRACTION_LOCK_NAMESPACE = 4101
+
+# Catch-up sweep for documents whose extract_text job was never queued
+PENDING_SWEEP_INTERVAL = 60
+PENDING_BATCH_SIZE = 500
+
+OOXML_MIMETYPES = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': 'pptx',
+}
+
+# Zip parts holding the visible text of each OOXML flavour
+OOXML_PARTS = {
+    'docx': re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$'),
+    'xlsx': re.compile(r'^xl/(sharedStrings|worksheets/sheet\d+)\.xml$'),
+    'pptx': re.compile(r'^ppt/(slides/slide\d+|notesSlides/notesSlide\d+)\.xml$'),
+}
+# Local element names that carry text / end a line in those parts
+OOXML_TEXT_TAGS = {'t'}
+OOXML_BREAK_TAGS = {'p', 'br', 'tab', 'row', 'si'}
+
+
+def file_sha256(path):
+    """SHA-256 of the original bytes (compressed blobs are hashed decompressed)"""
+    digest = hashlib.sha256()
+    with storage.open_stored(path) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _extract_ooxml(path, kind, max_chars):
+    pattern = OOXML_PARTS[kind]
+    parts = []
+    size = 0
+    with storage.open_stored(path) as f, zipfile.ZipFile(f) as zf:
+        names = sorted(n for n in zf.namelist() if pattern.match(n))
+        for name in names:
+            with zf.open(name) as part:
+                # iterparse streams the part instead of building the whole tree
+                for event, elem in ET.iterparse(part, events=('end',)):
+                    tag = _local_name(elem.tag)
+                    if tag in OOXML_TEXT_TAGS and elem.text:
+                        parts.append(elem.text)
+                        size += len(elem.text)
+                    elif tag in OOXML_BREAK_TAGS:
+                        parts.append('\n' if tag != 'tab' else '\t')
+                    elem.clear()
+                    if size >= max_chars:
+                        return ''.join(parts)[:max_chars]
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def _extract_txt(path, max_chars):
+    with io.TextIOWrapper(storage.open_stored(path), encoding='utf-8', errors='replace') as f:
+        return f.read(max_chars)
+
+
+_PDF_STREAM_RE = re.compile(rb'stream\r?\n(.*?)\r?\nendstream', re.S)
+_PDF_TEXT_RE = re.compile(rb'\((?:\\.|[^\\)])*\)\s*Tj|\[(?:\\.|[^\]])*\]\s*TJ')
+_PDF_STRING_RE = re.compile(rb'\(((?:\\.|[^\\)])*)\)')
+
+
+def _extract_pdf_fallback(path, max_chars):
+    """Best-effort text from Tj/TJ operators in (Flate) content streams.
+
+    Only used when pypdf is not installed; it handles simple single-byte
+    encoded PDFs, which covers most text exported by office tools.
+    """
+    with storage.open_stored(path) as f:
+        data = f.read()
+    chunks = []
+    size = 0
+    for match in _PDF_STREAM_RE.finditer(data):
+        stream = match.group(1)
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for op in _PDF_TEXT_RE.finditer(stream):
+            text = b''.join(_PDF_STRING_RE.findall(op.group(0)))
+            text = re.sub(rb'\\([()\\])', rb'\1', text)
+            chunks.append(text.decode('latin-1'))
+            size += len(chunks[-1])
+        chunks.append('\n')
+        if size >= max_chars:
+            break
+    return ''.join(chunks)[:max_chars]
+
+
+def _extract_pdf(path, max_chars):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return _extract_pdf_fallback(path, max_chars)
+    chunks = []
+    size = 0
+    with storage.stored_as_file(path) as local_path:
+        reader = PdfReader(local_path)
+        for page in reader.pages:
+            text = page.extract_text() or ''
+            chunks.append(text)
+            size += len(text)
+            if size >= max_chars:
+                break
+    return '\n'.join(chunks)[:max_chars]
+
+
+def extract_text(path, mime_type, max_chars=1000000):
+    """Return the plain text of a stored file (compressed or not), or None for unsupported types"""
+    ext = os.path.splitext(storage.original_name(path))[1].lower().lstrip('.')
+    if mime_type == 'text/plain' or ext == 'txt':
+        return _extract_txt(path, max_chars)
+    kind = OOXML_MIMETYPES.get(mime_type) or (ext if ext in OOXML_PARTS else None)
+    if kind:
+        return _extract_ooxml(path, kind, max_chars)
+    if mime_type == 'application/pdf' or ext == 'pdf':
+        return _extract_pdf(path, max_chars)
+    return None
+
+
+def extract_document(conn, document, max_chars=1000000):
+    """Extract and store the text of one document row.
+
+    ``document`` needs ``id``, ``file_path`` and ``mime_type``. The stored
+    content hash is compared first, so unchanged files are never re-read for
+    extraction. Returns True when the text was (re)extracted.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT content_hash FROM document_texts WHERE document_id = %s', (document['id'],))
+        existing = cursor.fetchone()
+
+        error = None
+        body = None
+        try:
+            content_hash = file_sha256(document['file_path'])
+        except OSError as e:
+            content_hash = None
+            error = f'File not readable: {e}'
+
+        if content_hash:
+            # Backfills the download ETag of documents uploaded before it existed
+            cursor.execute('UPDATE documents SET content_hash = %s WHERE id = %s AND content_hash IS NULL',
+                           (content_hash, document['id']))
+
+        if content_hash and existing and existing['content_hash'] == content_hash:
+            cursor.execute('UPDATE document_texts SET extracted_at = NOW() WHERE document_id = %s', (document['id'],))
+            conn.commit()
+            return False
+
+        if content_hash:
+            try:
+                body = extract_text(document['file_path'], document['mime_type'], max_chars)
+            except Exception as e:
+                error = f'Extraction failed: {e}'
+        if body:
+            # NUL bytes are not allowed in PostgreSQL text values
+            body = body.replace('\x00', '')
+
+        cursor.execute('''
+            INSERT INTO document_texts (document_id, content_hash, body, error, extracted_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (document_id) DO UPDATE
+            SET content_hash = EXCLUDED.content_hash, body = EXCLUDED.body,
+                error = EXCLUDED.error, extracted_at = EXCLUDED.extracted_at
+        ''', (document['id'], content_hash, body, error))
+        conn.commit()
+        if error:
+            logger.warning(f"Text extraction for document {document['id']}: {error}")
+        return True
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def pending_documents(cursor, limit, max_file_size=None):
+    """Documents with no extracted text, or edited since their last extraction"""
+    query = '''
+        SELECT d.id
+        FROM documents d
+        LEFT JOIN document_texts t ON t.document_id = d.id
+        WHERE (t.document_id IS NULL OR t.extracted_at < d.updated_at)
+    '''
+    params = []
+    if max_file_size:
+        query += ' AND COALESCE(d.file_size, 0) <= %s'
+        params.append(max_file_size)
+    query += ' ORDER BY d.id LIMIT %s'
+    params.append(limit)
+    cursor.execute(query, params)
+    return [row['id'] for row in cursor.fetchall()]
+
+
+def enqueue(cursor, document_ids):
+    """Queue text extraction for new or changed documents in the caller's transaction"""
+    if not config.TEXT_EXTRACTION_ENABLED:
+        return
+    for document_id in document_ids:
+        jobs.enqueue(cursor, 'extract_text', {'document_id': document_id}, dedupe_key=str(document_id))
+
+
+@jobs.handler('extract_text')
+def run_extract_text(conn, payload):
+    document_id = payload['document_id']
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT id, file_path, mime_type, file_size FROM documents WHERE id = %s', (document_id,))
+        document = cursor.fetchone()
+        max_file_size = config.TEXT_EXTRACTION_MAX_FILE_SIZE
+        if document is None or (max_file_size and (document['file_size'] or 0) > max_file_size):
+            conn.rollback()
+            return
+        # Session lock: extract_document commits, and a job reclaimed after a
+        # lease timeout must not run alongside the original
+        cursor.execute('SELECT pg_try_advisory_lock(%s, %s) AS locked', (EXTRACTION_LOCK_NAMESPACE, document_id))
+        if not cursor.fetchone()['locked']:
+            conn.rollback()
+            return
+        try:
+            extract_document(conn, document, config.TEXT_EXTRACTION_MAX_CHARS)
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', (EXTRACTION_LOCK_NAMESPACE, document_id))
+            conn.commit()
+    finally:
+        cursor.close()
+
+
+@jobs.handler('extract_pending')
+def run_extract_pending(conn, payload):
+    """Catch-up sweep: queue documents that were never (or not re-) extracted.
+
+    Covers documents imported outside the upload routes and jobs that ended
+    up failed, so the index converges even if an enqueue was missed.
+    """
+    cursor = conn.cursor()
+    try:
+        pending = pending_documents(cursor, PENDING_BATCH_SIZE, config.TEXT_EXTRACTION_MAX_FILE_SIZE)
+        enqueue(cursor, pending)
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+jobs.limit('extract_text', config.TEXT_EXTRACTION_RATE_LIMIT)
+if config.TEXT_EXTRACTION_ENABLED:
+    jobs.every(PENDING_SWEEP_INTERVAL, 'extract_pending')
@@ -0,0 +1,351 @@
+import time
+import select
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import Json
+
+import models
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# Channel notified by enqueue() on commit; the payload is the job kind
+CHANNEL = 'jobs'
+
+# kind -> callable(conn, payload)
+HANDLERS = {}
+# (interval seconds, kind) pairs a worker enqueues on a timer
+PERIODIC = []
+# kind -> most jobs per second each process starts (see limit())
+RATE_LIMITS = {}
+# kind -> monotonic time before which this process starts no further job
+_next_start = {}
+_rate_lock = threading.Lock()
+
+
+def handler(kind):
+    """Register the function run for jobs of ``kind``.
+
+    Handlers receive a pooled connection and the job payload and commit
+    their own work. Delivery is at-least-once (a worker that dies mid-job
+    leaves it to be claimed again after the visibility timeout), so handlers
+    must be safe to run twice.
+    """
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def every(interval, kind):
+    """Have workers enqueue a ``kind`` job every ``interval`` seconds"""
+    PERIODIC.append((interval, kind))
+
+
+def limit(kind, rate):
+    """Start at most ``rate`` jobs of ``kind`` per second in each process.
+
+    Shared by every worker thread of the process, so the web process's
+    embedded workers cannot saturate its CPU with, say, PDF parsing.
+    A rate of 0 (or less) means no limit.
+    """
+    if rate and rate > 0:
+        RATE_LIMITS[kind] = rate
+    else:
+        RATE_LIMITS.pop(kind, None)
+
+
+def throttled_kinds():
+    """Rate-limited kinds that may not start now, and the seconds until the next one may"""
+    now = time.monotonic()
+    with _rate_lock:
+        waits = {kind: at - now for kind, at in _next_start.items() if at > now}
+    return list(waits), min(waits.values(), default=0)
+
+
+def _started(kind):
+    rate = RATE_LIMITS.get(kind)
+    if rate:
+        with _rate_lock:
+            _next_start[kind] = max(_next_start.get(kind, 0), time.monotonic()) + 1 / rate
+
+
+def enqueue(cursor, kind, payload=None, delay=0, dedupe_key=None, max_attempts=5):
+    """Queue a job in the caller's transaction.
+
+    The job only becomes visible (and workers are only woken) when the
+    caller commits, so work is never started for a rolled-back change. With
+    ``dedupe_key`` a job is skipped while an identical one is still queued.
+    Returns the job id, or None when it was deduplicated.
+    """
+    cursor.execute('''
+        INSERT INTO jobs (kind, payload, run_at, dedupe_key, max_attempts)
+        VALUES (%s, %s, NOW() + make_interval(secs => %s), %s, %s)
+        ON CONFLICT (kind, dedupe_key) WHERE status = 'queued' AND dedupe_key IS NOT NULL DO NOTHING
+        RETURNING id
+    ''', (kind, Json(payload or {}), delay, dedupe_key, max_attempts))
+    row = cursor.fetchone()
+    cursor.execute('SELECT pg_notify(%s, %s)', (CHANNEL, kind))
+    return row['id'] if row else None
+
+
+def claim(cursor, visibility_timeout, kinds=None, exclude_kinds=None):
+    """Lease the next due job for ``visibility_timeout`` seconds, or return None.
+
+    Running jobs whose lease expired (their worker died) are claimed again.
+    SKIP LOCKED lets any number of workers dequeue concurrently without
+    blocking on each other's rows.
+    """
+    query = '''
+        UPDATE jobs SET status = 'running', attempts = attempts + 1,
+            locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE ((status = 'queued' AND run_at <= NOW())
+                OR (status = 'running' AND locked_until < NOW()))
+    '''
+    params = [visibility_timeout]
+    if kinds:
+        query += ' AND kind = ANY(%s)'
+        params.append(list(kinds))
+    if exclude_kinds:
+        query += ' AND kind <> ALL(%s)'
+        params.append(list(exclude_kinds))
+    query += '''
+            ORDER BY run_at, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    '''
+    cursor.execute(query, params)
+    return cursor.fetchone()
+
+
+def extend_lease(cursor, job, visibility_timeout):
+    """Push a running job's lease out; False if another worker has reclaimed it"""
+    cursor.execute('''
+        UPDATE jobs SET locked_until = NOW() + make_interval(secs => %s)
+        WHERE id = %s AND status = 'running' AND attempts = %s
+    ''', (visibility_timeout, job['id'], job['attempts']))
+    return cursor.rowcount == 1
+
+
+class _Heartbeat:
+    """Keeps extending a job's lease while its handler runs.
+
+    Without it a handler running past the visibility timeout (a large PDF,
+    a slow conversion) would be claimed and run a second time. Each beat
+    uses its own pooled connection, as the handler's is busy.
+    """
+
+    def __init__(self, job, visibility_timeout):
+        self.job = job
+        self.visibility_timeout = visibility_timeout
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"job-heartbeat-{job['id']}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.visibility_timeout / 3):
+            try:
+                with models.pooled_connection() as conn:
+                    cursor = conn.cursor()
+                    extended = extend_lease(cursor, self.job, self.visibility_timeout)
+                    conn.commit()
+                    cursor.close()
+                if not extended:
+                    return
+            except Exception as e:
+                logger.warning(f"Could not extend the lease of job {self.job['id']}: {e}")
+
+
+def complete(cursor, job):
+    cursor.execute('DELETE FROM jobs WHERE id = %s', (job['id'],))
+
+
+def fail(cursor, job, error, retry_delay=10, max_delay=3600):
+    """Requeue a failed job with exponential backoff, or park it as 'failed'"""
+    if job['attempts'] >= job['max_attempts']:
+        cursor.execute('''
+            UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = %s, updated_at = NOW()
+            WHERE id = %s
+        ''', (error, job['id']))
+        return False
+    delay = min(retry_delay * 2 ** (job['attempts'] - 1), max_delay)
+    # An identical job queued meanwhile already covers the retry
+    cursor.execute('''
+        UPDATE jobs SET status = 'queued', locked_until = NULL, last_error = %s,
+            run_at = NOW() + make_interval(secs => %s), updated_at = NOW()
+        WHERE id = %s AND NOT EXISTS (
+            SELECT 1 FROM jobs q
+            WHERE q.status = 'queued' AND q.kind = %s AND q.dedupe_key = %s
+        )
+    ''', (error, delay, job['id'], job['kind'], job['dedupe_key']))
+    if cursor.rowcount == 0:
+        complete(cursor, job)
+    return True
+
+
+class Worker:
+    """Claims and runs jobs until stopped.
+
+    Sleeps on LISTEN ``CHANNEL`` so a commit that enqueues work wakes it at
+    once, and polls every ``poll_interval`` seconds for delayed retries and
+    expired leases. Runs in a thread inside the web process or as its own
+    process via ``python -m worker``.
+    """
+
+    def __init__(self, visibility_timeout=300, poll_interval=5, retry_delay=10, kinds=None,
+                 dsn=DATABASE_URL, name='job-worker'):
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.kinds = kinds
+        self.dsn = dsn
+        self.name = name
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_periodic = {}
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None and timeout is not None:
+            self._thread.join(timeout)
+
+    def run_one(self):
+        """Claim and run a single job; returns False when nothing was due"""
+        with models.pooled_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                job = claim(cursor, self.visibility_timeout, self.kinds, throttled_kinds()[0])
+                conn.commit()
+                if job is None:
+                    return False
+                _started(job['kind'])
+
+                func = HANDLERS.get(job['kind'])
+                error = None
+                started = time.monotonic()
+                try:
+                    if func is None:
+                        raise LookupError(f"No handler registered for job kind '{job['kind']}'")
+                    with _Heartbeat(job, self.visibility_timeout):
+                        func(conn, job['payload'])
+                except Exception as e:
+                    conn.rollback()
+                    error = f'{type(e).__name__}: {e}'
+
+                if error is None:
+                    complete(cursor, job)
+                    logger.debug(f"Job {job['id']} ({job['kind']}) done in {time.monotonic() - started:.2f}s")
+                elif fail(cursor, job, error, self.retry_delay):
+                    logger.warning(f"Job {job['id']} ({job['kind']}) failed, will retry: {error}")
+                else:
+                    logger.error(f"Job {job['id']} ({job['kind']}) failed after {job['attempts']} attempts: {error}")
+                conn.commit()
+                return True
+            finally:
+                cursor.close()
+
+    def run_pending(self):
+        handled = 0
+        while not self._stop.is_set():
+            if self.run_one():
+                handled += 1
+                continue
+            # Rate-limited kinds may have due jobs: wait for the next slot
+            # instead of a whole poll interval
+            throttled, wait = throttled_kinds()
+            if not throttled or wait >= self.poll_interval:
+                break
+            self._stop.wait(wait)
+        return handled
+
+    def _enqueue_periodic(self):
+        now = time.monotonic()
+        due = [kind for interval, kind in PERIODIC if self._next_periodic.get(kind, 0) <= now]
+        if not due:
+            return
+        with models.pooled_connection() as conn:
+            cursor = conn.cursor()
+            for interval, kind in PERIODIC:
+                if kind in due:
+                    # Every worker does this; the dedupe key keeps one queued copy
+                    enqueue(cursor, kind, dedupe_key='periodic')
+                    self._next_periodic[kind] = now + interval
+            conn.commit()
+            cursor.close()
+
+    def _tick(self):
+        try:
+            self._enqueue_periodic()
+            self.run_pending()
+        except Exception as e:
+            logger.error(f'Job worker error: {e}')
+
+    def run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                listen = conn.cursor()
+                listen.execute(f'LISTEN {CHANNEL}')
+                backoff = 1
+                while not self._stop.is_set():
+                    self._tick()
+                    if select.select([conn], [], [], self.poll_interval) != ([], [], []):
+                        conn.poll()
+                        conn.notifies.clear()
+            except Exception as e:
+                logger.warning(f'Job worker listener disconnected: {e}')
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            # Keep working by polling while the listener reconnects
+            deadline = time.monotonic() + backoff
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                self._tick()
+                self._stop.wait(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            backoff = min(backoff * 2, 60)
+
+
+def worker_options(settings):
+    """Worker keyword arguments from a Flask config or the config module's globals"""
+    return {
+        'visibility_timeout': settings.get('JOBS_VISIBILITY_TIMEOUT', 300),
+        'poll_interval': settings.get('JOBS_POLL_INTERVAL', 5),
+        'retry_delay': settings.get('JOBS_RETRY_DELAY', 10),
+    }
+
+
+workers = []
+
+
+def init_app(app):
+    """Start JOBS_EMBEDDED_WORKERS worker threads inside the web process"""
+    for i in range(app.config.get('JOBS_EMBEDDED_WORKERS', 1)):
+        worker = Worker(name=f'job-worker-{i + 1}', **worker_options(app.config))
+        worker.start()
+        workers.append(worker)
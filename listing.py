@@ -0,0 +1,241 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+
+from search import TS_CONFIG, prefix_tsquery
+
+# Listings read the denormalized document_listing projection (alias "l"),
+# one row per document with uploader, type, plant and department already
+# resolved, so a page is a single-table scan with no joins or GROUP BY.
+LISTING_COLUMNS = '''
+    l.document_id AS id, l.title, l.description, l.filename, l.file_path, l.file_size,
+    l.mime_type, l.uploaded_at, l.updated_at, l.uploader_id, l.uploader_name,
+    l.document_type_id, l.document_type_name, l.plant_ids, l.department_ids,
+    l.plant_names, l.department_names
+'''
+
+# Whitelisted sort keys -> SQL expression. Every column sort has a matching
+# (expression, document_id) index so keyset pages are index range scans.
+SORT_MAP = {
+    'title': 'l.title',
+    'uploaded_at': 'l.uploaded_at',
+    'size': 'COALESCE(l.file_size, 0)',
+    # Untyped documents have no type name; '' keeps them in keyset comparisons
+    'type': "COALESCE(l.document_type_name, '')",
+    # Only available with a full-text search; "query" is the tsquery joined
+    # in by build_filters(). Cast to float8 so cursor values round-trip exactly.
+    'relevance': 'ts_rank_cd(sd.search_vector, query, 32)::float8',
+}
+DEFAULT_SORT = 'uploaded_at'
+
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded or does not match the query"""
+
+
+def encode_cursor(sort, order, direction, sort_value, document_id):
+    """Build an opaque cursor pointing just past (sort_value, document_id)"""
+    if isinstance(sort_value, datetime):
+        sort_value = {'dt': sort_value.isoformat()}
+    payload = {'s': sort, 'o': order, 'd': direction, 'v': sort_value, 'id': document_id}
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort, order):
+    """Decode a cursor produced by encode_cursor for the same sort and order"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+        value = payload['v']
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value['dt'])
+        document_id = int(payload['id'])
+        direction = payload.get('d', 'next')
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise InvalidCursor('Malformed cursor')
+    if payload.get('s') != sort or payload.get('o') != order or direction not in ('next', 'prev'):
+        raise InvalidCursor('Cursor does not match the requested sort order')
+    return direction, value, document_id
+
+
+def parse_sort(args, filters=None):
+    ranked = bool(filters and filters['tsquery'])
+    sort = args.get('sort') or ('relevance' if ranked else DEFAULT_SORT)
+    if sort not in SORT_MAP or (sort == 'relevance' and not ranked):
+        sort = DEFAULT_SORT
+    order = 'asc' if args.get('order', 'desc').lower() == 'asc' else 'desc'
+    return sort, order
+
+
+def build_filters(args, max_ranked=None):
+    """Translate listing query-string filters into SQL fragments.
+
+    Returns a dict of ``joins`` (FROM items, with ``join_params``) and
+    ``where`` clauses (with ``params``). A full-text search joins the parsed
+    tsquery in as ``query`` so sort and filter expressions can share it.
+    """
+    filters = {'joins': [], 'join_params': [], 'where': [], 'params': [], 'tsquery': None}
+
+    plant_filter = args.get('plant_id')
+    dept_filter = args.get('department_id')
+    if plant_filter:
+        filters['where'].append('l.plant_ids && ARRAY[%s]::int[]')
+        filters['params'].append(plant_filter)
+    if dept_filter:
+        filters['where'].append('l.department_ids && ARRAY[%s]::int[]')
+        filters['params'].append(dept_filter)
+
+    search = args.get('search')
+    search_mode = args.get('search_mode', 'fulltext')
+    if search and search_mode == 'title':
+        filters['where'].append('l.title ILIKE %s')
+        filters['params'].append(f'%{search}%')
+    elif search:
+        tsquery = prefix_tsquery(search)
+        if tsquery is None:
+            # Nothing searchable (only punctuation): match nothing, like an
+            # ILIKE on a string no title contains.
+            filters['where'].append('FALSE')
+        else:
+            filters['tsquery'] = tsquery
+            # The search vector lives on documents; join it in by primary key
+            filters['joins'].append('JOIN documents sd ON sd.id = l.document_id')
+            filters['joins'].append(f'CROSS JOIN to_tsquery(\'{TS_CONFIG}\', %s) query')
+            filters['join_params'].append(tsquery)
+            filters['where'].append('sd.search_vector @@ query')
+            if max_ranked and parse_sort(args, filters)[0] == 'relevance':
+                # Relevance order only keeps the best max_ranked matches, in
+                # the listing's own order (rank, then newest id first), so
+                # pages and counts are stable. Every match is still scored to
+                # find them: this bounds the rows read from the listing
+                # projection and sorted, not the ranking work. Other sorts
+                # see every match.
+                filters['where'].append('''l.document_id IN (
+                    SELECT rd.id FROM documents rd
+                    WHERE rd.search_vector @@ query
+                    ORDER BY ts_rank_cd(rd.search_vector, query, 32) DESC, rd.id DESC
+                    LIMIT %s
+                )''')
+                filters['params'].append(max_ranked)
+
+    return filters
+
+
+def count_documents(cursor, filters, mode='exact'):
+    """Count matching documents exactly, from planner estimates, or not at all"""
+    if mode == 'none':
+        return None
+    query = 'SELECT {} FROM document_listing l ' + ' '.join(filters['joins'])
+    if filters['where']:
+        query += ' WHERE ' + ' AND '.join(filters['where'])
+    params = filters['join_params'] + filters['params']
+    if mode == 'estimate':
+        if not filters['where']:
+            cursor.execute("SELECT GREATEST(reltuples, 0)::bigint AS count FROM pg_class WHERE oid = 'document_listing'::regclass")
+            return cursor.fetchone()['count']
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query.format('1'), params)
+        plan = cursor.fetchone()['QUERY PLAN']
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    cursor.execute(query.format('COUNT(*) AS count'), params)
+    return cursor.fetchone()['count']
+
+
+def fetch_document_page(cursor, args, per_page, page=None, cursor_token=None, count_mode='exact',
+                        max_ranked=None):
+    """Fetch one page of the document listing.
+
+    Pages are addressed either by ``cursor_token`` (keyset pagination on
+    ``(sort_col, document_id)``, cost independent of depth) or by the legacy
+    ``page`` number (OFFSET). Returns a dict with the rows, the next/previous
+    cursors and the total count (``None`` when ``count_mode`` is ``'none'``).
+    ``max_ranked`` caps a relevance-sorted search to its best matches.
+    """
+    filters = build_filters(args, max_ranked=max_ranked)
+    sort, order = parse_sort(args, filters)
+    sort_col = SORT_MAP[sort]
+    total_count = count_documents(cursor, filters, count_mode)
+
+    direction = 'next'
+    page_where = list(filters['where'])
+    page_params = filters['join_params'] + filters['params']
+    if cursor_token:
+        direction, value, last_id = decode_cursor(cursor_token, sort, order)
+        # Walking backwards flips the comparison and the scan order; rows are
+        # reversed again below so the page always reads in the requested order.
+        forward = direction == 'next'
+        comparator = '<' if (order == 'desc') == forward else '>'
+        page_where.append(f'({sort_col}, l.document_id) {comparator} (%s, %s)')
+        page_params.extend([value, last_id])
+    scan_desc = (order == 'desc') == (direction == 'next')
+    scan_dir = 'DESC' if scan_desc else 'ASC'
+
+    query = f'''
+        SELECT {LISTING_COLUMNS}, {sort_col} AS sort_key
+        FROM document_listing l
+        {' '.join(filters['joins'])}
+    '''
+    if page_where:
+        query += ' WHERE ' + ' AND '.join(page_where)
+    query += f' ORDER BY {sort_col} {scan_dir}, l.document_id {scan_dir} LIMIT %s'
+    page_params.append(per_page + 1)
+    if page is not None and not cursor_token:
+        query += ' OFFSET %s'
+        page_params.append((page - 1) * per_page)
+    cursor.execute(query, page_params)
+    rows = cursor.fetchall()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next = has_more
+        has_prev = bool(cursor_token) or (page is not None and page > 1)
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(sort, order, 'next', rows[-1]['sort_key'], rows[-1]['id'])
+    if rows and has_prev:
+        prev_cursor = encode_cursor(sort, order, 'prev', rows[0]['sort_key'], rows[0]['id'])
+
+    return {
+        'rows': rows,
+        'sort': sort,
+        'order': order,
+        'total_count': total_count,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+
+
+def shape_document(row):
+    """Shape a listing row for templates and JSON responses"""
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'description': row['description'],
+        'filename': row['filename'],
+        'file_size': row['file_size'],
+        'mime_type': row['mime_type'],
+        'uploaded_at': row['uploaded_at'],
+        'updated_at': row['updated_at'],
+        'uploader': {
+            'id': row['uploader_id'],
+            'username': row['uploader_name'],
+        },
+        'document_type': {
+            'id': row['document_type_id'],
+            'name': row['document_type_name'],
+        },
+        'plants': row['plant_names'],
+        'departments': row['department_names'],
+        'plant_ids': row['plant_ids'],
+        'department_ids': row['department_ids'],
+    }
@@ -3,17 +3,112 @@ import secrets
 from psycopg2.extras import RealDictCursor
 from werkzeug.security import generate_password_hash
 
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from flask import g, has_app_context
+
+import config
 from config import DATABASE_URL
+from db_pool import ConnectionPool, PooledConnection
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=config.DB_POOL_MIN_SIZE,
+                    max_size=config.DB_POOL_MAX_SIZE,
+                    timeout=config.DB_POOL_TIMEOUT,
+                    max_lifetime=config.DB_POOL_RECYCLE,
+                    health_check=config.DB_POOL_PRE_PING,
+                    cursor_factory=RealDictCursor,
+                )
+    return _pool
 
 def get_db_connection():
-    """Get PostgreSQL database connection"""
+    """Get PostgreSQL database connection.
+
+    Inside a Flask app context this is the request's pooled connection, shared
+    by every caller in the request and returned to the pool on teardown.
+    Outside an app context (CLI scripts) a standalone connection is opened.
+    """
     try:
+        if has_app_context():
+            if 'db_conn' not in g:
+                g.db_conn = PooledConnection(get_pool().getconn())
+            return g.db_conn
         conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
         return conn
     except psycopg2.Error as e:
         print(f"Database connection error: {e}")
         return None
 
+def release_db_connection(exception=None):
+    """Teardown handler: hand the request's connection back to the pool"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn.raw, discard=conn.raw.closed != 0)
+
+@contextmanager
+def pooled_connection():
+    """Borrow a pooled connection outside of a request (background threads)"""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def init_app(app):
+    app.teardown_appcontext(release_db_connection)
+
+# Junction tables written through sync_links/add_links: table -> (owner column, linked column)
+LINK_TABLES = {
+    'document_plants': ('document_id', 'plant_id'),
+    'document_departments': ('document_id', 'department_id'),
+    'user_plants': ('user_id', 'plant_id'),
+    'user_departments': ('user_id', 'department_id'),
+}
+
+def sync_links(cursor, table, owner_id, ids):
+    """Make ``owner_id`` link to exactly ``ids`` in ``table`` with one statement.
+
+    Only the difference is written: links that are no longer wanted are
+    deleted and missing ones inserted, so an unchanged selection touches no
+    rows (and fires no row-level work in the link triggers).
+    """
+    owner_col, link_col = LINK_TABLES[table]
+    ids = sorted({int(i) for i in ids})
+    cursor.execute(f'''
+        WITH removed AS (
+            DELETE FROM {table}
+            WHERE {owner_col} = %(owner)s AND {link_col} <> ALL(%(ids)s::int[])
+        )
+        INSERT INTO {table} ({owner_col}, {link_col})
+        SELECT %(owner)s, wanted.id FROM unnest(%(ids)s::int[]) AS wanted(id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table} t WHERE t.{owner_col} = %(owner)s AND t.{link_col} = wanted.id
+        )
+        ON CONFLICT DO NOTHING
+    ''', {'owner': owner_id, 'ids': ids})
+
+def add_links(cursor, table, owner_ids, ids):
+    """Link every owner in ``owner_ids`` to every id in ``ids`` with one statement"""
+    owner_col, link_col = LINK_TABLES[table]
+    cursor.execute(f'''
+        INSERT INTO {table} ({owner_col}, {link_col})
+        SELECT owner.id, linked.id
+        FROM unnest(%s::int[]) AS owner(id) CROSS JOIN unnest(%s::int[]) AS linked(id)
+        ON CONFLICT DO NOTHING
+    ''', (sorted({int(i) for i in owner_ids}), sorted({int(i) for i in ids})))
+
 def recreate_tables():
     """Drops all existing tables from the PostgreSQL database."""
     conn = get_db_connection()
@@ -24,6 +119,19 @@ def recreate_tables():
     cursor = conn.cursor()
     try:
         cursor.execute('''
+            DROP TABLE IF EXISTS document_count_deltas CASCADE;
+            DROP TABLE IF EXISTS document_counts CASCADE;
+            DROP TABLE IF EXISTS download_daily_departments CASCADE;
+            DROP TABLE IF EXISTS download_daily_plants CASCADE;
+            DROP TABLE IF EXISTS download_daily_users CASCADE;
+            DROP TABLE IF EXISTS download_daily_documents CASCADE;
+            DROP TABLE IF EXISTS rollup_state CASCADE;
+            DROP TABLE IF EXISTS conversions CASCADE;
+            DROP TABLE IF EXISTS jobs CASCADE;
+            DROP TABLE IF EXISTS upload_sessions CASCADE;
+            DROP TABLE IF EXISTS blobs CASCADE;
+            DROP TABLE IF EXISTS document_listing CASCADE;
+            DROP TABLE IF EXISTS document_texts CASCADE;
             DROP TABLE IF EXISTS admin_notifications CASCADE;
             DROP TABLE IF EXISTS document_requests CASCADE;
             DROP TABLE IF EXISTS audit_logs CASCADE;
@@ -51,6 +159,9 @@ def recreate_tables():
 
 def init_db(force_recreate=False):
     """Initialize PostgreSQL database"""
+    # Imported here: partitions registers a job handler, and jobs imports this module
+    import partitions
+
     conn = get_db_connection()
     if not conn:
         print("Failed to connect to database")
@@ -63,6 +174,9 @@ def init_db(force_recreate=False):
             if not recreate_tables():
                 return False
         
+        # Log tables from before partitioning are renamed aside here and
+        # copied into the partitioned ones at the end
+        partitions.detach_legacy(cursor)
 
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS plants (
@@ -132,23 +246,26 @@ def init_db(force_recreate=False):
             );
         ''')
         cursor.execute('''
+            -- Partitioned by month (see partitions.py); no FK to documents so
+            -- download history outlives deleted documents
             CREATE TABLE IF NOT EXISTS download_logs (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 document_id INTEGER NOT NULL,
                 user_id INTEGER NOT NULL,
-                downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (document_id) REFERENCES documents (id),
+                downloaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, downloaded_at),
                 FOREIGN KEY (user_id) REFERENCES users (id)
-            )
+            ) PARTITION BY RANGE (downloaded_at)
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS audit_logs (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 user_id INTEGER REFERENCES users(id),
                 action VARCHAR(255) NOT NULL,
                 details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
+                timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
 
             CREATE TABLE IF NOT EXISTS document_requests (
                 id SERIAL PRIMARY KEY,
@@ -218,6 +335,7 @@ def init_db(force_recreate=False):
         ''')
 
         cursor.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
                 id SERIAL PRIMARY KEY,
                 title VARCHAR(200) NOT NULL,
                 description TEXT,
@@ -246,24 +364,27 @@ def init_db(force_recreate=False):
         ''')
         
         cursor.execute('''
+            -- Partitioned by month (see partitions.py); no FK to documents so
+            -- download history outlives deleted documents
             CREATE TABLE IF NOT EXISTS download_logs (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 document_id INTEGER NOT NULL,
                 user_id INTEGER NOT NULL,
-                downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (document_id) REFERENCES documents (id),
+                downloaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, downloaded_at),
                 FOREIGN KEY (user_id) REFERENCES users (id)
-            )
+            ) PARTITION BY RANGE (downloaded_at)
         ''')
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS audit_logs (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 user_id INTEGER REFERENCES users(id),
                 action VARCHAR(255) NOT NULL,
                 details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
+                timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
 
             CREATE TABLE IF NOT EXISTS document_requests (
                 id SERIAL PRIMARY KEY,
@@ -296,9 +417,579 @@ def init_db(force_recreate=False):
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_uploaded_at ON documents(uploaded_at)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_uploader ON documents(uploaded_by)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_logs_document ON download_logs(document_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_logs_user ON download_logs(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_logs_date ON download_logs(downloaded_at)')
+
+
+        # Full-text search: weighted title (A), description (B) and extracted file text (C)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS document_texts (
+                document_id INTEGER PRIMARY KEY REFERENCES documents(id) ON DELETE CASCADE,
+                content_hash CHAR(64),
+                body TEXT,
+                extracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            ALTER TABLE document_texts ADD COLUMN IF NOT EXISTS error TEXT;
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector tsvector;
+        ''')
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION documents_search_vector(doc_title TEXT, doc_description TEXT, doc_body TEXT)
+            RETURNS tsvector AS $$
+                SELECT setweight(to_tsvector('english', COALESCE(doc_title, '')), 'A') ||
+                       setweight(to_tsvector('english', COALESCE(doc_description, '')), 'B') ||
+                       -- tsvector values are capped at 1MB, so only index the head of very long texts
+                       setweight(to_tsvector('english', LEFT(COALESCE(doc_body, ''), 262144)), 'C')
+            $$ LANGUAGE sql IMMUTABLE;
+
+            CREATE OR REPLACE FUNCTION documents_search_vector_trigger() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := documents_search_vector(
+                    NEW.title, NEW.description,
+                    (SELECT body FROM document_texts WHERE document_id = NEW.id)
+                );
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_documents_search_vector ON documents;
+            CREATE TRIGGER trg_documents_search_vector
+                BEFORE INSERT OR UPDATE OF title, description ON documents
+                FOR EACH ROW EXECUTE FUNCTION documents_search_vector_trigger();
+
+            CREATE OR REPLACE FUNCTION document_texts_search_vector_trigger() RETURNS trigger AS $$
+            BEGIN
+                UPDATE documents
+                SET search_vector = documents_search_vector(title, description, NEW.body)
+                WHERE id = NEW.document_id;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_document_texts_search_vector ON document_texts;
+            CREATE TRIGGER trg_document_texts_search_vector
+                AFTER INSERT OR UPDATE OF body ON document_texts
+                FOR EACH ROW EXECUTE FUNCTION document_texts_search_vector_trigger();
+        ''')
+        # Backfill rows created before the search column existed
+        cursor.execute('''
+            UPDATE documents d
+            SET search_vector = documents_search_vector(d.title, d.description, t.body)
+            FROM documents d2
+            LEFT JOIN document_texts t ON t.document_id = d2.id
+            WHERE d.id = d2.id AND d.search_vector IS NULL
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_search_vector ON documents USING GIN (search_vector)')
+
+        # Trigram index for typo-tolerant title suggestions (KNN ordering needs GiST)
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_title_trgm ON documents USING GIST (title gist_trgm_ops)')
+
+        # Plant/department id arrays on documents, kept in sync with the junction tables.
+        # Visibility checks and filters use the && overlap operator on their GIN indexes.
+        cursor.execute('''
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS plant_ids INTEGER[] NOT NULL DEFAULT '{}';
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS department_ids INTEGER[] NOT NULL DEFAULT '{}';
+
+            -- Locks the documents first: under READ COMMITTED, two transactions
+            -- editing links of one document would otherwise each compute the arrays
+            -- from a snapshot missing the other's rows, and the last writer would
+            -- drop the other's plants/departments. The UPDATE runs after the lock
+            -- is granted, with a fresh snapshot that includes committed links.
+            CREATE OR REPLACE FUNCTION sync_document_link_arrays(doc_ids INTEGER[]) RETURNS void AS $$
+            BEGIN
+                PERFORM 1 FROM documents WHERE id = ANY(doc_ids) ORDER BY id FOR UPDATE;
+                UPDATE documents d
+                SET plant_ids = x.plant_ids, department_ids = x.department_ids
+                FROM (
+                    SELECT doc.id,
+                           ARRAY(SELECT dp.plant_id FROM document_plants dp WHERE dp.document_id = doc.id ORDER BY dp.plant_id) AS plant_ids,
+                           ARRAY(SELECT dd.department_id FROM document_departments dd WHERE dd.document_id = doc.id ORDER BY dd.department_id) AS department_ids
+                    FROM documents doc
+                    WHERE doc.id = ANY(doc_ids)
+                ) x
+                WHERE d.id = x.id
+                  AND (d.plant_ids IS DISTINCT FROM x.plant_ids OR d.department_ids IS DISTINCT FROM x.department_ids);
+            END
+            $$ LANGUAGE plpgsql;
+
+            -- Link changes are handled per statement so a multi-row insert syncs each document once
+            CREATE OR REPLACE FUNCTION document_links_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                    PERFORM sync_document_link_arrays(ARRAY(SELECT DISTINCT document_id FROM old_rows));
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    PERFORM sync_document_link_arrays(ARRAY(SELECT DISTINCT document_id FROM new_rows));
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_document_plants_ins ON document_plants;
+            CREATE TRIGGER trg_document_plants_ins AFTER INSERT ON document_plants
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+            DROP TRIGGER IF EXISTS trg_document_plants_upd ON document_plants;
+            CREATE TRIGGER trg_document_plants_upd AFTER UPDATE ON document_plants
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+            DROP TRIGGER IF EXISTS trg_document_plants_del ON document_plants;
+            CREATE TRIGGER trg_document_plants_del AFTER DELETE ON document_plants
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+
+            DROP TRIGGER IF EXISTS trg_document_departments_ins ON document_departments;
+            CREATE TRIGGER trg_document_departments_ins AFTER INSERT ON document_departments
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+            DROP TRIGGER IF EXISTS trg_document_departments_upd ON document_departments;
+            CREATE TRIGGER trg_document_departments_upd AFTER UPDATE ON document_departments
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+            DROP TRIGGER IF EXISTS trg_document_departments_del ON document_departments;
+            CREATE TRIGGER trg_document_departments_del AFTER DELETE ON document_departments
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_links_trigger();
+
+            CREATE INDEX IF NOT EXISTS idx_documents_plant_ids ON documents USING GIN (plant_ids);
+            CREATE INDEX IF NOT EXISTS idx_documents_department_ids ON documents USING GIN (department_ids);
+        ''')
+        cursor.execute('''
+            SELECT sync_document_link_arrays(ARRAY(SELECT id FROM documents))
+        ''')
+
+        # Denormalized listing projection: one row per document, kept current by triggers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS document_listing (
+                document_id INTEGER PRIMARY KEY REFERENCES documents(id) ON DELETE CASCADE,
+                title VARCHAR(200) NOT NULL,
+                description TEXT,
+                filename VARCHAR(255) NOT NULL,
+                file_path VARCHAR(500) NOT NULL,
+                file_size BIGINT,
+                mime_type VARCHAR(100),
+                uploaded_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                uploader_id INTEGER,
+                uploader_name VARCHAR(80),
+                document_type_id INTEGER,
+                document_type_name VARCHAR(100),
+                plant_ids INTEGER[] NOT NULL DEFAULT '{}',
+                department_ids INTEGER[] NOT NULL DEFAULT '{}',
+                plant_names TEXT,
+                department_names TEXT
+            );
+
+            CREATE OR REPLACE FUNCTION refresh_document_listing(doc_ids INTEGER[]) RETURNS void AS $$
+            BEGIN
+                IF doc_ids IS NULL OR cardinality(doc_ids) = 0 THEN
+                    RETURN;
+                END IF;
+
+                DELETE FROM document_listing l
+                WHERE l.document_id = ANY(doc_ids)
+                  AND NOT EXISTS (SELECT 1 FROM documents d WHERE d.id = l.document_id);
+
+                INSERT INTO document_listing (
+                    document_id, title, description, filename, file_path, file_size, mime_type,
+                    uploaded_at, updated_at, uploader_id, uploader_name, document_type_id, document_type_name,
+                    plant_ids, department_ids, plant_names, department_names
+                )
+                SELECT d.id, d.title, d.description, d.filename, d.file_path, d.file_size, d.mime_type,
+                       d.uploaded_at, d.updated_at, u.id, u.username, dt.id, dt.name,
+                       d.plant_ids, d.department_ids,
+                       (SELECT STRING_AGG(p.name, ', ' ORDER BY p.name) FROM plants p WHERE p.id = ANY(d.plant_ids)),
+                       (SELECT STRING_AGG(dept.name, ', ' ORDER BY dept.name) FROM departments dept WHERE dept.id = ANY(d.department_ids))
+                FROM documents d
+                JOIN users u ON u.id = d.uploaded_by
+                LEFT JOIN document_types dt ON dt.id = d.document_type_id
+                WHERE d.id = ANY(doc_ids)
+                ON CONFLICT (document_id) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    description = EXCLUDED.description,
+                    filename = EXCLUDED.filename,
+                    file_path = EXCLUDED.file_path,
+                    file_size = EXCLUDED.file_size,
+                    mime_type = EXCLUDED.mime_type,
+                    uploaded_at = EXCLUDED.uploaded_at,
+                    updated_at = EXCLUDED.updated_at,
+                    uploader_id = EXCLUDED.uploader_id,
+                    uploader_name = EXCLUDED.uploader_name,
+                    document_type_id = EXCLUDED.document_type_id,
+                    document_type_name = EXCLUDED.document_type_name,
+                    plant_ids = EXCLUDED.plant_ids,
+                    department_ids = EXCLUDED.department_ids,
+                    plant_names = EXCLUDED.plant_names,
+                    department_names = EXCLUDED.department_names;
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION document_listing_documents_trigger() RETURNS trigger AS $$
+            BEGIN
+                PERFORM refresh_document_listing(ARRAY[NEW.id]);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_document_listing_documents ON documents;
+            CREATE TRIGGER trg_document_listing_documents
+                AFTER INSERT OR UPDATE OF title, description, filename, file_path, file_size, mime_type,
+                                          uploaded_at, updated_at, uploaded_by, document_type_id,
+                                          plant_ids, department_ids ON documents
+                FOR EACH ROW EXECUTE FUNCTION document_listing_documents_trigger();
+
+            -- Renames of referenced rows
+            CREATE OR REPLACE FUNCTION document_listing_names_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_TABLE_NAME = 'users' THEN
+                    UPDATE document_listing SET uploader_name = NEW.username WHERE uploader_id = NEW.id;
+                ELSIF TG_TABLE_NAME = 'document_types' THEN
+                    UPDATE document_listing SET document_type_name = NEW.name WHERE document_type_id = NEW.id;
+                ELSIF TG_TABLE_NAME = 'plants' THEN
+                    PERFORM refresh_document_listing(ARRAY(SELECT document_id FROM document_listing WHERE plant_ids @> ARRAY[NEW.id]));
+                ELSIF TG_TABLE_NAME = 'departments' THEN
+                    PERFORM refresh_document_listing(ARRAY(SELECT document_id FROM document_listing WHERE department_ids @> ARRAY[NEW.id]));
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_document_listing_users ON users;
+            CREATE TRIGGER trg_document_listing_users AFTER UPDATE OF username ON users
+                FOR EACH ROW WHEN (OLD.username IS DISTINCT FROM NEW.username)
+                EXECUTE FUNCTION document_listing_names_trigger();
+            DROP TRIGGER IF EXISTS trg_document_listing_document_types ON document_types;
+            CREATE TRIGGER trg_document_listing_document_types AFTER UPDATE OF name ON document_types
+                FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+                EXECUTE FUNCTION document_listing_names_trigger();
+            DROP TRIGGER IF EXISTS trg_document_listing_plants ON plants;
+            CREATE TRIGGER trg_document_listing_plants AFTER UPDATE OF name ON plants
+                FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+                EXECUTE FUNCTION document_listing_names_trigger();
+            DROP TRIGGER IF EXISTS trg_document_listing_departments ON departments;
+            CREATE TRIGGER trg_document_listing_departments AFTER UPDATE OF name ON departments
+                FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+                EXECUTE FUNCTION document_listing_names_trigger();
+
+            -- Listing sorts and filters are single-table index scans on the projection
+            CREATE INDEX IF NOT EXISTS idx_document_listing_uploaded_at ON document_listing(uploaded_at, document_id);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_title ON document_listing(title, document_id);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_file_size ON document_listing((COALESCE(file_size, 0)), document_id);
+            DROP INDEX IF EXISTS idx_document_listing_type_name;
+            CREATE INDEX IF NOT EXISTS idx_document_listing_type_sort ON document_listing((COALESCE(document_type_name, '')), document_id);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_type_id ON document_listing(document_type_id);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_uploader ON document_listing(uploader_id);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_plant_ids ON document_listing USING GIN (plant_ids);
+            CREATE INDEX IF NOT EXISTS idx_document_listing_department_ids ON document_listing USING GIN (department_ids);
+        ''')
+        cursor.execute('''
+            SELECT refresh_document_listing(ARRAY(
+                SELECT d.id FROM documents d
+                WHERE NOT EXISTS (SELECT 1 FROM document_listing l WHERE l.document_id = d.id)
+            ))
+        ''')
+        # Link triggers now maintain documents.plant_ids/department_ids, which
+        # in turn refresh the projection
+        cursor.execute('''
+            DROP TRIGGER IF EXISTS trg_document_listing_plants_ins ON document_plants;
+            DROP TRIGGER IF EXISTS trg_document_listing_plants_upd ON document_plants;
+            DROP TRIGGER IF EXISTS trg_document_listing_plants_del ON document_plants;
+            DROP TRIGGER IF EXISTS trg_document_listing_departments_ins ON document_departments;
+            DROP TRIGGER IF EXISTS trg_document_listing_departments_upd ON document_departments;
+            DROP TRIGGER IF EXISTS trg_document_listing_departments_del ON document_departments;
+            DROP FUNCTION IF EXISTS document_listing_links_trigger();
+        ''')
+        # Keyset sorts moved to the projection's indexes
+        cursor.execute('''
+            DROP INDEX IF EXISTS idx_documents_uploaded_at_id;
+            DROP INDEX IF EXISTS idx_documents_title_id;
+            DROP INDEX IF EXISTS idx_documents_file_size_id;
+            DROP INDEX IF EXISTS idx_documents_type_id;
+        ''')
+        cursor.execute('''
+            -- Reference-data caches in every app process listen on this channel; the
+            -- payload is the table name, sent once per statement and only on commit
+            CREATE OR REPLACE FUNCTION notify_reference_data() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('reference_data', TG_TABLE_NAME);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_plants_notify ON plants;
+            CREATE TRIGGER trg_plants_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON plants
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data();
+            DROP TRIGGER IF EXISTS trg_departments_notify ON departments;
+            CREATE TRIGGER trg_departments_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON departments
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data();
+            DROP TRIGGER IF EXISTS trg_document_types_notify ON document_types;
+            CREATE TRIGGER trg_document_types_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON document_types
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data();
+        ''')
+        cursor.execute('''
+            -- Strong download ETags: SHA-256 of the stored file
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+        ''')
+        cursor.execute('''
+            -- Content-addressed file store: one row per stored file under UPLOAD_FOLDER/blobs,
+            -- ref_count = number of documents with that content_hash
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_hash CHAR(64) PRIMARY KEY,
+                size BIGINT NOT NULL,
+                ref_count INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash);
+
+            CREATE OR REPLACE FUNCTION blobs_ref_count_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    IF OLD.content_hash IS NOT NULL THEN
+                        UPDATE blobs SET ref_count = ref_count - 1 WHERE content_hash = OLD.content_hash;
+                    END IF;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    IF NEW.content_hash IS NOT NULL THEN
+                        UPDATE blobs SET ref_count = ref_count + 1 WHERE content_hash = NEW.content_hash;
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_documents_blob_refs ON documents;
+            CREATE TRIGGER trg_documents_blob_refs AFTER INSERT OR DELETE OR UPDATE OF content_hash ON documents
+                FOR EACH ROW EXECUTE FUNCTION blobs_ref_count_trigger();
+        ''')
+        cursor.execute('''
+            -- Resumable uploads: received bytes are appended to UPLOAD_FOLDER/blobs/tmp/upload-<id>.part
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                id CHAR(32) PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                filename VARCHAR(255) NOT NULL,
+                total_size BIGINT NOT NULL,
+                received BIGINT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at ON upload_sessions(updated_at);
+        ''')
+        cursor.execute('''
+            -- Background jobs, claimed by workers with FOR UPDATE SKIP LOCKED (see jobs.py)
+            CREATE TABLE IF NOT EXISTS jobs (
+                id BIGSERIAL PRIMARY KEY,
+                kind VARCHAR(64) NOT NULL,
+                payload JSONB NOT NULL DEFAULT '{}',
+                status VARCHAR(16) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'failed')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 5,
+                run_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                locked_until TIMESTAMPTZ,
+                last_error TEXT,
+                dedupe_key VARCHAR(255),
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+
+            -- Only claimable rows are indexed; failed jobs stay out of the dequeue path
+            CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(run_at, id) WHERE status IN ('queued', 'running');
+            -- At most one queued job per (kind, dedupe_key)
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(kind, dedupe_key)
+                WHERE status = 'queued' AND dedupe_key IS NOT NULL;
+        ''')
+        cursor.execute('''
+            -- Automatic format conversions, one file per (content hash, target) under CONVERSION_DIR
+            CREATE TABLE IF NOT EXISTS conversions (
+                content_hash CHAR(64) NOT NULL,
+                target VARCHAR(50) NOT NULL,
+                file_path VARCHAR(500) NOT NULL,
+                file_size BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (content_hash, target)
+            );
+
+            ALTER TABLE document_requests ADD COLUMN IF NOT EXISTS conversion_target VARCHAR(50);
+            ALTER TABLE document_requests ADD COLUMN IF NOT EXISTS fulfilled_at TIMESTAMP;
+            CREATE INDEX IF NOT EXISTS idx_document_requests_pending ON document_requests(document_id) WHERE status = 'pending';
+        ''')
+        cursor.execute('''
+            -- Compression at rest: encoding of the stored file and its size on disk (size stays the original)
+            ALTER TABLE blobs ADD COLUMN IF NOT EXISTS encoding VARCHAR(16) NOT NULL DEFAULT 'identity';
+            ALTER TABLE blobs ADD COLUMN IF NOT EXISTS stored_size BIGINT;
+        ''')
+        cursor.execute('''
+            -- Catch-all partitions for rows outside every monthly partition
+            CREATE TABLE IF NOT EXISTS download_logs_default PARTITION OF download_logs DEFAULT;
+            CREATE TABLE IF NOT EXISTS audit_logs_default PARTITION OF audit_logs DEFAULT;
+        ''')
+        cursor.execute('''
+            -- Daily download rollups folded from download_logs by the rollup_downloads job
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name VARCHAR(50) PRIMARY KEY,
+                last_id BIGINT NOT NULL DEFAULT 0,
+                seen_id BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS download_daily_documents (
+                day DATE NOT NULL,
+                document_id INTEGER NOT NULL,
+                downloads BIGINT NOT NULL,
+                PRIMARY KEY (day, document_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS download_daily_users (
+                day DATE NOT NULL,
+                user_id INTEGER NOT NULL,
+                downloads BIGINT NOT NULL,
+                PRIMARY KEY (day, user_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS download_daily_plants (
+                plant_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                document_id INTEGER NOT NULL,
+                downloads BIGINT NOT NULL,
+                PRIMARY KEY (plant_id, day, document_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS download_daily_departments (
+                department_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                document_id INTEGER NOT NULL,
+                downloads BIGINT NOT NULL,
+                PRIMARY KEY (department_id, day, document_id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_download_daily_documents_document ON download_daily_documents(document_id, day);
+        ''')
+        cursor.execute('''
+            -- Dashboard counters: documents per (plant_ids, department_ids, type) signature.
+            -- Each document has exactly one signature, so totals over any plant/department
+            -- selection are exact sums. Triggers append deltas in the writing transaction
+            -- (no hot counter rows); fold_document_counts() merges them periodically.
+            CREATE TABLE IF NOT EXISTS document_counts (
+                plant_ids INTEGER[] NOT NULL,
+                department_ids INTEGER[] NOT NULL,
+                document_type_id INTEGER NOT NULL,  -- 0 when the document has no type
+                documents BIGINT NOT NULL,
+                PRIMARY KEY (plant_ids, department_ids, document_type_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS document_count_deltas (
+                id BIGSERIAL PRIMARY KEY,
+                plant_ids INTEGER[] NOT NULL,
+                department_ids INTEGER[] NOT NULL,
+                document_type_id INTEGER NOT NULL,
+                delta BIGINT NOT NULL
+            );
+
+            CREATE OR REPLACE FUNCTION document_counts_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO document_count_deltas (plant_ids, department_ids, document_type_id, delta)
+                    SELECT plant_ids, department_ids, COALESCE(document_type_id, 0), COUNT(*)
+                    FROM new_rows GROUP BY 1, 2, 3;
+                ELSIF TG_OP = 'DELETE' THEN
+                    INSERT INTO document_count_deltas (plant_ids, department_ids, document_type_id, delta)
+                    SELECT plant_ids, department_ids, COALESCE(document_type_id, 0), -COUNT(*)
+                    FROM old_rows GROUP BY 1, 2, 3;
+                ELSE
+                    -- Fires for every UPDATE; only signature changes produce deltas
+                    INSERT INTO document_count_deltas (plant_ids, department_ids, document_type_id, delta)
+                    SELECT plant_ids, department_ids, type_id, SUM(n)
+                    FROM (
+                        SELECT plant_ids, department_ids, COALESCE(document_type_id, 0) AS type_id, -1 AS n FROM old_rows
+                        UNION ALL
+                        SELECT plant_ids, department_ids, COALESCE(document_type_id, 0), 1 FROM new_rows
+                    ) x
+                    GROUP BY 1, 2, 3
+                    HAVING SUM(n) <> 0;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_document_counts_ins ON documents;
+            CREATE TRIGGER trg_document_counts_ins AFTER INSERT ON documents
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_counts_trigger();
+            DROP TRIGGER IF EXISTS trg_document_counts_upd ON documents;
+            CREATE TRIGGER trg_document_counts_upd AFTER UPDATE ON documents
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_counts_trigger();
+            DROP TRIGGER IF EXISTS trg_document_counts_del ON documents;
+            CREATE TRIGGER trg_document_counts_del AFTER DELETE ON documents
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION document_counts_trigger();
+
+            -- Merge pending deltas into document_counts; returns the number of deltas merged
+            CREATE OR REPLACE FUNCTION fold_document_counts() RETURNS bigint AS $$
+            DECLARE
+                merged bigint;
+            BEGIN
+                WITH moved AS (
+                    DELETE FROM document_count_deltas RETURNING plant_ids, department_ids, document_type_id, delta
+                ),
+                summed AS (
+                    SELECT plant_ids, department_ids, document_type_id, SUM(delta) AS delta, COUNT(*) AS merged_rows
+                    FROM moved GROUP BY 1, 2, 3
+                ),
+                applied AS (
+                    INSERT INTO document_counts (plant_ids, department_ids, document_type_id, documents)
+                    SELECT plant_ids, department_ids, document_type_id, delta FROM summed WHERE delta <> 0
+                    ON CONFLICT (plant_ids, department_ids, document_type_id)
+                    DO UPDATE SET documents = document_counts.documents + EXCLUDED.documents
+                )
+                SELECT COALESCE(SUM(merged_rows), 0) INTO merged FROM summed;
+                DELETE FROM document_counts WHERE documents = 0;
+                RETURN merged;
+            END
+            $$ LANGUAGE plpgsql;
+
+            -- Append corrections so counters plus pending deltas match the documents table
+            -- as seen by the current snapshot; returns the number of signatures corrected
+            CREATE OR REPLACE FUNCTION reconcile_document_counts() RETURNS bigint AS $$
+                WITH corrected AS (
+                    INSERT INTO document_count_deltas (plant_ids, department_ids, document_type_id, delta)
+                    SELECT plant_ids, department_ids, type_id, SUM(n)
+                    FROM (
+                        SELECT plant_ids, department_ids, COALESCE(document_type_id, 0) AS type_id, COUNT(*) AS n
+                        FROM documents GROUP BY 1, 2, 3
+                        UNION ALL
+                        SELECT plant_ids, department_ids, document_type_id, -documents FROM document_counts
+                        UNION ALL
+                        SELECT plant_ids, department_ids, document_type_id, -delta FROM document_count_deltas
+                    ) x
+                    GROUP BY 1, 2, 3
+                    HAVING SUM(n) <> 0
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM corrected
+            $$ LANGUAGE sql;
+        ''')
+        cursor.execute('SELECT reconcile_document_counts()')
+        cursor.execute('SELECT fold_document_counts()')
+        cursor.execute('''
+            -- Audit viewer: one (filter column, timestamp, id) index per filter so each
+            -- stream is read in keyset order straight from an index
+            DROP INDEX IF EXISTS idx_audit_logs_timestamp;
+            DROP INDEX IF EXISTS idx_download_logs_document;
+            DROP INDEX IF EXISTS idx_download_logs_user;
+            DROP INDEX IF EXISTS idx_download_logs_date;
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_time ON audit_logs(timestamp, id);
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_user_time ON audit_logs(user_id, timestamp, id);
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_action_time ON audit_logs(action, timestamp, id);
+            CREATE INDEX IF NOT EXISTS idx_download_logs_time ON download_logs(downloaded_at, id);
+            CREATE INDEX IF NOT EXISTS idx_download_logs_user_time ON download_logs(user_id, downloaded_at, id);
+            CREATE INDEX IF NOT EXISTS idx_download_logs_document_time ON download_logs(document_id, downloaded_at, id);
+        ''')
+        partitions.migrate_legacy(cursor)
+        this_month = partitions.month_start(datetime.now())
+        for table in partitions.PARTITIONED_TABLES:
+            partitions.ensure_partitions(cursor, table, this_month,
+                                         partitions.add_months(this_month, config.LOG_PARTITIONS_AHEAD))
         
         conn.commit()
         print("Database tables created successfully")
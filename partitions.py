@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Monthly partitions for the log tables
+
+    python -m partitions                 # create upcoming, expire old partitions
+    python -m partitions --dry-run       # only report what would change
+
+download_logs and audit_logs are range-partitioned by month on their
+timestamp column, with a DEFAULT partition catching rows outside every
+monthly one. Job workers run the same maintenance daily.
+"""
+
+import os
+import gzip
+import logging
+import argparse
+from datetime import date, datetime
+
+import config
+import jobs
+
+logger = logging.getLogger(__name__)
+
+# Partitioned table -> partition key column
+PARTITIONED_TABLES = {
+    'download_logs': 'downloaded_at',
+    'audit_logs': 'timestamp',
+}
+RETENTION_ACTIONS = ('detach', 'archive', 'drop')
+MAINTENANCE_INTERVAL = 86400
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_y{month.year:04d}m{month.month:02d}'
+
+
+def _exists(cursor, name):
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL AS present', (name,))
+    return cursor.fetchone()['present']
+
+
+def _relkind(cursor, name):
+    cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (name,))
+    row = cursor.fetchone()
+    return row['relkind'] if row else None
+
+
+def detach_legacy(cursor):
+    """Rename unpartitioned log tables out of the way before init_db creates
+    the partitioned ones; ``migrate_legacy()`` copies their rows afterwards.
+
+    The table's indexes and id sequence are renamed too, so the new table
+    can reuse their names.
+    """
+    for table in PARTITIONED_TABLES:
+        if _relkind(cursor, table) != 'r':
+            continue
+        legacy = f'{table}_legacy'
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+        cursor.execute('SELECT indexrelid::regclass::text AS name FROM pg_index WHERE indrelid = %s::regclass', (legacy,))
+        for index in cursor.fetchall():
+            cursor.execute(f"ALTER INDEX {index['name']} RENAME TO {index['name']}_legacy")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id') AS seq", (legacy,))
+        sequence = cursor.fetchone()['seq']
+        if sequence:
+            cursor.execute(f'ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq')
+        logger.info(f'Renamed unpartitioned {table} to {legacy} for migration')
+
+
+def migrate_legacy(cursor):
+    """Copy rows from ``<table>_legacy`` into the partitioned table and drop it"""
+    for table, column in PARTITIONED_TABLES.items():
+        legacy = f'{table}_legacy'
+        if not _exists(cursor, legacy):
+            continue
+        cursor.execute(f'SELECT MIN({column}) AS first, MAX(id) AS last_id FROM {legacy}')
+        bounds = cursor.fetchone()
+        if bounds['first'] is not None:
+            ensure_partitions(cursor, table, month_start(bounds['first']), month_start(datetime.now()))
+        cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position', (table,))
+        columns = [row['column_name'] for row in cursor.fetchall()]
+        select = ', '.join(f"COALESCE({c}, 'epoch'::timestamp)" if c == column else c for c in columns)
+        cursor.execute(f'INSERT INTO {table} ({", ".join(columns)}) SELECT {select} FROM {legacy}')
+        moved = cursor.rowcount
+        if bounds['last_id'] is not None:
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", (table, bounds['last_id']))
+        cursor.execute(f'DROP TABLE {legacy}')
+        logger.info(f'Migrated {moved} rows from {legacy} into partitioned {table}')
+
+
+def create_partition(cursor, table, month, dry_run=False):
+    """Create and attach the partition for ``month``; returns False if it exists.
+
+    Rows for that month already sitting in the DEFAULT partition are moved
+    into the new partition first, otherwise attaching it would fail. With
+    ``dry_run`` nothing is created.
+    """
+    name = partition_name(table, month)
+    if _exists(cursor, name):
+        return False
+    if dry_run:
+        return True
+    column = PARTITIONED_TABLES[table]
+    start, end = month, add_months(month, 1)
+    cursor.execute(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    default = f'{table}_default'
+    if _exists(cursor, default):
+        cursor.execute(f'''
+            WITH moved AS (
+                DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        ''', (start, end))
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    return True
+
+
+def ensure_partitions(cursor, table, first_month, last_month, dry_run=False):
+    created = []
+    month = first_month
+    while month <= last_month:
+        if create_partition(cursor, table, month, dry_run):
+            created.append(partition_name(table, month))
+        month = add_months(month, 1)
+    return created
+
+
+def monthly_partitions(cursor, table):
+    """``(name, month)`` of the monthly partitions attached to ``table``, oldest first"""
+    cursor.execute('''
+        SELECT c.relname AS name FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    ''', (table,))
+    partitions = []
+    prefix = f'{table}_y'
+    for row in cursor.fetchall():
+        name = row['name']
+        if not name.startswith(prefix):
+            continue
+        try:
+            month = date(int(name[len(prefix):len(prefix) + 4]), int(name[-2:]), 1)
+        except ValueError:
+            continue
+        partitions.append((name, month))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def expire_partitions(cursor, table, retention_months, action='detach', archive_dir=None, today=None,
+                      dry_run=False):
+    """Detach, archive or drop monthly partitions older than the retention.
+
+    The current month plus ``retention_months`` full months before it are
+    kept. ``detach`` leaves the partition as a standalone table; ``archive``
+    writes it to ``archive_dir/<partition>.csv.gz`` first and drops it;
+    ``drop`` removes it outright. With ``dry_run`` the expired partitions
+    are only listed: no archive is written and nothing is detached, since
+    DETACH locks the whole log table until the transaction ends.
+    """
+    if not retention_months:
+        return []
+    cutoff = add_months(month_start(today or datetime.now()), -retention_months)
+    expired = []
+    for name, month in monthly_partitions(cursor, table):
+        if month >= cutoff:
+            break
+        if dry_run:
+            expired.append(name)
+            continue
+        if action == 'archive':
+            os.makedirs(archive_dir, exist_ok=True)
+            path = os.path.join(archive_dir, f'{name}.csv.gz')
+            with gzip.open(path, 'wb') as f:
+                cursor.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', f)
+        cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+        if action in ('archive', 'drop'):
+            cursor.execute(f'DROP TABLE {name}')
+        expired.append(name)
+    return expired
+
+
+def maintain(conn, months_ahead=None, retention_months=None, action=None, archive_dir=None, dry_run=False):
+    """Create upcoming partitions and expire old ones for every log table"""
+    months_ahead = config.LOG_PARTITIONS_AHEAD if months_ahead is None else months_ahead
+    retention_months = config.LOG_RETENTION_MONTHS if retention_months is None else retention_months
+    action = action or config.LOG_RETENTION_ACTION
+    archive_dir = archive_dir or config.LOG_ARCHIVE_DIR
+    if action not in RETENTION_ACTIONS:
+        raise ValueError(f'Retention action must be one of: {", ".join(RETENTION_ACTIONS)}')
+
+    report = {}
+    cursor = conn.cursor()
+    try:
+        this_month = month_start(datetime.now())
+        for table in PARTITIONED_TABLES:
+            # Serialise with other maintainers (several job workers, cron)
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f'partitions:{table}',))
+            created = ensure_partitions(cursor, table, this_month, add_months(this_month, months_ahead), dry_run)
+            expired = expire_partitions(cursor, table, retention_months, action, archive_dir, dry_run=dry_run)
+            report[table] = {'created': created, 'expired': expired}
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return report
+
+
+@jobs.handler('maintain_partitions')
+def run_maintain_partitions(conn, payload):
+    for table, changes in maintain(conn).items():
+        if changes['created'] or changes['expired']:
+            logger.info(f"Partitions of {table}: created {changes['created']}, expired {changes['expired']}")
+
+
+jobs.every(MAINTENANCE_INTERVAL, 'maintain_partitions')
+
+
+def main(argv=None):
+    import models
+
+    parser = argparse.ArgumentParser(description='Create and expire monthly log partitions')
+    parser.add_argument('--months-ahead', type=int, default=None,
+                        help='months of partitions to pre-create (default: LOG_PARTITIONS_AHEAD)')
+    parser.add_argument('--retention-months', type=int, default=None,
+                        help='full months kept before the current one; 0 keeps everything (default: LOG_RETENTION_MONTHS)')
+    parser.add_argument('--action', choices=RETENTION_ACTIONS, default=None,
+                        help='what to do with expired partitions (default: LOG_RETENTION_ACTION)')
+    parser.add_argument('--archive-dir', default=None, help='where archive writes CSV files (default: LOG_ARCHIVE_DIR)')
+    parser.add_argument('--dry-run', action='store_true', help='only list the partitions that would be created or expired')
+    args = parser.parse_args(argv)
+
+    with models.pooled_connection() as conn:
+        report = maintain(conn, args.months_ahead, args.retention_months, args.action, args.archive_dir, args.dry_run)
+    for table, changes in report.items():
+        print(f"{table}: created {len(changes['created'])} {changes['created']}, "
+              f"expired {len(changes['expired'])} {changes['expired']}")
+    if args.dry_run:
+        print('Dry run: nothing was changed')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,151 @@
+import select
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from flask import has_app_context
+
+import models
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# Channel notified by the notify_reference_data() triggers on commit; the
+# payload is the name of the table that changed
+CHANNEL = 'reference_data'
+
+QUERIES = {
+    'plants': 'SELECT id, name FROM plants ORDER BY name',
+    'departments': 'SELECT id, name FROM departments ORDER BY name',
+    'document_types': 'SELECT id, name FROM document_types ORDER BY name',
+}
+
+
+class ReferenceCache:
+    """In-process cache of the small, almost-static lookup tables.
+
+    Rows are kept until a NOTIFY on ``CHANNEL`` says the table changed, so
+    every worker process drops its copy as soon as any process (or psql)
+    commits a change. Each table has a version number that is bumped on
+    invalidation; a load only populates the cache if no invalidation happened
+    while it ran, so a concurrent change can never be overwritten by stale
+    rows. Entries are only cached while the LISTEN connection is up, because
+    without it this process would not hear about changes made elsewhere.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        self._versions = {name: 0 for name in QUERIES}
+        self._listening = False
+        self._listener = None
+        self._stop = threading.Event()
+
+    def get(self, name, cursor=None):
+        """Return the rows of ``name`` as a list of ``{'id', 'name'}`` dicts"""
+        with self._lock:
+            rows = self._data.get(name)
+            version = self._versions[name]
+        if rows is not None:
+            return rows
+
+        if cursor is not None:
+            rows = self._load(cursor, name)
+        elif has_app_context():
+            # Reuse the request's pooled connection
+            load_cursor = models.get_db_connection().cursor()
+            rows = self._load(load_cursor, name)
+            load_cursor.close()
+        else:
+            with models.pooled_connection() as conn:
+                load_cursor = conn.cursor()
+                rows = self._load(load_cursor, name)
+                load_cursor.close()
+                conn.rollback()
+
+        with self._lock:
+            if self._listening and self._versions[name] == version:
+                self._data[name] = rows
+        return rows
+
+    @staticmethod
+    def _load(cursor, name):
+        cursor.execute(QUERIES[name])
+        return [dict(row) for row in cursor.fetchall()]
+
+    def name_of(self, name, item_id, cursor=None):
+        """Look up the display name of one row, or None if it does not exist"""
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            return None
+        for row in self.get(name, cursor):
+            if row['id'] == item_id:
+                return row['name']
+        return None
+
+    def invalidate(self, *names):
+        names = names or tuple(QUERIES)
+        with self._lock:
+            for name in names:
+                if name in self._versions:
+                    self._versions[name] += 1
+                    self._data.pop(name, None)
+
+    def start_listener(self, dsn=DATABASE_URL):
+        if self._listener is None or not self._listener.is_alive():
+            self._stop.clear()
+            self._listener = threading.Thread(target=self._listen, args=(dsn,), name='refcache-listener', daemon=True)
+            self._listener.start()
+
+    def stop_listener(self):
+        self._stop.set()
+
+    def _set_listening(self, listening):
+        with self._lock:
+            self._listening = listening
+        # Anything cached before (re)connecting may have missed notifications
+        self.invalidate()
+
+    def _listen(self, dsn):
+        backoff = 1
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f'LISTEN {CHANNEL}')
+                self._set_listening(True)
+                backoff = 1
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        # Idle: make sure the connection is still alive
+                        cursor.execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    changed = set()
+                    while conn.notifies:
+                        changed.add(conn.notifies.pop(0).payload)
+                    if changed:
+                        self.invalidate(*changed)
+            except Exception as e:
+                logger.warning(f'Reference cache listener disconnected: {e}')
+            finally:
+                self._set_listening(False)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+reference_cache = ReferenceCache()
+
+
+def init_app(app):
+    if app.config.get('REFERENCE_CACHE_ENABLED', True):
+        reference_cache.start_listener()
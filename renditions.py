@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+from PIL import Image, ImageOps
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Rendition name -> bounding box in pixels
+SIZES = {
+    'thumb': (256, 256),
+    'preview': (1024, 1024),
+}
+IMAGE_MIMETYPES = {'image/jpeg', 'image/png'}
+PDF_MIMETYPE = 'application/pdf'
+JPEG_QUALITY = 82
+# A hit only refreshes the file's mtime (its LRU position) once this stale,
+# so cache hits don't turn into a metadata write each
+TOUCH_INTERVAL = 3600
+PDFTOPPM_TIMEOUT = 30
+
+
+def supports(mime_type):
+    return mime_type in IMAGE_MIMETYPES or mime_type == PDF_MIMETYPE
+
+
+def flatten(image):
+    """RGB copy of ``image`` with any transparency composited onto white"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _render_image(path, box):
+    with storage.open_stored(path) as f, Image.open(f) as image:
+        # JPEG decoders can downscale by 1/2..1/8 while decoding: much less
+        # work and memory for large scans
+        image.draft('RGB', (box[0] * 2, box[1] * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(box, Image.LANCZOS)
+        return flatten(image)
+
+
+def _render_pdf_pdftoppm(path, box):
+    pdftoppm = shutil.which('pdftoppm')
+    if not pdftoppm:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'page')
+        subprocess.run([pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-png',
+                        '-scale-to', str(max(box)), path, prefix],
+                       check=True, timeout=PDFTOPPM_TIMEOUT, capture_output=True)
+        return _render_image(prefix + '.png', box)
+
+
+def _render_pdf_embedded(path, box):
+    """Largest image embedded in the first page; scanned PDFs are one image per page"""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    if not reader.pages:
+        return None
+    images = [embedded.image for embedded in reader.pages[0].images if embedded.image is not None]
+    if not images:
+        return None
+    image = max(images, key=lambda img: img.width * img.height)
+    image.thumbnail(box, Image.LANCZOS)
+    return flatten(image)
+
+
+def _render_pdf(path, box):
+    with storage.stored_as_file(path) as local_path:
+        # pdftoppm (poppler) renders the real page when it is installed
+        try:
+            image = _render_pdf_pdftoppm(local_path, box)
+            if image is not None:
+                return image
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.warning(f'pdftoppm failed for {path}: {e}')
+        try:
+            return _render_pdf_embedded(local_path, box)
+        except ImportError:
+            return None
+
+
+def render(path, mime_type, size):
+    """Render a rendition of the file as a PIL image, or None if not possible"""
+    box = SIZES[size]
+    if mime_type in IMAGE_MIMETYPES:
+        return _render_image(path, box)
+    if mime_type == PDF_MIMETYPE:
+        return _render_pdf(path, box)
+    return None
+
+
+class RenditionCache:
+    """Thumbnails and previews on disk, keyed by content hash and size.
+
+    Files live at ``root/ab/<hash>-<size>.jpg``, so documents sharing content
+    share renditions and a path never needs invalidating. Renditions are
+    rendered on first request; concurrent requests for the same one in this
+    process wait for a single render. Once the directory grows past
+    ``max_bytes`` the least recently used files (by mtime) are evicted.
+    """
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rendering = {}
+        self._approx_bytes = None
+
+    def path_for(self, content_hash, size):
+        return os.path.join(self.root, content_hash[:2], f'{content_hash}-{size}.jpg')
+
+    def get(self, source_path, content_hash, mime_type, size):
+        """Path of the cached rendition, rendering it if needed; None if unsupported"""
+        path = self.path_for(content_hash, size)
+        if self._touch(path):
+            return path
+
+        with self._lock:
+            key_lock = self._rendering.setdefault(path, threading.Lock())
+        with key_lock:
+            try:
+                if os.path.exists(path):
+                    return path
+                image = render(source_path, mime_type, size)
+                if image is None:
+                    return None
+                written = self._write(image, path)
+            finally:
+                with self._lock:
+                    self._rendering.pop(path, None)
+        self._account(written)
+        return path
+
+    def _touch(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        if now - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return True
+
+    def _write(self, image, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            image.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return os.path.getsize(path)
+
+    def _account(self, written):
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan_size()
+            else:
+                self._approx_bytes += written
+            over = self._approx_bytes > self.max_bytes
+        if over:
+            self.trim()
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def trim(self, target_ratio=0.9):
+        """Evict least recently used renditions down to ``target_ratio`` of the cap"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * target_ratio
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._approx_bytes = total
+        if removed:
+            logger.info(f'Evicted {removed} renditions, cache now {total} bytes')
+        return removed
+
+
+cache = None
+
+
+def init_app(app):
+    global cache
+    cache = RenditionCache(
+        app.config.get('RENDITION_DIR') or os.path.join(app.config['UPLOAD_FOLDER'], 'renditions'),
+        max_bytes=app.config.get('RENDITION_CACHE_MAX_SIZE', 512 * 1024 * 1024),
+    )
+    app.jinja_env.globals['has_thumbnail'] = supports
@@ -1,7 +1,7 @@
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from datetime import date, datetime
 from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, flash, send_file, abort, current_app
 from werkzeug.security import check_password_hash
 from werkzeug.security import generate_password_hash
@@ -13,34 +13,46 @@ import secrets
 
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
 
-from models import get_db_connection
+from models import get_db_connection, pooled_connection, sync_links, add_links
+from listing import fetch_document_page, shape_document, build_filters, InvalidCursor, COUNT_MODES, LISTING_COLUMNS
+from search import SEARCH_MODES
+import extraction
+import audit_writer
+import storage
+import uploads
+import bulk
+import renditions
+import conversions
+import bundle
+import download_stats
+import document_counts
+import auditlog
+from refcache import reference_cache
 
 from extensions import csrf
 from extensions import limiter # Import limiter from extensions.py
 from flask import current_app
 
-import magic # Import the python-magic library
-
 main = Blueprint('main', __name__)
 
-def allowed_file(filename, file_stream):
-    # 1. Check extension whitelist
+# Container formats libmagic reports for several document types; the stored
+# type is then refined from the (already validated) extension
+GENERIC_MIMETYPES = {'application/zip', 'application/octet-stream'}
+
+def allowed_extension(filename):
     if '.' not in filename:
         return False
-    ext = filename.rsplit('.', 1)[1].lower()
-    if ext not in current_app.config['ALLOWED_EXTENSIONS']:
-        return False
+    return filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-    # 2. Perform magic byte sniffing
-    # Read a chunk of the file to determine its MIME type
-    file_stream.seek(0) # Ensure we read from the beginning
-    buffer = file_stream.read(1024) # Read first 1024 bytes
-    file_stream.seek(0) # Reset stream position for subsequent reads
+def allowed_file(filename, detected_mime):
+    # 1. Check extension whitelist
+    if not allowed_extension(filename):
+        return False
+    ext = filename.rsplit('.', 1)[1].lower()
 
-    try:
-        detected_mime = magic.from_buffer(buffer, mime=True)
-    except Exception as e:
-        current_app.logger.error(f"Magic detection failed for {filename}: {e}")
+    # 2. detected_mime was sniffed from the leading bytes while the upload was
+    # being spooled (storage.SpooledUpload)
+    if detected_mime is None:
         return False # If magic detection fails, deny the file
 
     # 3. Compare detected MIME type with allowed MIME types for the extension
@@ -57,6 +69,23 @@ def allowed_file(filename, file_stream):
 
     return True
 
+def stored_mimetype(filename, detected_mime):
+    """MIME type persisted for an accepted upload: the sniffed one, unless it is a bare container"""
+    if detected_mime in GENERIC_MIMETYPES:
+        ext = filename.rsplit('.', 1)[1].lower()
+        return current_app.config['ALLOWED_MIMETYPES'][ext][0]
+    return detected_mime
+
+def visibility_filter(alias='d'):
+    """SQL clause limiting documents to the session user's plants and departments.
+
+    Returns ``(None, [])`` for admins, who can see every document.
+    """
+    if session.get('role') == 'admin':
+        return None, []
+    clause = f'{alias}.plant_ids && %s::int[] AND {alias}.department_ids && %s::int[]'
+    return clause, [session.get('plant_ids', []), session.get('department_ids', [])]
+
 # Authentication decorators
 def login_required(f):
     from functools import wraps
@@ -159,139 +188,52 @@ def dashboard():
     plant_ids = session.get('plant_ids', [])
     department_ids = session.get('department_ids', [])
 
+    # Read from the signature counters rather than aggregating the catalog
     if session['role'] == 'admin':
-        cursor.execute('SELECT COUNT(*) as count FROM documents')
+        document_count = document_counts.total(cursor)
+        documents_per_department = document_counts.per_department(cursor)
     else:
         if not plant_ids or not department_ids:
             flash('User session missing plant or department information.')
             return redirect(url_for('main.login'))
-        cursor.execute('''
-            SELECT COUNT(DISTINCT d.id) AS count
-            FROM documents d
-            JOIN document_plants dp ON d.id = dp.document_id
-            JOIN document_departments dd ON d.id = dd.document_id
-            WHERE dp.plant_id = ANY(%s) AND dd.department_id = ANY(%s)
-        ''', (plant_ids, department_ids))
-    document_count = cursor.fetchone()['count']
-    
-    documents_per_department = []
-    if user['role'] == 'admin':
-        cursor.execute('''
-            SELECT d.name, COUNT(doc.id) AS document_count
-            FROM departments d
-            LEFT JOIN document_departments dd ON d.id = dd.department_id
-            LEFT JOIN documents doc ON dd.document_id = doc.id
-            GROUP BY d.name
-            ORDER BY d.name
-        ''')
-        documents_per_department = cursor.fetchall()
-    else:
+        document_count = document_counts.total(cursor, plant_ids, department_ids)
         # For non-admin, show only their department's documents
-        cursor.execute('''
-            SELECT d.name, COUNT(doc.id) AS document_count
-            FROM departments d
-            LEFT JOIN document_departments dd ON d.id = dd.department_id
-            LEFT JOIN documents doc ON dd.document_id = doc.id
-            LEFT JOIN document_plants dp ON doc.id = dp.document_id
-            WHERE d.id = ANY(%s) AND dp.plant_id = ANY(%s)
-            GROUP BY d.name
-        ''', (department_ids, plant_ids))
-        documents_per_department = cursor.fetchall()
+        documents_per_department = document_counts.per_department(cursor, plant_ids, department_ids)
 
     cursor.close()
     conn.close()
     return render_template('dashboard.html', user=user, document_count=document_count, documents_per_department=documents_per_department)
 
+def _parse_per_page(default, maximum=100):
+    try:
+        per_page = int(request.args.get('per_page', default))
+    except ValueError:
+        per_page = default
+    return max(min(per_page, maximum), 1)
+
 @main.route('/documents')
 def documents():
     conn = get_db_connection()
     cursor = conn.cursor()
 
     # Preload lists for filters (always load all for public access)
-    cursor.execute('SELECT id, name FROM plants ORDER BY name')
-    plants = cursor.fetchall()
-    cursor.execute('SELECT id, name FROM departments ORDER BY name')
-    departments = cursor.fetchall()
-
-    # Sorting params (whitelisted)
-    sort = request.args.get('sort', 'uploaded_at')
-    order = request.args.get('order', 'desc').lower()
-    sort_map = {
-        'title': 'd.title',
-        'uploaded_at': 'd.uploaded_at',
-        'size': 'd.file_size',
-        'type': 'dt.name',
-    }
-    sort_col = sort_map.get(sort, 'd.uploaded_at')
-    order_dir = 'DESC' if order != 'asc' else 'ASC'
-
-    base_query = '''
-        SELECT d.id, d.title, d.description, d.filename, d.file_size, d.mime_type,
-               d.uploaded_at, d.updated_at,
-               u.id AS uploader_id, u.username AS uploader_name,
-               dt.id AS document_type_id, dt.name AS document_type_name,
-               STRING_AGG(DISTINCT p.name, ', ') AS plant_names,
-               STRING_AGG(DISTINCT dept.name, ', ') AS department_names
-        FROM documents d
-        JOIN users u ON d.uploaded_by = u.id
-        JOIN document_types dt ON d.document_type_id = dt.id
-        LEFT JOIN document_plants dp ON d.id = dp.document_id
-        LEFT JOIN plants p ON dp.plant_id = p.id
-        LEFT JOIN document_departments dd ON d.id = dd.document_id
-        LEFT JOIN departments dept ON dd.department_id = dept.id
-    '''
-    where_clauses = []
-    params = []
-
-    # Filters (now apply to everyone, no admin check needed)
-    plant_filter = request.args.get('plant_id')
-    dept_filter = request.args.get('department_id')
-    if plant_filter:
-        where_clauses.append('d.id IN (SELECT document_id FROM document_plants WHERE plant_id = %s)')
-        params.append(plant_filter)
-    if dept_filter:
-        where_clauses.append('d.id IN (SELECT document_id FROM document_departments WHERE department_id = %s)')
-        params.append(dept_filter)
-
-    # Search filter
-    search = request.args.get('search')
-    if search:
-        where_clauses.append('d.title ILIKE %s')
-        params.append(f'%{search}%')
-
-    query = base_query
-    if where_clauses:
-        query += ' WHERE ' + ' AND '.join(where_clauses)
-    query += ' GROUP BY d.id, u.id, dt.id'
-    query += f' ORDER BY {sort_col} {order_dir}, d.id DESC'
-
-    # Execute query
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-
-    # Shape data for template
-    shaped_documents = []
-    for row in rows:
-        shaped_documents.append({
-            'id': row['id'],
-            'title': row['title'],
-            'description': row['description'],
-            'filename': row['filename'],
-            'file_size': row['file_size'],
-            'mime_type': row['mime_type'],
-            'uploaded_at': row['uploaded_at'],
-            'updated_at': row['updated_at'],
-            'uploader': {
-                'id': row['uploader_id'],
-                'username': row['uploader_name'],
-            },
-            'document_type': {
-                'id': row['document_type_id'],
-                'name': row['document_type_name'],
-            },
-            'plants': row['plant_names'],
-            'departments': row['department_names'],
-        })
+    plants = reference_cache.get('plants', cursor)
+    departments = reference_cache.get('departments', cursor)
+
+    per_page = _parse_per_page(25)
+    max_ranked = current_app.config['SEARCH_MAX_RANKED']
+    try:
+        result = fetch_document_page(cursor, request.args, per_page,
+                                     cursor_token=request.args.get('cursor') or None,
+                                     count_mode='none', max_ranked=max_ranked)
+    except InvalidCursor:
+        # Stale or tampered cursor: start over from the first page
+        result = fetch_document_page(cursor, request.args, per_page, count_mode='none', max_ranked=max_ranked)
+
+    shaped_documents = [shape_document(row) for row in result['rows']]
+
+    # Query-string args to carry over into the pager links
+    page_args = {k: v for k, v in request.args.items() if k != 'cursor'}
 
     cursor.close()
     conn.close()
@@ -300,98 +242,131 @@ def documents():
         documents=shaped_documents,
         user={'role': session.get('role', 'guest')},
         plants=plants,
-        departments=departments
+        departments=departments,
+        next_cursor=result['next_cursor'],
+        prev_cursor=result['prev_cursor'],
+        page_args=page_args
     )
 
 @main.route('/api/documents')
 def api_documents():
+    """Paginated document listing.
+
+    Pass ``cursor`` (empty for the first page, then the returned
+    ``next_cursor``/``prev_cursor``) for keyset pagination; ``page`` keeps the
+    legacy OFFSET behaviour. ``count`` is ``exact``, ``estimate`` or ``none``
+    and defaults to ``exact`` for page mode and ``none`` for cursor mode.
+    ``search`` runs a ranked full-text search over titles, descriptions and
+    extracted file text; ``search_mode=title`` restores the plain title match.
+    """
+    search_mode = request.args.get('search_mode', 'fulltext')
+    if search_mode not in SEARCH_MODES:
+        return jsonify({'error': f'search_mode must be one of: {", ".join(SEARCH_MODES)}'}), 400
+
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    cursor_mode = 'cursor' in request.args
     try:
         page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 10))
     except ValueError:
         page = 1
-        per_page = 10
     page = max(page, 1)
-    per_page = max(min(per_page, 100), 1)
-
-    base_query = '''
-        SELECT d.id, d.title, d.description, d.filename, d.file_size, d.mime_type,
-               d.uploaded_at, d.updated_at,
-               u.id AS uploader_id, u.username AS uploader_name,
-               dt.id AS document_type_id, dt.name AS document_type_name,
-               STRING_AGG(DISTINCT p.name, ', ') AS plant_names,
-               STRING_AGG(DISTINCT dept.name, ', ') AS department_names
-        FROM documents d
-        JOIN users u ON d.uploaded_by = u.id
-        JOIN document_types dt ON d.document_type_id = dt.id
-        LEFT JOIN document_plants dp ON d.id = dp.document_id
-        LEFT JOIN plants p ON dp.plant_id = p.id
-        LEFT JOIN document_departments dd ON d.id = dd.document_id
-        LEFT JOIN departments dept ON dd.department_id = dept.id
-    '''
-    where_clauses = []
-    params = []
-
-    # Filters (now apply to everyone, no admin check needed)
-    plant_filter = request.args.get('plant_id')
-    dept_filter = request.args.get('department_id')
-    if plant_filter:
-        where_clauses.append('d.id IN (SELECT document_id FROM document_plants WHERE plant_id = %s)')
-        params.append(plant_filter)
-    if dept_filter:
-        where_clauses.append('d.id IN (SELECT document_id FROM document_departments WHERE department_id = %s)')
-        params.append(dept_filter)
-
-    search = request.args.get('search')
-    if search:
-        where_clauses.append('d.title ILIKE %s')
-        params.append(f'%{search}%')
-
-    count_query = 'SELECT COUNT(DISTINCT d.id) AS count FROM documents d'
-    if where_clauses:
-        count_query += ' LEFT JOIN document_plants dp ON d.id = dp.document_id LEFT JOIN document_departments dd ON d.id = dd.document_id WHERE ' + ' AND '.join(where_clauses)
-
-    query = base_query
-    if where_clauses:
-        query += ' WHERE ' + ' AND '.join(where_clauses)
-    query += ' GROUP BY d.id, u.id, dt.id'
-    query += ' ORDER BY d.uploaded_at DESC LIMIT %s OFFSET %s'
-
-    cursor.execute(count_query, params)
-    total_count = cursor.fetchone()['count']
-
-    paginated_params = params + [per_page, (page - 1) * per_page]
-    cursor.execute(query, paginated_params)
-    rows = cursor.fetchall()
+    per_page = _parse_per_page(10)
 
-    documents = []
-    for row in rows:
-        documents.append({
-            'id': row['id'],
-            'title': row['title'],
-            'description': row['description'],
-            'filename': row['filename'],
-            'file_size': row['file_size'],
-            'mime_type': row['mime_type'],
-            'uploaded_at': row['uploaded_at'].isoformat() if row['uploaded_at'] else None,
-            'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None,
-            'uploader': {'id': row['uploader_id'], 'username': row['uploader_name']},
-            'document_type': {'id': row['document_type_id'], 'name': row['document_type_name']},
-            'plants': row['plant_names'],
-            'departments': row['department_names'],
-        })
+    count_mode = request.args.get('count', 'none' if cursor_mode else 'exact')
+    if count_mode not in COUNT_MODES:
+        return jsonify({'error': f'count must be one of: {", ".join(COUNT_MODES)}'}), 400
 
-    total_pages = (total_count + per_page - 1) // per_page
-    return jsonify({
+    try:
+        result = fetch_document_page(
+            cursor, request.args, per_page,
+            page=None if cursor_mode else page,
+            cursor_token=request.args.get('cursor') or None,
+            count_mode=count_mode,
+            max_ranked=current_app.config['SEARCH_MAX_RANKED'],
+        )
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+
+    documents = []
+    for row in result['rows']:
+        document = shape_document(row)
+        document['uploaded_at'] = row['uploaded_at'].isoformat() if row['uploaded_at'] else None
+        document['updated_at'] = row['updated_at'].isoformat() if row['updated_at'] else None
+        documents.append(document)
+
+    total_count = result['total_count']
+    response = {
         'data': documents,
-        'page': page,
         'per_page': per_page,
+        'sort': result['sort'],
+        'order': result['order'],
+        'next_cursor': result['next_cursor'],
+        'prev_cursor': result['prev_cursor'],
         'total_count': total_count,
-        'total_pages': total_pages,
-    })
+        'count_mode': count_mode,
+    }
+    if not cursor_mode:
+        response['page'] = page
+        response['total_pages'] = (total_count + per_page - 1) // per_page if total_count is not None else None
+    return jsonify(response)
+
+@main.route('/api/documents/suggest')
+@login_required
+def api_documents_suggest():
+    """Typo-tolerant title autocomplete backed by the pg_trgm GiST index"""
+    q = (request.args.get('q') or '').strip()
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        limit = 10
+    limit = max(min(limit, 50), 1)
+    if len(q) < 2:
+        return jsonify({'data': []})
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # word_similarity compares the query with the best-matching part of the
+    # title, so a short fragment of a long drawing name still scores well.
+    cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                   (str(current_app.config['SUGGEST_SIMILARITY_THRESHOLD']),))
+    query = '''
+        SELECT d.id, d.title, word_similarity(%s, d.title) AS score
+        FROM documents d
+        WHERE %s <%% d.title
+    '''
+    params = [q, q]
+    clause, clause_params = visibility_filter('d')
+    if clause:
+        query += ' AND ' + clause
+        params.extend(clause_params)
+    query += ' ORDER BY %s <<-> d.title, d.id LIMIT %s'
+    params.extend([q, limit])
+    cursor.execute(query, params)
+    suggestions = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return jsonify({'data': suggestions})
+
+@main.route('/api/users/suggest')
+@admin_required
+def api_users_suggest():
+    """Username prefix autocomplete for the audit log filters"""
+    q = (request.args.get('q') or '').strip()
+    limit = max(min(request.args.get('limit', 10, type=int), 50), 1)
+    if not q:
+        return jsonify({'data': []})
+    pattern = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, username FROM users WHERE username ILIKE %s ORDER BY username LIMIT %s',
+                   (pattern, limit))
+    suggestions = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return jsonify({'data': suggestions})
 
 @main.route('/documents/<int:document_id>/update', methods=['POST'])
 @admin_required
@@ -428,13 +403,8 @@ def update_document(document_id):
             conn.rollback()
             return jsonify({'error': 'Document not found'}), 404
 
-        cursor.execute('DELETE FROM document_plants WHERE document_id = %s', (document_id,))
-        cursor.execute('DELETE FROM document_departments WHERE document_id = %s', (document_id,))
-
-        for plant_id in plant_ids:
-            cursor.execute('INSERT INTO document_plants (document_id, plant_id) VALUES (%s, %s)', (document_id, plant_id))
-        for department_id in department_ids:
-            cursor.execute('INSERT INTO document_departments (document_id, department_id) VALUES (%s, %s)', (document_id, department_id))
+        sync_links(cursor, 'document_plants', document_id, plant_ids)
+        sync_links(cursor, 'document_departments', document_id, department_ids)
 
         conn.commit()
         return jsonify({'message': 'Document updated successfully'})
@@ -452,107 +422,55 @@ def document_detail(document_id):
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Build detail query with joins
-    detail_query = '''
-        SELECT d.id, d.title, d.description, d.filename, d.file_path, d.file_size,
-               d.mime_type, d.uploaded_at, d.updated_at,
-               u.id AS uploader_id, u.username AS uploader_name,
-               dt.id AS document_type_id, dt.name AS document_type_name,
-               STRING_AGG(DISTINCT p.name, ', ') AS plant_names,
-               STRING_AGG(DISTINCT dept.name, ', ') AS department_names
-        FROM documents d
-        JOIN users u ON d.uploaded_by = u.id
-        JOIN document_types dt ON d.document_type_id = dt.id
-        LEFT JOIN document_plants dp ON d.id = dp.document_id
-        LEFT JOIN plants p ON dp.plant_id = p.id
-        LEFT JOIN document_departments dd ON d.id = dd.document_id
-        LEFT JOIN departments dept ON dd.department_id = dept.id
-        WHERE d.id = %s
-        GROUP BY d.id, u.id, dt.id
-    '''
+    # Single primary-key lookup on the denormalized listing projection
+    detail_query = f'SELECT {LISTING_COLUMNS} FROM document_listing l WHERE l.document_id = %s'
     params = [document_id]
 
     # Restrict for non-admin
     if session.get('role') != 'admin':
-        plant_ids = session.get('plant_ids', [])
-        department_ids = session.get('department_ids', [])
-        if not plant_ids or not department_ids:
+        if not session.get('plant_ids') or not session.get('department_ids'):
             flash('User session missing plant or department information.')
             return redirect(url_for('main.login'))
-        
-        cursor.execute('''
-            SELECT 1 FROM document_plants dp
-            JOIN document_departments dd ON dp.document_id = dd.document_id
-            WHERE dp.document_id = %s AND dp.plant_id = ANY(%s) AND dd.department_id = ANY(%s)
-        ''', (document_id, plant_ids, department_ids))
-        if not cursor.fetchone():
-            abort(404)
+        clause, clause_params = visibility_filter('l')
+        detail_query += ' AND ' + clause
+        params.extend(clause_params)
 
     cursor.execute(detail_query, params)
     row = cursor.fetchone()
 
-    cursor.close()
-    conn.close()
-
     if not row:
+        cursor.close()
+        conn.close()
         abort(404)
 
-    shaped_document = {
-        'id': row['id'],
-        'title': row['title'],
-        'description': row['description'],
-        'filename': row['filename'],
-        'file_path': row['file_path'],
-        'file_size': row['file_size'],
-        'mime_type': row['mime_type'],
-        'uploaded_at': row['uploaded_at'],
-        'updated_at': row['updated_at'],
-        'uploader': {
-            'id': row['uploader_id'],
-            'username': row['uploader_name'],
-        },
-        'document_type': {
-            'id': row['document_type_id'],
-            'name': row['document_type_name'],
-        },
-        'plants': row['plant_names'],
-        'departments': row['department_names'],
-    }
+    shaped_document = shape_document(row)
+    shaped_document['file_path'] = row['file_path']
+
+    cursor.execute('''
+        SELECT c.target FROM conversions c
+        JOIN documents d ON d.content_hash = c.content_hash
+        WHERE d.id = %s ORDER BY c.target
+    ''', (document_id,))
+    shaped_document['conversions'] = [r['target'] for r in cursor.fetchall()]
+    cursor.close()
+    conn.close()
 
     return render_template('document_detail.html', document=shaped_document, user={'role': session.get('role', 'user')})
 
 @main.route('/api/plants')
 @login_required
 def api_plants():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM plants ORDER BY name')
-    plants = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return jsonify(plants)
+    return jsonify(reference_cache.get('plants'))
 
 @main.route('/api/departments')
 @login_required
 def api_departments():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM departments ORDER BY name')
-    departments = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return jsonify(departments)
+    return jsonify(reference_cache.get('departments'))
 
 @main.route('/api/document-types')
 @login_required
 def api_document_types():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM document_types ORDER BY name')
-    document_types = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return jsonify(document_types)
+    return jsonify(reference_cache.get('document_types'))
 
 @main.route('/api/user/profile')
 @login_required
@@ -574,6 +492,88 @@ def api_user_profile():
         return jsonify(user)
     return jsonify({'error': 'User not found'}), 404
 
+STATS_VIEWS = ('top', 'series', 'departments')
+
+@main.route('/api/stats/downloads')
+@admin_required
+def api_stats_downloads():
+    """Download analytics served from the daily rollups, never the raw logs.
+
+    ``view`` is ``top`` (``group``: document, user, plant or department),
+    ``series`` (``interval``: day, week or month) or ``departments``.
+    ``start``/``end`` are inclusive ISO dates (default: the last 30 days);
+    ``plant_id``, ``department_id`` and ``document_id`` narrow the result.
+    Figures trail the raw logs by up to two rollup intervals, see ``as_of``.
+    """
+    view = request.args.get('view', 'top')
+    if view not in STATS_VIEWS:
+        return jsonify({'error': f'view must be one of: {", ".join(STATS_VIEWS)}'}), 400
+    group = request.args.get('group', 'document')
+    if group not in download_stats.GROUPS:
+        return jsonify({'error': f'group must be one of: {", ".join(download_stats.GROUPS)}'}), 400
+    interval = request.args.get('interval', 'day')
+    if interval not in download_stats.INTERVALS:
+        return jsonify({'error': f'interval must be one of: {", ".join(download_stats.INTERVALS)}'}), 400
+    start, end = download_stats.default_range()
+    try:
+        if request.args.get('end'):
+            end = date.fromisoformat(request.args['end'])
+        if request.args.get('start'):
+            start = date.fromisoformat(request.args['start'])
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+    if start > end:
+        return jsonify({'error': 'start must not be after end'}), 400
+    plant_id = request.args.get('plant_id', type=int)
+    department_id = request.args.get('department_id', type=int)
+    document_id = request.args.get('document_id', type=int)
+    limit = max(min(request.args.get('limit', 10, type=int), 100), 1)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        if view == 'top':
+            data = download_stats.top(cursor, start, end, group, limit, plant_id, department_id)
+        elif view == 'series':
+            data = [{'period': row['period'].isoformat(), 'downloads': row['downloads']}
+                    for row in download_stats.series(cursor, start, end, interval, document_id, plant_id, department_id)]
+        else:
+            data = download_stats.departments(cursor, start, end, plant_id)
+        as_of = download_stats.as_of(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+    return jsonify({
+        'view': view,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'as_of': as_of.isoformat() if as_of else None,
+        'data': data,
+    })
+
+def insert_document(cursor, title, description, filename, file_path, file_size, mime_type, content_hash,
+                    document_type_id, plant_ids, department_ids):
+    """Insert a document and its plant/department links; returns the new id"""
+    cursor.execute('''
+        INSERT INTO documents (title, description, filename, file_path, file_size, mime_type, content_hash, uploaded_by, document_type_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+    ''', (
+        title,
+        description,
+        filename,
+        file_path,
+        file_size,
+        mime_type,
+        content_hash,
+        session['user_id'],
+        document_type_id
+    ))
+    document_id = cursor.fetchone()['id']
+
+    add_links(cursor, 'document_plants', [document_id], plant_ids)
+    add_links(cursor, 'document_departments', [document_id], department_ids)
+    return document_id
+
 @main.route('/documents/upload', methods=['GET', 'POST'])
 @admin_required
 def upload_document():
@@ -587,8 +587,10 @@ def upload_document():
             current_app.logger.warning('File upload failed: No file selected')
             return jsonify({'error': 'No file selected'}), 400
 
-        # Pass the file stream to allowed_file
-        if file and allowed_file(file.filename, file.stream):
+        # Extension check first; content is sniffed while the file is stored
+        if file and allowed_extension(file.filename):
+            tmp_path = None
+            added = None
             try:
                 filename = secure_filename(file.filename)
 
@@ -599,41 +601,37 @@ def upload_document():
                     current_app.logger.warning('File upload failed: Plant and department information required')
                     return jsonify({'error': 'Plant and department information required'}), 400
 
-                # Create directory structure: UPLOAD_FOLDER/year/month/day
-                upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], datetime.now().strftime('%Y/%m/%d'))
-                os.makedirs(upload_dir, exist_ok=True)
+                # The form parser already spooled the file into the store's
+                # tmp dir with its hash, size and sniffed MIME type;
+                # identical content is stored only once
+                store = storage.get_store(current_app)
+                ingested = store.ingest(file.stream)
+                tmp_path, content_hash, file_size = ingested.tmp_path, ingested.content_hash, ingested.size
 
-                file_path = os.path.join(upload_dir, filename)
-                file.save(file_path)
-
-                # Detect MIME type (extension + magic fallback) - this is now handled by allowed_file
-                # For saving to DB, we can use mimetypes.guess_type or magic.from_file again if we want the exact detected type.
-                mime_type, _ = mimetypes.guess_type(file_path)
-                if mime_type is None:
-                    mime_type = 'application/octet-stream' # Default if detection fails
+                if not allowed_file(file.filename, ingested.mime_type):
+                    store.discard_temp(tmp_path)
+                    current_app.logger.warning(f'File upload failed: File type not allowed for file {file.filename}')
+                    return jsonify({'error': 'File type not allowed or invalid'}), 400
+                mime_type = stored_mimetype(file.filename, ingested.mime_type)
 
                 # Save to database
                 conn = get_db_connection()
                 cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO documents (title, description, filename, file_path, file_size, mime_type, uploaded_by, document_type_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
-                ''', (
+                added = store.add(cursor, tmp_path, content_hash, file_size, mime_type)
+                document_id = insert_document(
+                    cursor,
                     request.form.get('title', filename),
                     request.form.get('description', ''),
                     filename,
-                    file_path,
-                    os.path.getsize(file_path),
+                    added.path,
+                    file_size,
                     mime_type,
-                    session['user_id'],
-                    request.form.get('document_type_id')
-                ))
-                document_id = cursor.fetchone()['id']
-
-                for plant_id in plant_ids:
-                    cursor.execute('INSERT INTO document_plants (document_id, plant_id) VALUES (%s, %s)', (document_id, plant_id))
-                for department_id in department_ids:
-                    cursor.execute('INSERT INTO document_departments (document_id, department_id) VALUES (%s, %s)', (document_id, department_id))
+                    content_hash,
+                    request.form.get('document_type_id'),
+                    plant_ids,
+                    department_ids
+                )
+                extraction.enqueue(cursor, [document_id])
 
                 conn.commit()
                 cursor.close()
@@ -645,22 +643,199 @@ def upload_document():
 
             except Exception as e:
                 current_app.logger.error(f"Error during file upload: {e}")
+                store = storage.get_store(current_app)
+                # Take the file back out of the store while the blob lock is held
+                store.undo_add(added)
+                conn = get_db_connection()
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+                if tmp_path:
+                    store.discard_temp(tmp_path)
                 return jsonify({'error': f'Upload failed: {str(e)}'}), 500
         else:
             current_app.logger.warning(f'File upload failed: File type not allowed for file {file.filename}')
             return jsonify({'error': 'File type not allowed or invalid'}), 400 # Updated error message
     # GET request
+    document_types = reference_cache.get('document_types')
+    plants = reference_cache.get('plants')
+    departments = reference_cache.get('departments')
+    return render_template('upload.html', document_types=document_types, plants=plants, departments=departments)
+
+# --- Resumable uploads ---
+# POST /api/uploads {filename, size} -> session; PUT chunks at ?offset=N;
+# GET reports the received offset; POST .../complete with the same form
+# fields as upload_document() turns the assembled file into a document.
+
+def _upload_error(e):
+    body = {'error': str(e)}
+    if e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status
+
+def _upload_status(upload):
+    return {
+        'id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['total_size'],
+        'offset': upload['received'],
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE'],
+    }
+
+@main.route('/api/uploads', methods=['POST'])
+@admin_required
+def api_upload_create():
+    payload = request.get_json(silent=True) or {}
+    filename = secure_filename(payload.get('filename') or '')
+    try:
+        total_size = int(payload.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'File size is required'}), 400
+    if not filename or not allowed_extension(filename):
+        return jsonify({'error': 'File type not allowed or invalid'}), 400
+    if total_size <= 0 or total_size > current_app.config['RESUMABLE_UPLOAD_MAX_SIZE']:
+        return jsonify({'error': 'File is empty or too large'}), 413
+
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM document_types ORDER BY name')
-    document_types = cursor.fetchall()
-    cursor.execute('SELECT id, name FROM plants ORDER BY name')
-    plants = cursor.fetchall()
-    cursor.execute('SELECT id, name FROM departments ORDER BY name')
-    departments = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return render_template('upload.html', document_types=document_types, plants=plants, departments=departments)
+    try:
+        upload = uploads.create_session(cursor, storage.get_store(current_app), session['user_id'], filename, total_size)
+        conn.commit()
+        return jsonify(_upload_status(upload)), 201
+    except Exception as e:
+        current_app.logger.error(f"Error creating upload session: {e}")
+        conn.rollback()
+        return jsonify({'error': 'Failed to create upload'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@main.route('/api/uploads/<upload_id>', methods=['GET'])
+@admin_required
+def api_upload_status(upload_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        upload = uploads.get_session(cursor, upload_id, session['user_id'])
+        return jsonify(_upload_status(upload))
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    finally:
+        cursor.close()
+        conn.close()
+
+@main.route('/api/uploads/<upload_id>', methods=['PUT'])
+@admin_required
+def api_upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'offset is required'}), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        upload = uploads.get_session(cursor, upload_id, session['user_id'], lock=True)
+        received = uploads.append_chunk(cursor, storage.get_store(current_app), upload, offset,
+                                        request.stream, request.content_length)
+        conn.commit()
+        return jsonify({'id': upload_id, 'offset': received})
+    except uploads.UploadError as e:
+        # Partial progress of an interrupted chunk is kept
+        conn.commit()
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error writing upload chunk for {upload_id}: {e}")
+        conn.rollback()
+        return jsonify({'error': 'Failed to store chunk'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@main.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@admin_required
+def api_upload_cancel(upload_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        uploads.get_session(cursor, upload_id, session['user_id'], lock=True)
+        uploads.delete_session(cursor, storage.get_store(current_app), upload_id)
+        conn.commit()
+        return jsonify({'message': 'Upload cancelled'})
+    except uploads.UploadError as e:
+        conn.rollback()
+        return _upload_error(e)
+    finally:
+        cursor.close()
+        conn.close()
+
+@main.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@admin_required
+def api_upload_complete(upload_id):
+    payload = request.get_json(silent=True)
+    if payload is not None:
+        form_get = payload.get
+        plant_ids = payload.get('plant_ids') or []
+        department_ids = payload.get('department_ids') or []
+    else:
+        form_get = request.form.get
+        plant_ids = request.form.getlist('plant_ids')
+        department_ids = request.form.getlist('department_ids')
+    if not plant_ids or not department_ids:
+        return jsonify({'error': 'Plant and department information required'}), 400
+
+    store = storage.get_store(current_app)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    added = None
+    try:
+        upload = uploads.get_session(cursor, upload_id, session['user_id'], lock=True)
+        if upload['received'] != upload['total_size']:
+            raise uploads.UploadError('Upload is not complete', 409, upload['received'])
+
+        filename = upload['filename']
+        ingested = store.scan_temp(uploads.part_path(store, upload_id))
+        if not allowed_file(filename, ingested.mime_type):
+            uploads.delete_session(cursor, store, upload_id)
+            conn.commit()
+            current_app.logger.warning(f'Resumable upload rejected: File type not allowed for file {filename}')
+            return jsonify({'error': 'File type not allowed or invalid'}), 400
+
+        mime_type = stored_mimetype(filename, ingested.mime_type)
+        # The part file stays until commit: on rollback undo_add() puts a
+        # moved file back, so the client can retry the same session
+        added = store.add(cursor, ingested.tmp_path, ingested.content_hash, ingested.size, mime_type,
+                          keep_temp=True)
+        document_id = insert_document(
+            cursor,
+            form_get('title') or filename,
+            form_get('description') or '',
+            filename,
+            added.path,
+            ingested.size,
+            mime_type,
+            ingested.content_hash,
+            form_get('document_type_id'),
+            plant_ids,
+            department_ids
+        )
+        cursor.execute('DELETE FROM upload_sessions WHERE id = %s', (upload_id,))
+        extraction.enqueue(cursor, [document_id])
+        conn.commit()
+        store.discard_temp(ingested.tmp_path)
+
+        current_app.log_audit(current_app, 'document_upload', user_id=session['user_id'], details=f'Document \'{filename}\' (ID: {document_id}) uploaded')
+        current_app.logger.info(f'Document {filename} uploaded successfully by user {session["username"]}')
+        return jsonify({'message': 'Document uploaded successfully', 'document_id': document_id}), 201
+    except uploads.UploadError as e:
+        conn.rollback()
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error completing upload {upload_id}: {e}")
+        store.undo_add(added)
+        conn.rollback()
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
 import csv
 
@@ -695,75 +870,124 @@ def bulk_upload():
                 current_app.logger.error(f"Error processing metadata file: {e}")
                 return jsonify({'error': 'Invalid metadata file'}), 400
 
-        upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'bulk', datetime.now().strftime('%Y%m%d%H%M%S'))
-        os.makedirs(upload_dir, exist_ok=True)
-
-        saved = 0
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        try:
-            for f in files:
-                # Pass the file stream to allowed_file
-                if not f or f.filename == '' or not allowed_file(f.filename, f.stream):
-                    current_app.logger.warning(f'Bulk upload failed: File type not allowed or invalid for file {f.filename}')
-                    # Continue to next file, but log the error
-                    continue
+        store = storage.get_store(current_app)
+        allow_duplicates = request.form.get('allow_duplicates') == '1'
 
+        # Per-file report, in upload order
+        results = [{'filename': f.filename} for f in files]
+        candidates = []
+        for f, result in zip(files, results):
+            if not f or f.filename == '' or not allowed_extension(f.filename):
+                result.update(status='rejected', reason='File type not allowed')
+            else:
+                candidates.append((f, result))
+
+        # Sniff the spooled files in parallel; validation needs the app context
+        ingested_files = bulk.ingest_all(store, [f.stream for f, _ in candidates],
+                                         current_app.config['BULK_UPLOAD_WORKERS'])
+        accepted = []
+        for (f, result), ingested in zip(candidates, ingested_files):
+            if isinstance(ingested, Exception):
+                current_app.logger.error(f'Bulk upload: storing {f.filename} failed: {ingested}')
+                result.update(status='error', reason='Could not store file')
+            elif not allowed_file(f.filename, ingested.mime_type):
+                store.discard_temp(ingested.tmp_path)
+                result.update(status='rejected', reason=f'File content ({ingested.mime_type or "unknown"}) does not match its extension')
+            else:
                 filename = secure_filename(f.filename)
-                file_path = os.path.join(upload_dir, filename)
-                f.save(file_path)
-
-                mime_type, _ = mimetypes.guess_type(file_path)
-                if mime_type is None:
-                    mime_type = 'application/octet-stream'
-
                 doc_metadata = metadata.get(filename, {})
-                title = doc_metadata.get('title') or filename
-                description = doc_metadata.get('description') or ''
-
-                cursor.execute('''
-                    INSERT INTO documents (title, description, filename, file_path, file_size, mime_type, uploaded_by, document_type_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
-                ''', (
-                    title,
-                    description,
-                    filename,
-                    file_path,
-                    os.path.getsize(file_path),
-                    mime_type,
-                    session['user_id'],
-                    document_type_id
-                ))
-                document_id = cursor.fetchone()['id']
-
-                for plant_id in plant_ids:
-                    cursor.execute('INSERT INTO document_plants (document_id, plant_id) VALUES (%s, %s)', (document_id, plant_id))
-                for department_id in department_ids:
-                    cursor.execute('INSERT INTO document_departments (document_id, department_id) VALUES (%s, %s)', (document_id, department_id))
-
-                saved += 1
-            conn.commit()
+                result.update(
+                    filename=filename,
+                    title=doc_metadata.get('title') or filename,
+                    description=doc_metadata.get('description') or '',
+                    mime_type=stored_mimetype(f.filename, ingested.mime_type),
+                    ingested=ingested,
+                )
+                accepted.append(result)
+
+        failure = None
+        conn = get_db_connection()
+        try:
+            if not allow_duplicates:
+                cursor = conn.cursor()
+                existing = bulk.existing_documents(cursor, {item['ingested'].content_hash for item in accepted})
+                cursor.close()
+                conn.rollback()
+                seen = {}
+                unique = []
+                for item in accepted:
+                    content_hash = item['ingested'].content_hash
+                    if content_hash in existing or content_hash in seen:
+                        store.discard_temp(item['ingested'].tmp_path)
+                        item['status'] = 'duplicate'
+                        if content_hash in existing:
+                            item['duplicate_of'] = existing[content_hash]
+                        else:
+                            item['reason'] = f'Same content as {seen[content_hash]}'
+                    else:
+                        seen[content_hash] = item['filename']
+                        unique.append(item)
+                accepted = unique
+
+            bulk.insert_in_chunks(
+                conn, store, accepted, current_app.config['BULK_UPLOAD_COMMIT_SIZE'],
+                uploaded_by=session['user_id'],
+                document_type_id=document_type_id,
+                plant_ids=plant_ids,
+                department_ids=department_ids,
+            )
         except Exception as e:
+            # Chunks committed before the failure stay stored: report every
+            # file's outcome instead of a bare error
             current_app.logger.error(f"Bulk upload error: {e}")
-            conn.rollback()
-            return jsonify({'error': 'Bulk upload failed'}), 500
+            failure = e
+            try:
+                bulk.rollback(conn, store, accepted)
+            except Exception:
+                pass
+            for item in accepted:
+                if 'status' not in item:
+                    item['status'] = 'error'
+                    item['reason'] = bulk.NOT_ATTEMPTED
+                if item['status'] != 'accepted':
+                    store.discard_temp(item['ingested'].tmp_path)
         finally:
-            cursor.close()
             conn.close()
 
-        return jsonify({'message': f'Uploaded {saved} files successfully'})
+        report = []
+        for result in results:
+            result.pop('ingested', None)
+            for key in ('title', 'description', 'mime_type'):
+                result.pop(key, None)
+            report.append(result)
+        counts = {status: sum(1 for r in report if r['status'] == status)
+                  for status in ('accepted', 'rejected', 'duplicate', 'error')}
+        if counts['accepted']:
+            current_app.log_audit(current_app, 'bulk_upload', user_id=session['user_id'], details=f"Bulk upload: {counts['accepted']} accepted, {counts['rejected']} rejected, {counts['duplicate']} duplicates, {counts['error']} failed")
+        for r in report:
+            if r['status'] in ('rejected', 'error'):
+                current_app.logger.warning(f"Bulk upload: {r['filename']} {r['status']}: {r.get('reason')}")
+
+        if failure is not None:
+            message = f"Bulk upload failed after storing {counts['accepted']} files"
+            body = {
+                'error': message,
+                'message': message,
+                'counts': counts,
+                'results': report,
+            }
+            # Nothing committed: a plain failure the client can simply retry
+            return jsonify(body), 200 if counts['accepted'] else 500
+        return jsonify({
+            'message': f"Uploaded {counts['accepted']} files successfully",
+            'counts': counts,
+            'results': report,
+        })
 
     # GET
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM document_types ORDER BY name')
-    document_types = cursor.fetchall()
-    cursor.execute('SELECT id, name FROM plants ORDER BY name')
-    plants = cursor.fetchall()
-    cursor.execute('SELECT id, name FROM departments ORDER BY name')
-    departments = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    document_types = reference_cache.get('document_types')
+    plants = reference_cache.get('plants')
+    departments = reference_cache.get('departments')
     return render_template('bulk_upload.html', document_types=document_types, plants=plants, departments=departments)
 
 # --- Admin User Management ---
@@ -830,10 +1054,8 @@ def admin_users_create():
         ))
         user_id = cursor.fetchone()['id']
 
-        for plant_id in plant_ids:
-            cursor.execute('INSERT INTO user_plants (user_id, plant_id) VALUES (%s, %s)', (user_id, plant_id))
-        for department_id in department_ids:
-            cursor.execute('INSERT INTO user_departments (user_id, department_id) VALUES (%s, %s)', (user_id, department_id))
+        add_links(cursor, 'user_plants', [user_id], plant_ids)
+        add_links(cursor, 'user_departments', [user_id], department_ids)
 
         conn.commit()
         current_app.log_audit(current_app, 'user_create', user_id=session['user_id'], details=f'User {username} created')
@@ -911,13 +1133,8 @@ def admin_users_update(user_id):
             conn.rollback()
             return jsonify({'error': 'User not found'}), 404
 
-        cursor.execute('DELETE FROM user_plants WHERE user_id = %s', (user_id,))
-        cursor.execute('DELETE FROM user_departments WHERE user_id = %s', (user_id,))
-
-        for plant_id in plant_ids:
-            cursor.execute('INSERT INTO user_plants (user_id, plant_id) VALUES (%s, %s)', (user_id, plant_id))
-        for department_id in department_ids:
-            cursor.execute('INSERT INTO user_departments (user_id, department_id) VALUES (%s, %s)', (user_id, department_id))
+        sync_links(cursor, 'user_plants', user_id, plant_ids)
+        sync_links(cursor, 'user_departments', user_id, department_ids)
 
         conn.commit()
         current_app.log_audit(current_app, 'user_update', user_id=session['user_id'], details=f'User {username} (ID: {user_id}) updated')
@@ -999,6 +1216,8 @@ def add_department():
             cursor.execute('INSERT INTO departments (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id', (department_name,))
             new_department = cursor.fetchone()
             conn.commit()
+            # Other processes are told by the table's NOTIFY trigger
+            reference_cache.invalidate('departments')
             if new_department:
                 flash(f'Department "{department_name}" added successfully', 'success')
                 current_app.log_audit(current_app, 'add_department', user_id=session['user_id'], details=f'Department "{department_name}" (ID: {new_department["id"]}) added')
@@ -1032,6 +1251,7 @@ def delete_department(department_id):
 
         cursor.execute('DELETE FROM departments WHERE id = %s', (department_id,))
         conn.commit()
+        reference_cache.invalidate('departments')
         current_app.log_audit(current_app, 'delete_department', user_id=session['user_id'], details=f'Department "{department["name"]}" (ID: {department_id}) deleted')
         return jsonify({'message': 'Department deleted successfully'}), 200
     except psycopg2.errors.ForeignKeyViolation:
@@ -1059,6 +1279,7 @@ def delete_document_type(document_type_id):
 
         cursor.execute('DELETE FROM document_types WHERE id = %s', (document_type_id,))
         conn.commit()
+        reference_cache.invalidate('document_types')
         current_app.log_audit(current_app, 'delete_document_type', user_id=session['user_id'], details=f'Document type "{document_type["name"]}" (ID: {document_type_id}) deleted')
         return jsonify({'message': 'Document type deleted successfully'}), 200
     except psycopg2.errors.ForeignKeyViolation:
@@ -1076,24 +1297,14 @@ def delete_document_type(document_type_id):
 @main.route('/admin/departments')
 @admin_required
 def admin_departments():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM departments ORDER BY name')
-    departments = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    departments = reference_cache.get('departments')
     return render_template('admin_departments.html', departments=departments)
 
 
 @main.route('/admin/document-types')
 @admin_required
 def admin_document_types():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM document_types ORDER BY name')
-    document_types = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    document_types = reference_cache.get('document_types')
     return render_template('admin_document_types.html', document_types=document_types)
 
 
@@ -1114,6 +1325,8 @@ def add_document_type():
             cursor.execute('INSERT INTO document_types (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id', (document_type_name,))
             new_document_type = cursor.fetchone()
             conn.commit()
+            # Other processes are told by the table's NOTIFY trigger
+            reference_cache.invalidate('document_types')
             if new_document_type:
                 flash(f'Document type "{document_type_name}" added successfully', 'success')
                 current_app.log_audit(current_app, 'add_document_type', user_id=session['user_id'], details=f'Document type "{document_type_name}" (ID: {new_document_type["id"]}) added')
@@ -1151,8 +1364,7 @@ def request_new_document():
         cursor = conn.cursor()
         try:
             # Fetch document type name for notification
-            cursor.execute('SELECT name FROM document_types WHERE id = %s', (document_type_id,))
-            document_type_name = cursor.fetchone()['name'] if cursor.rowcount > 0 else 'Unknown Type'
+            document_type_name = reference_cache.name_of('document_types', document_type_id, cursor) or 'Unknown Type'
 
             cursor.execute('''
                 INSERT INTO document_requests (user_id, requested_document_description, document_type_id, requested_format)
@@ -1174,12 +1386,7 @@ def request_new_document():
         finally:
             cursor.close()
             conn.close()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM document_types ORDER BY name')
-    document_types = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    document_types = reference_cache.get('document_types')
     return render_template('request_document_form.html', document_types=document_types)
 
 @main.route('/document/<int:document_id>/request_format', methods=['POST'])
@@ -1194,10 +1401,19 @@ def request_document_format(document_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
+        cursor.execute('SELECT mime_type FROM documents WHERE id = %s', (document_id,))
+        document = cursor.fetchone()
+        if not document:
+            return jsonify({'error': 'Document not found'}), 404
+
         cursor.execute('''
             INSERT INTO document_requests (user_id, document_id, requested_document_description, requested_format)
-            VALUES (%s, %s, NULL, %s)
+            VALUES (%s, %s, NULL, %s) RETURNING id
         ''', (session['user_id'], document_id, requested_format))
+        request_id = cursor.fetchone()['id']
+        automatic = current_app.config['CONVERSIONS_ENABLED'] and conversions.plan(document['mime_type'], requested_format) is not None
+        if automatic:
+            conversions.enqueue(cursor, request_id)
 
         # Insert into admin_notifications
         admin_notification_message = f"User {session['username']} requested format '{requested_format}' for document ID: {document_id}."
@@ -1207,6 +1423,8 @@ def request_document_format(document_id):
         ''', (session['user_id'], document_id, admin_notification_message))
         conn.commit()
         current_app.log_audit(current_app, 'document_format_request', user_id=session['user_id'], details=f'User requested format \'{requested_format}\' for document ID: {document_id}')
+        if automatic:
+            return jsonify({'message': 'Format request submitted; the converted file will appear on this page shortly'})
         return jsonify({'message': 'Format request submitted successfully'})
     except Exception as e:
         current_app.logger.error(f"Error submitting format request: {e}")
@@ -1222,7 +1440,7 @@ def admin_requests():
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT dr.id, u.username, d.title AS document_title, dr.document_id, dr.requested_document_description, dt.name AS requested_document_type_name, dr.requested_format, dr.status, dr.created_at
+        SELECT dr.id, u.username, d.title AS document_title, dr.document_id, dr.requested_document_description, dt.name AS requested_document_type_name, dr.requested_format, dr.status, dr.conversion_target, dr.created_at
         FROM document_requests dr
         JOIN users u ON dr.user_id = u.id
         LEFT JOIN documents d ON dr.document_id = d.id
@@ -1292,178 +1510,345 @@ def delete_document_request(request_id):
         conn.close()
 
                     
-@main.route('/documents/<int:document_id>/download')
-@login_required
-def download_document(document_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _offload_response(document, etag):
+    """Empty response telling the front proxy to serve the file with sendfile"""
+    mode = current_app.config['SENDFILE_MODE']
+    response = current_app.response_class(mimetype=document['mime_type'] or 'application/octet-stream')
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(document['file_path'], current_app.config['UPLOAD_FOLDER'])
+        prefix = current_app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = f"{prefix}/{relative.replace(os.sep, '/')}"
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(document['file_path'])
+    response.headers.set('Content-Disposition', 'attachment', filename=document['filename'])
+    response.set_etag(etag)
+    response.last_modified = datetime.utcfromtimestamp(os.path.getmtime(document['file_path']))
+    # Only answers If-None-Match/If-Modified-Since; the proxy handles Range
+    return response.make_conditional(request)
+
+
+def _compressed_response(document, etag):
+    """Serve a blob stored gzip-compressed.
+
+    Clients that accept gzip get the stored bytes as-is with
+    ``Content-Encoding: gzip``; others get it decompressed on the fly with
+    the original length. Either way Range is not honoured (a full 200 is
+    sent), since byte offsets into one representation are meaningless for
+    the other.
+    """
+    path = document['file_path']
+    mimetype = document['mime_type'] or 'application/octet-stream'
+    if request.accept_encodings['gzip']:
+        response = send_file(path, as_attachment=True, download_name=document['filename'],
+                             mimetype=mimetype, conditional=False, etag=False)
+        response.headers['Content-Encoding'] = 'gzip'
+        # A different representation needs a different strong validator
+        response.set_etag(f'{etag}-gzip')
+    else:
+        def generate():
+            with storage.open_stored(path) as f:
+                for chunk in iter(lambda: f.read(storage.CHUNK_SIZE), b''):
+                    yield chunk
+        response = current_app.response_class(generate(), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = document['file_size']
+        response.headers.set('Content-Disposition', 'attachment', filename=document['filename'])
+        response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.last_modified = datetime.utcfromtimestamp(os.path.getmtime(path))
+    return response.make_conditional(request)
+
+
+def _counts_as_download(response):
+    """Resumed downloads (ranges past byte 0) and 304s are not new downloads"""
+    if response.status_code == 206:
+        return response.content_range is not None and response.content_range.start == 0
+    if response.status_code != 200:
+        return False
+    if current_app.config['SENDFILE_MODE'] and request.range is not None:
+        return request.range.ranges[0][0] == 0
+    return True
 
-    query = 'SELECT * FROM documents WHERE id = %s'
+
+def _visible_document(cursor, document_id):
+    """The document row if the current user may see it, else None"""
+    query = 'SELECT * FROM documents d WHERE d.id = %s'
     params = [document_id]
 
     if session.get('role') != 'admin':
-        plant_ids = session.get('plant_ids', [])
-        department_ids = session.get('department_ids', [])
-        if not plant_ids or not department_ids:
+        if not session.get('plant_ids') or not session.get('department_ids'):
             abort(403)  # Forbidden
-        
-        cursor.execute('''
-            SELECT 1 FROM document_plants dp
-            JOIN document_departments dd ON dp.document_id = dd.document_id
-            WHERE dp.document_id = %s AND dp.plant_id = ANY(%s) AND dd.department_id = ANY(%s)
-        ''', (document_id, plant_ids, department_ids))
-        if not cursor.fetchone():
-            abort(403)
+        clause, clause_params = visibility_filter('d')
+        query += ' AND ' + clause
+        params.extend(clause_params)
 
     cursor.execute(query, params)
-    document = cursor.fetchone()
+    return cursor.fetchone()
+
+
+@main.route('/documents/<int:document_id>/download')
+@login_required
+def download_document(document_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    document = _visible_document(cursor, document_id)
     if not document:
         cursor.close()
         conn.close()
+        abort(404 if session.get('role') == 'admin' else 403)
+    if not os.path.exists(document['file_path']):
+        cursor.close()
+        conn.close()
+        current_app.logger.error(f'File for document {document_id} missing: {document["file_path"]}')
         abort(404)
-    
-    # Log download
-    cursor.execute('INSERT INTO download_logs (document_id, user_id) VALUES (%s, %s)', (document_id, session['user_id']))
-    conn.commit()
+
+    etag = document['content_hash']
+    if not etag:
+        # Older rows: hash once, then every later request can use the ETag
+        etag = extraction.file_sha256(document['file_path'])
+        cursor.execute('UPDATE documents SET content_hash = %s WHERE id = %s', (etag, document_id))
+        conn.commit()
     cursor.close()
     conn.close()
-    
-    current_app.logger.info(f'Document {document["filename"]} downloaded by user {session["username"]}')
-    return send_file(document['file_path'], as_attachment=True, download_name=document['filename'])
+
+    if storage.is_compressed(document['file_path']):
+        # Served by the app even in sendfile mode: the proxy would not keep
+        # our Content-Encoding on an internal redirect
+        response = _compressed_response(document, etag)
+    elif current_app.config['SENDFILE_MODE']:
+        response = _offload_response(document, etag)
+    else:
+        # conditional=True handles Range (206/416) and If-None-Match /
+        # If-Modified-Since (304) against the strong ETag and file mtime
+        response = send_file(document['file_path'], as_attachment=True, download_name=document['filename'],
+                             mimetype=document['mime_type'] or None, conditional=True, etag=etag)
+
+    # Log download (queued, so the file starts streaming right away)
+    if _counts_as_download(response):
+        audit_writer.log_download(document_id, session['user_id'])
+        current_app.logger.info(f'Document {document["filename"]} downloaded by user {session["username"]}')
+    return response
+
+@main.route('/documents/bundle')
+@login_required
+def download_bundle():
+    """Stream a ZIP of the documents matching the listing filters or ``ids``.
+
+    Accepts the same ``plant_id``, ``department_id``, ``search`` and
+    ``search_mode`` arguments as the listing, and/or ``ids=1,2,3``.
+    Documents the user cannot see are left out.
+    """
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of document ids'}), 400
+    filters = build_filters(request.args)
+    if not ids and not filters['where']:
+        return jsonify({'error': 'Select documents with ids or a filter'}), 400
+    if session.get('role') != 'admin' and (not session.get('plant_ids') or not session.get('department_ids')):
+        abort(403)
+
+    where = list(filters['where'])
+    params = filters['join_params'] + filters['params']
+    if ids:
+        where.append('l.document_id = ANY(%s)')
+        params.append(ids)
+    clause, clause_params = visibility_filter('l')
+    if clause:
+        where.append(clause)
+        params.extend(clause_params)
+    max_documents = current_app.config['BUNDLE_MAX_DOCUMENTS']
+    query = f'''
+        SELECT l.document_id AS id, l.filename, l.file_path, l.file_size, l.mime_type
+        FROM document_listing l {' '.join(filters['joins'])}
+        WHERE {' AND '.join(where)}
+        ORDER BY l.title, l.document_id
+        LIMIT %s
+    '''
+    params.append(max_documents + 1)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        documents = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+    if not documents:
+        abort(404)
+    if len(documents) > max_documents:
+        return jsonify({'error': f'Too many documents for one bundle (limit {max_documents}); narrow the filter'}), 400
+
+    user_id = session['user_id']
+    username = session['username']
+    logger = current_app.logger
+
+    def log_bundle(document_ids):
+        # One batch for the whole archive instead of a log row per request
+        audit_writer.log_downloads(document_ids, user_id)
+        audit_writer.log_audit(user_id, 'bundle_download', f'{len(document_ids)} documents downloaded as ZIP')
+        logger.info(f'Bundle of {len(document_ids)} documents downloaded by user {username}')
+
+    download_name = f"documents-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    response = current_app.response_class(bundle.stream_zip(documents, on_complete=log_bundle),
+                                          mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    # Let proxies pass the stream through instead of buffering it
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@main.route('/documents/<int:document_id>/converted/<target>')
+@login_required
+def download_conversion(document_id, target):
+    """Download a format conversion produced for a fulfilled request"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        document = _visible_document(cursor, document_id)
+        if not document:
+            abort(404 if session.get('role') == 'admin' else 403)
+        cursor.execute('SELECT file_path FROM conversions WHERE content_hash = %s AND target = %s',
+                       (document['content_hash'], target))
+        conversion = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+    if not conversion or not os.path.exists(conversion['file_path']):
+        abort(404)
+
+    extension = conversions.target_extension(target)
+    download_name = f"{os.path.splitext(document['filename'])[0]}.{extension}"
+    response = send_file(conversion['file_path'], as_attachment=True, download_name=download_name,
+                         mimetype=mimetypes.guess_type(download_name)[0], conditional=True,
+                         etag=f"{document['content_hash']}-{target}")
+    if _counts_as_download(response):
+        audit_writer.log_download(document_id, session['user_id'])
+        current_app.logger.info(f'Document {document["filename"]} downloaded as {target} by user {session["username"]}')
+    return response
+
+@main.route('/documents/<int:document_id>/thumbnail')
+@login_required
+def document_thumbnail(document_id):
+    """Cached JPEG thumbnail (``?size=thumb``) or preview (``?size=preview``)"""
+    size = request.args.get('size', 'thumb')
+    if size not in renditions.SIZES:
+        abort(400)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        document = _visible_document(cursor, document_id)
+    finally:
+        cursor.close()
+        conn.close()
+    if not document:
+        abort(404 if session.get('role') == 'admin' else 403)
+    if not renditions.supports(document['mime_type']) or not document['content_hash']:
+        abort(404)
+
+    try:
+        path = renditions.cache.get(document['file_path'], document['content_hash'], document['mime_type'], size)
+    except FileNotFoundError:
+        current_app.logger.error(f'File for document {document_id} missing: {document["file_path"]}')
+        abort(404)
+    except Exception as e:
+        current_app.logger.warning(f'Could not render {size} for document {document_id}: {e}')
+        abort(404)
+    if path is None:
+        abort(404)
+
+    # A document's content never changes, so its rendition can be cached
+    # for good; private because access depends on the user
+    response = send_file(path, mimetype='image/jpeg', conditional=True,
+                         etag=f"{document['content_hash']}-{size}", max_age=31536000)
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = True
+    return response
 
 @main.route('/audit-logs')
 @admin_required
 def audit_logs():
+    """Merged audit/download history, keyset-paginated on (timestamp, id).
+
+    User and document filters are picked through the typeahead endpoints, so
+    only the selected names are loaded here.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Fetch all users and documents for filter dropdowns
-    cursor.execute('SELECT id, username FROM users ORDER BY username')
-    all_users = cursor.fetchall()
-    cursor.execute('SELECT id, title FROM documents ORDER BY title')
-    all_documents = cursor.fetchall()
-
-    # Filters & pagination
+    per_page = _parse_per_page(20)
+    filters = auditlog.parse_filters(request.args)
     try:
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 20))
-    except ValueError:
-        page = 1
-        per_page = 20
-    page = max(page, 1)
-    per_page = max(min(per_page, 100), 1)
-
-    user_filter = request.args.get('user_id')
-    action_filter = request.args.get('action')
-    document_filter = request.args.get('document_id') # New filter
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-
-    # --- Query for audit_logs ---
-    audit_log_base_query = '''
-        SELECT al.id, al.timestamp, al.action, al.details,
-               u.username AS username, NULL AS document_title, NULL AS document_id, 'audit' AS log_type
-        FROM audit_logs al
-        LEFT JOIN users u ON al.user_id = u.id
-    '''
-    audit_log_where_clauses = []
-    audit_log_params = []
-
-    if user_filter:
-        audit_log_where_clauses.append('u.id = %s')
-        audit_log_params.append(user_filter)
-    if action_filter and action_filter != 'document_download': # Only apply if not filtering specifically for downloads
-        audit_log_where_clauses.append('al.action = %s')
-        audit_log_params.append(action_filter)
-    if start_date:
-        audit_log_where_clauses.append('al.timestamp >= %s')
-        audit_log_params.append(start_date)
-    if end_date:
-        audit_log_where_clauses.append('al.timestamp <= %s')
-        audit_log_params.append(end_date)
-
-    audit_log_query = audit_log_base_query
-    if audit_log_where_clauses:
-        audit_log_query += ' WHERE ' + ' AND '.join(audit_log_where_clauses)
-
-    # --- Query for download_logs ---
-    download_log_base_query = '''
-        SELECT dl.id, dl.downloaded_at AS timestamp, 'document_download' AS action,
-               d.title AS details, u.username AS username, d.title AS document_title, d.id AS document_id, 'download' AS log_type
-        FROM download_logs dl
-        JOIN users u ON dl.user_id = u.id
-        JOIN documents d ON dl.document_id = d.id
-    '''
-    download_log_where_clauses = []
-    download_log_params = []
-
-    if user_filter:
-        download_log_where_clauses.append('u.id = %s')
-        download_log_params.append(user_filter)
-    if document_filter:
-        download_log_where_clauses.append('d.id = %s')
-        download_log_params.append(document_filter)
-    if start_date:
-        download_log_where_clauses.append('dl.downloaded_at >= %s')
-        download_log_params.append(start_date)
-    if end_date:
-        download_log_where_clauses.append('dl.downloaded_at <= %s')
-        download_log_params.append(end_date)
-
-    download_log_query = download_log_base_query
-    if download_log_where_clauses:
-        download_log_query += ' WHERE ' + ' AND '.join(download_log_where_clauses)
-
-    # Construct the combined query for total count
-    total_count = 0
-    if not action_filter or action_filter == 'document_download':
-        cursor.execute(f'SELECT COUNT(*) FROM ({download_log_query}) AS dl_sub', download_log_params)
-        total_count += cursor.fetchone()['count']
-    if not action_filter or action_filter != 'document_download':
-        cursor.execute(f'SELECT COUNT(*) FROM ({audit_log_query}) AS al_sub', audit_log_params)
-        total_count += cursor.fetchone()['count']
-
-    # Construct the combined query for paginated logs
-    combined_log_query_parts = []
-    if not action_filter or action_filter == 'document_download':
-        combined_log_query_parts.append(download_log_query)
-    if not action_filter or action_filter != 'document_download':
-        combined_log_query_parts.append(audit_log_query)
-
-    combined_query = ' UNION ALL '.join(combined_log_query_parts)
-    combined_query += ' ORDER BY timestamp DESC LIMIT %s OFFSET %s'
-
-    # Combine parameters for the final query
-    combined_params = []
-    if not action_filter or action_filter == 'document_download':
-        combined_params.extend(download_log_params)
-    if not action_filter or action_filter != 'document_download':
-        combined_params.extend(audit_log_params)
-
-    combined_params.extend([per_page, (page - 1) * per_page])
-
-    cursor.execute(combined_query, combined_params)
-    logs = cursor.fetchall()
-
-    total_pages = (total_count + per_page - 1) // per_page
+        result = auditlog.fetch_page(cursor, filters, per_page, cursor_token=request.args.get('cursor') or None)
+    except InvalidCursor:
+        # Stale or tampered cursor: start over from the newest entries
+        result = auditlog.fetch_page(cursor, filters, per_page)
+
+    selected_username = selected_document_title = None
+    if filters['user_id'] is not None:
+        cursor.execute('SELECT username FROM users WHERE id = %s', (filters['user_id'],))
+        row = cursor.fetchone()
+        selected_username = row['username'] if row else None
+    if filters['document_id'] is not None:
+        cursor.execute('SELECT title FROM documents WHERE id = %s', (filters['document_id'],))
+        row = cursor.fetchone()
+        selected_document_title = row['title'] if row else '(deleted document)'
+
+    # Query-string args to carry over into the pager links
+    page_args = {k: v for k, v in request.args.items() if k != 'cursor' and v}
+
     cursor.close()
     conn.close()
     return render_template(
         'audit_logs.html',
-        logs=logs,
-        page=page,
-        per_page=per_page,
-        total_count=total_count,
-        total_pages=total_pages,
-        all_users=all_users,        # Pass for filter dropdown
-        all_documents=all_documents,  # Pass for filter dropdown
-        selected_user=user_filter,    # Pass back selected filter
-        selected_action=action_filter,
-        selected_document=document_filter,
-        selected_start_date=start_date,
-        selected_end_date=end_date
+        logs=result['rows'],
+        next_cursor=result['next_cursor'],
+        prev_cursor=result['prev_cursor'],
+        page_args=page_args,
+        selected_user=filters['user_id'],
+        selected_username=selected_username,
+        selected_action=filters['action'],
+        selected_document=filters['document_id'],
+        selected_document_title=selected_document_title,
+        selected_start_date=filters['start_date'],
+        selected_end_date=filters['end_date']
     )
 
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+@main.route('/audit-logs/export')
+@admin_required
+def export_audit_logs():
+    """Stream the filtered history, oldest first, as CSV or JSON lines.
+
+    Takes the audit_logs() filters plus ``format`` (``csv`` or ``jsonl``);
+    the output is gzip-compressed as it is produced unless ``gzip=0``.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in auditlog.EXPORT_FORMATS:
+        return jsonify({'error': f'format must be one of: {", ".join(auditlog.EXPORT_FORMATS)}'}), 400
+    compress = request.args.get('gzip', '1') != '0'
+    filters = auditlog.parse_filters(request.args)
+    audit_writer.log_audit(session['user_id'], 'audit_export',
+                           f"{fmt} export: " + ', '.join(f'{k}={v}' for k, v in filters.items() if v is not None))
+
+    def generate():
+        # The request connection is released before the body is sent, so the
+        # export borrows its own for as long as the client keeps reading
+        with pooled_connection() as conn:
+            chunks = auditlog.export_chunks(auditlog.iter_history(conn, filters), fmt)
+            if compress:
+                chunks = auditlog.gzip_chunks(chunks)
+            yield from chunks
+
+    download_name = f"audit-log-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}" + ('.gz' if compress else '')
+    response = current_app.response_class(generate(),
+                                          mimetype='application/gzip' if compress else EXPORT_MIMETYPES[fmt])
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @main.route('/admin/notifications/<int:notification_id>/mark-read', methods=['POST'])
 @admin_required
 def mark_notification_read(notification_id):
@@ -1492,11 +1877,13 @@ def delete_document(document_id):
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    store = storage.get_store(current_app)
+    trash_path = None
     try:
         # Delete from admin_notifications first
         cursor.execute('DELETE FROM admin_notifications WHERE document_id = %s', (document_id,))
 
-        cursor.execute('SELECT file_path, filename FROM documents WHERE id = %s', (document_id,))
+        cursor.execute('SELECT file_path, filename, content_hash FROM documents WHERE id = %s', (document_id,))
         document = cursor.fetchone()
 
         if not document:
@@ -1507,19 +1894,33 @@ def delete_document(document_id):
         current_app.logger.info(f'Deleting document {document_id} from database')
         cursor.execute('DELETE FROM document_plants WHERE document_id = %s', (document_id,))
         cursor.execute('DELETE FROM document_departments WHERE document_id = %s', (document_id,))
-        cursor.execute('DELETE FROM download_logs WHERE document_id = %s', (document_id,))
         cursor.execute('DELETE FROM documents WHERE id = %s', (document_id,))
+
+        # Stored blobs are shared: only the last reference removes the file
+        trash_path = store.release(cursor, document['content_hash'])
+        store.purge_later(cursor, trash_path)
+        if document['content_hash']:
+            # Conversions of content no document has any more
+            cursor.execute('''
+                DELETE FROM conversions c WHERE c.content_hash = %s
+                  AND NOT EXISTS (SELECT 1 FROM documents d WHERE d.content_hash = c.content_hash)
+                RETURNING file_path
+            ''', (document['content_hash'],))
+            for conversion in cursor.fetchall():
+                store.purge_later(cursor, conversion['file_path'])
+        if not store.is_blob_path(document['file_path'], document['content_hash']):
+            # Files uploaded before the blob store; same-named files may share a path
+            cursor.execute('SELECT 1 FROM documents WHERE file_path = %s LIMIT 1', (document['file_path'],))
+            if cursor.fetchone() is None:
+                if os.path.exists(document['file_path']):
+                    store.purge_later(cursor, document['file_path'])
+                else:
+                    current_app.logger.warning(f'Physical file for document {document_id} not found')
         conn.commit()
+        # The file itself is unlinked by the queued remove_file job
+        trash_path = None
         current_app.logger.info(f'Document {document_id} deleted from database')
 
-        # Delete physical file
-        current_app.logger.info(f'Deleting physical file for document {document_id}')
-        if os.path.exists(document['file_path']):
-            os.remove(document['file_path'])
-            current_app.logger.info(f'Physical file for document {document_id} deleted')
-        else:
-            current_app.logger.warning(f'Physical file for document {document_id} not found')
-        
         current_app.log_audit(current_app, 'document_delete', user_id=session['user_id'], details=f'Document \'{document["filename"]}\' (ID: {document_id}) deleted')
         current_app.logger.info(f'Document with id {document_id} deleted by user {session["username"]}')
         return jsonify({'message': 'Document deleted successfully'}), 200
@@ -1527,10 +1928,13 @@ def delete_document(document_id):
     except psycopg2.Error as e:
         current_app.logger.error(f"Database error during document deletion: {e}")
         conn.rollback()
+        store.restore(trash_path)
         return jsonify({'error': 'Failed to delete document'}), 500
     except Exception as e:
-        current_app.logger.error(f"Error deleting physical file: {e}")
-        return jsonify({'error': 'Failed to delete physical file'}), 500
+        current_app.logger.error(f"Error deleting document: {e}")
+        conn.rollback()
+        store.restore(trash_path)
+        return jsonify({'error': 'Failed to delete document'}), 500
     finally:
         cursor.close()
         conn.close()
@@ -0,0 +1,23 @@
+import re
+
+# Text search configuration used both by the documents_search_vector() SQL
+# function and by queries against it; the two must always agree.
+TS_CONFIG = 'english'
+
+SEARCH_MODES = ('fulltext', 'title')
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def prefix_tsquery(text):
+    """Turn free-form user input into a prefix-matching tsquery string.
+
+    Every word becomes a ``word:*`` prefix term and all terms must match, so
+    ``"pump maint"`` finds "Pump Maintenance SOP". Returns ``None`` when the
+    input has no searchable words. Terms only contain word characters, so the
+    result is always valid ``to_tsquery`` input.
+    """
+    terms = _TERM_RE.findall(text or '')
+    if not terms:
+        return None
+    return ' & '.join(f'{term.lower()}:*' for term in terms[:16])
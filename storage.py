@@ -0,0 +1,409 @@
+import os
+import gzip
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+from collections import namedtuple
+
+import magic
+from flask import Request, current_app
+
+import config
+import jobs
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Leading bytes handed to libmagic for content sniffing
+SNIFF_SIZE = 64 * 1024
+
+Ingested = namedtuple('Ingested', 'tmp_path content_hash size mime_type')
+# What add() did: ``created`` when the temp file was moved to ``path``
+Added = namedtuple('Added', 'path tmp_path created')
+
+# Suffix of blobs stored gzip-compressed (see compress_blob)
+GZIP_SUFFIX = '.gz'
+# Keep the uncompressed copy this long after a blob is compressed, so
+# requests that already read the old file_path can still open it
+UNCOMPRESSED_GRACE = 600
+# Compression that saves less than this fraction is not kept
+MIN_COMPRESSION_SAVING = 0.1
+
+
+def is_compressed(path):
+    return path.endswith(GZIP_SUFFIX)
+
+
+def open_stored(path):
+    """Open a stored file for reading its original bytes, whatever its encoding"""
+    if is_compressed(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def original_name(path):
+    """``path`` without the suffix of a compressed blob, for extension checks"""
+    return path[:-len(GZIP_SUFFIX)] if is_compressed(path) else path
+
+
+@contextmanager
+def stored_as_file(path):
+    """Path of a plain file holding a stored file's original bytes.
+
+    Uncompressed files are used in place; compressed ones are decompressed
+    to a temporary file for readers that seek all over the file (pypdf) or
+    need a real path (pdftoppm).
+    """
+    if not is_compressed(path):
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(original_name(path))[1])
+    try:
+        with os.fdopen(fd, 'wb') as out, gzip.open(path, 'rb') as src:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+class _Scanner:
+    """Hash, size and sniff buffer accumulated chunk by chunk"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+
+    def update(self, chunk):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += chunk[:SNIFF_SIZE - len(self.head)]
+        self.digest.update(chunk)
+        self.size += len(chunk)
+
+    def result(self, path):
+        return Ingested(path, self.digest.hexdigest(), self.size, sniff_mimetype(self.head))
+
+
+class SpooledUpload:
+    """Writable file for a multipart upload, spooled straight into the store.
+
+    Installed as Werkzeug's file stream factory (see ``BlobRequest``): the
+    form parser writes each part here as it arrives, so the bytes land once,
+    in ``blobs/tmp`` on the store's filesystem, and are hashed and sniffed on
+    the way. ``BlobStore.ingest()`` then hands the file to ``add()`` without
+    copying it again. Closing removes the file unless it was moved away.
+    """
+
+    def __init__(self, tmp_dir):
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        self._file = open(self.path, 'w+b')
+        self._scanner = _Scanner()
+
+    def write(self, data):
+        self._scanner.update(bytes(data))
+        return self._file.write(data)
+
+    def ingested(self):
+        self._file.flush()
+        return self._scanner.result(self.path)
+
+    def close(self):
+        self._file.close()
+        BlobStore._remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class BlobRequest(Request):
+    """Request whose multipart files are spooled into the blob store"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledUpload(get_store(current_app).tmp_dir)
+
+
+# Advisory lock namespace serialising writers and deleters of one blob
+BLOB_LOCK_NAMESPACE = 4102
+
+
+class BlobStore:
+    """Content-addressed file store under ``UPLOAD_FOLDER/blobs``.
+
+    Files are stored once per SHA-256 at ``blobs/ab/cd/<hash>`` and the
+    ``blobs`` table counts the documents referencing each one (maintained
+    by a trigger on ``documents.content_hash``). Adding and releasing a blob
+    both take a transaction-scoped advisory lock on its hash, so an upload
+    can never reuse a file that a concurrent delete is about to unlink.
+    """
+
+    def __init__(self, upload_folder, compress_mimetypes=()):
+        self.root = os.path.join(upload_folder, 'blobs')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        self.compress_mimetypes = frozenset(compress_mimetypes)
+
+    def path_for(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def is_blob_path(self, path, content_hash):
+        if not content_hash:
+            return False
+        plain = os.path.abspath(self.path_for(content_hash))
+        return os.path.abspath(path) in (plain, plain + GZIP_SUFFIX)
+
+    def stored_path(self, content_hash):
+        """Path of the stored file (compressed or not), or None if absent"""
+        path = self.path_for(content_hash)
+        # The compressed copy wins: the plain one may be awaiting removal
+        for candidate in (path + GZIP_SUFFIX, path):
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def ingest(self, stream):
+        """``Ingested`` for an upload stream, ready for ``add()``.
+
+        Streams spooled by ``BlobRequest`` are already in ``blobs/tmp`` and
+        scanned, so nothing is copied; anything else goes through
+        ``write_temp()``.
+        """
+        if isinstance(stream, SpooledUpload) and os.path.dirname(stream.path) == self.tmp_dir:
+            return stream.ingested()
+        return self.write_temp(stream)
+
+    def write_temp(self, stream):
+        """Copy ``stream`` to a temporary file, hashing and sniffing it on the way.
+
+        Each fixed-size chunk is hashed, counted and written as it arrives,
+        and the leading bytes are sniffed with libmagic. Returns an
+        ``Ingested`` tuple; ``mime_type`` is None if sniffing failed. The
+        temp file lives on the same filesystem as the store so ``add()`` can
+        rename it into place atomically.
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        scanner = _Scanner()
+        try:
+            with open(tmp_path, 'wb') as out:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    scanner.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        return scanner.result(tmp_path)
+
+    def scan_temp(self, tmp_path):
+        """``Ingested`` for a temp file that was assembled elsewhere (resumable uploads)"""
+        scanner = _Scanner()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                scanner.update(chunk)
+        return scanner.result(tmp_path)
+
+    def _lock(self, cursor, content_hash):
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', (BLOB_LOCK_NAMESPACE, content_hash))
+
+    def add(self, cursor, tmp_path, content_hash, size, mime_type=None, keep_temp=False):
+        """Move a temp file into the store within the caller's transaction.
+
+        Registers the blob (inserting the document then bumps its reference
+        count) and returns an ``Added`` with the stored path; if the caller
+        rolls back, it must call ``undo_add()`` with it *before* the
+        rollback. If the content is already stored the temp file is dropped,
+        unless ``keep_temp``. New blobs of a compressible ``mime_type`` get
+        a compress_blob job, so compression never slows down the upload.
+        """
+        self._lock(cursor, content_hash)
+        # A new row starts from the documents already carrying this hash
+        # (e.g. older uploads), so the count never undercounts references
+        cursor.execute('''
+            INSERT INTO blobs (content_hash, size, ref_count)
+            SELECT %s, %s, COUNT(*) FROM documents WHERE content_hash = %s
+            ON CONFLICT (content_hash) DO NOTHING
+        ''', (content_hash, size, content_hash))
+        path = self.stored_path(content_hash)
+        if path is not None:
+            if not keep_temp:
+                self._remove(tmp_path)
+            return Added(path, tmp_path, False)
+        path = self.path_for(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        if mime_type in self.compress_mimetypes:
+            jobs.enqueue(cursor, 'compress_blob', {'content_hash': content_hash}, dedupe_key=content_hash)
+        return Added(path, tmp_path, True)
+
+    def undo_add(self, added):
+        """Move a file placed by ``add()`` back to its temp path.
+
+        Call before rolling back: the blob lock is still held, so no
+        concurrent upload can have started reusing the file.
+        """
+        if added and added.created:
+            try:
+                os.replace(added.path, added.tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def discard_temp(self, tmp_path):
+        self._remove(tmp_path)
+
+    def release(self, cursor, content_hash):
+        """Drop an unreferenced blob after its last document was deleted.
+
+        Must run in the transaction that deleted the document. The file is
+        moved aside (not unlinked) while the lock is held; call ``purge()``
+        after commit or ``restore()`` after rollback with the returned path.
+        Returns None when the blob is still referenced.
+        """
+        if not content_hash:
+            return None
+        self._lock(cursor, content_hash)
+        cursor.execute('SELECT ref_count FROM blobs WHERE content_hash = %s FOR UPDATE', (content_hash,))
+        row = cursor.fetchone()
+        if row is None or row['ref_count'] > 0:
+            return None
+        cursor.execute('DELETE FROM blobs WHERE content_hash = %s', (content_hash,))
+        path = self.stored_path(content_hash)
+        if path is None:
+            return None
+        trash_path = f'{path}.deleted-{uuid.uuid4().hex}'
+        os.replace(path, trash_path)
+        return trash_path
+
+    def compress(self, conn, content_hash, level=6):
+        """Replace a stored blob by a gzip copy if that saves enough space.
+
+        The copy is written without holding the blob lock; the swap (file
+        rename plus repointing every document at the ``.gz`` path) happens
+        under it in one transaction. The plain file is removed by a delayed
+        drop_uncompressed job. Returns True when the blob is now compressed.
+        """
+        path = self.path_for(content_hash)
+        if not os.path.exists(path) or os.path.exists(path + GZIP_SUFFIX):
+            return False
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=level) as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            size = os.path.getsize(path)
+            stored_size = os.path.getsize(tmp_path)
+            cursor = conn.cursor()
+            try:
+                self._lock(cursor, content_hash)
+                cursor.execute('SELECT encoding FROM blobs WHERE content_hash = %s FOR UPDATE', (content_hash,))
+                blob = cursor.fetchone()
+                if blob is None or blob['encoding'] != 'identity' or not os.path.exists(path):
+                    # Released or already compressed meanwhile
+                    conn.rollback()
+                    return False
+                if stored_size > size * (1 - MIN_COMPRESSION_SAVING):
+                    cursor.execute('UPDATE blobs SET stored_size = %s WHERE content_hash = %s', (size, content_hash))
+                    conn.commit()
+                    return False
+                os.replace(tmp_path, path + GZIP_SUFFIX)
+                try:
+                    cursor.execute('''
+                        UPDATE blobs SET encoding = 'gzip', stored_size = %s WHERE content_hash = %s
+                    ''', (stored_size, content_hash))
+                    cursor.execute('UPDATE documents SET file_path = %s WHERE content_hash = %s AND file_path = %s',
+                                   (path + GZIP_SUFFIX, content_hash, path))
+                    jobs.enqueue(cursor, 'drop_uncompressed', {'content_hash': content_hash},
+                                 delay=UNCOMPRESSED_GRACE, dedupe_key=content_hash)
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    self._remove(path + GZIP_SUFFIX)
+                    raise
+            finally:
+                cursor.close()
+        finally:
+            self._remove(tmp_path)
+        logger.info(f'Compressed blob {content_hash}: {size} -> {stored_size} bytes')
+        return True
+
+    def drop_uncompressed(self, conn, content_hash):
+        """Remove the plain copy left behind by ``compress()``, unless it is live again.
+
+        If the last document was deleted during the grace period and the same
+        content uploaded again, ``add()`` may have reused the plain file; it
+        is only removed while, under the blob lock, no document points at it
+        and the blob (if any) is stored gzip-compressed.
+        """
+        path = self.path_for(content_hash)
+        cursor = conn.cursor()
+        try:
+            self._lock(cursor, content_hash)
+            cursor.execute('SELECT 1 FROM documents WHERE file_path = %s LIMIT 1', (path,))
+            referenced = cursor.fetchone() is not None
+            cursor.execute('SELECT encoding FROM blobs WHERE content_hash = %s', (content_hash,))
+            blob = cursor.fetchone()
+            if not referenced and (blob is None or blob['encoding'] == 'gzip'):
+                self._remove(path)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def restore(self, trash_path):
+        if trash_path:
+            os.replace(trash_path, trash_path.rsplit('.deleted-', 1)[0])
+
+    def purge(self, trash_path):
+        if trash_path:
+            self._remove(trash_path)
+
+    def purge_later(self, cursor, path):
+        """Unlink ``path`` from a background job once the caller's transaction commits"""
+        if path:
+            jobs.enqueue(cursor, 'remove_file', {'path': path})
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f'Could not remove {path}: {e}')
+
+
+def sniff_mimetype(head):
+    try:
+        return magic.from_buffer(head, mime=True)
+    except Exception as e:
+        logger.error(f'Magic detection failed: {e}')
+        return None
+
+
+@jobs.handler('remove_file')
+def run_remove_file(conn, payload):
+    try:
+        os.remove(payload['path'])
+    except FileNotFoundError:
+        pass
+
+
+@jobs.handler('drop_uncompressed')
+def run_drop_uncompressed(conn, payload):
+    BlobStore(config.UPLOAD_FOLDER).drop_uncompressed(conn, payload['content_hash'])
+
+
+@jobs.handler('compress_blob')
+def run_compress_blob(conn, payload):
+    BlobStore(config.UPLOAD_FOLDER).compress(conn, payload['content_hash'], config.STORAGE_COMPRESSION_LEVEL)
+
+
+def get_store(app):
+    compress = app.config.get('STORAGE_COMPRESS_MIMETYPES', ()) if app.config.get('STORAGE_COMPRESSION') else ()
+    return BlobStore(app.config['UPLOAD_FOLDER'], compress_mimetypes=compress)
@@ -0,0 +1,191 @@
+import os
+import time
+import uuid
+import logging
+import threading
+
+import psycopg2
+
+import models
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """A resumable-upload request that cannot be applied; carries the HTTP status"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def part_path(store, upload_id):
+    # Parts live next to the blob store's temp files, so finalizing is a rename
+    return os.path.join(store.tmp_dir, f'upload-{upload_id}.part')
+
+
+def create_session(cursor, store, user_id, filename, total_size):
+    upload_id = uuid.uuid4().hex
+    cursor.execute('''
+        INSERT INTO upload_sessions (id, user_id, filename, total_size)
+        VALUES (%s, %s, %s, %s) RETURNING *
+    ''', (upload_id, user_id, filename, total_size))
+    upload = cursor.fetchone()
+    os.makedirs(store.tmp_dir, exist_ok=True)
+    open(part_path(store, upload_id), 'wb').close()
+    return upload
+
+
+def get_session(cursor, upload_id, user_id, lock=False):
+    """Fetch an upload session owned by ``user_id``, or raise a 404 UploadError.
+
+    With ``lock`` the row is locked for the rest of the transaction; a second
+    request for the same session gets a 409 instead of waiting.
+    """
+    query = 'SELECT * FROM upload_sessions WHERE id = %s AND user_id = %s'
+    if lock:
+        query += ' FOR UPDATE NOWAIT'
+    try:
+        cursor.execute(query, (upload_id, user_id))
+    except psycopg2.errors.LockNotAvailable:
+        raise UploadError('Another request is writing to this upload', 409)
+    upload = cursor.fetchone()
+    if upload is None:
+        raise UploadError('Upload not found or expired', 404)
+    return upload
+
+
+def append_chunk(cursor, store, upload, offset, stream, length):
+    """Append ``length`` bytes from ``stream`` at ``offset``; returns the new offset.
+
+    The chunk is copied to disk in fixed-size pieces, never buffered whole.
+    Bytes past the recorded offset (left by an interrupted request) are
+    truncated first, and if this request is cut off, the bytes that did
+    arrive are kept so the client can resume from the returned offset.
+    """
+    if offset != upload['received']:
+        raise UploadError('Offset does not match the received size', 409, upload['received'])
+    if length is None:
+        raise UploadError('Content-Length is required', 411, upload['received'])
+    if offset + length > upload['total_size']:
+        raise UploadError('Chunk exceeds the declared upload size', 413, upload['received'])
+
+    written = 0
+    error = None
+    try:
+        with open(part_path(store, upload['id']), 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            while written < length:
+                chunk = stream.read(min(storage.CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except FileNotFoundError:
+        raise UploadError('Upload not found or expired', 404)
+    except Exception as e:
+        # Client went away mid-chunk: keep what was written
+        error = e
+
+    cursor.execute('''
+        UPDATE upload_sessions SET received = received + %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s RETURNING received
+    ''', (written, upload['id']))
+    received = cursor.fetchone()['received']
+    if error is not None or written < length:
+        raise UploadError('Chunk was incomplete', 400, received)
+    return received
+
+
+def delete_session(cursor, store, upload_id):
+    cursor.execute('DELETE FROM upload_sessions WHERE id = %s', (upload_id,))
+    store.discard_temp(part_path(store, upload_id))
+
+
+def collect_garbage(store, ttl):
+    """Drop sessions idle for more than ``ttl`` seconds and orphaned temp files"""
+    with models.pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM upload_sessions
+            WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            RETURNING id
+        ''', (ttl,))
+        expired = [row['id'] for row in cursor.fetchall()]
+        conn.commit()
+        for upload_id in expired:
+            store.discard_temp(part_path(store, upload_id))
+
+        # Temp files older than the TTL whose session is gone: interrupted
+        # single-shot uploads, or parts of sessions deleted elsewhere
+        if not os.path.isdir(store.tmp_dir):
+            cursor.close()
+            return len(expired)
+        cutoff = time.time() - ttl
+        stale = {}
+        for name in os.listdir(store.tmp_dir):
+            path = os.path.join(store.tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    stale[name] = path
+            except OSError:
+                continue
+        part_ids = [name[len('upload-'):-len('.part')] for name in stale if name.startswith('upload-')]
+        live = set()
+        if part_ids:
+            cursor.execute('SELECT id FROM upload_sessions WHERE id = ANY(%s)', (part_ids,))
+            live = {row['id'] for row in cursor.fetchall()}
+            conn.rollback()
+        for name, path in stale.items():
+            if name.startswith('upload-') and name[len('upload-'):-len('.part')] in live:
+                continue
+            store.discard_temp(path)
+        cursor.close()
+    return len(expired)
+
+
+class UploadJanitor:
+    """Background thread running ``collect_garbage`` every ``interval`` seconds"""
+
+    def __init__(self, store, ttl, interval=900):
+        self.store = store
+        self.ttl = ttl
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='upload-janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                expired = collect_garbage(self.store, self.ttl)
+                if expired:
+                    logger.info(f'Removed {expired} abandoned upload sessions')
+            except Exception as e:
+                logger.error(f'Upload garbage collection failed: {e}')
+
+
+janitor = None
+
+
+def init_app(app):
+    global janitor
+    janitor = UploadJanitor(
+        storage.get_store(app),
+        ttl=app.config.get('UPLOAD_SESSION_TTL', 86400),
+        interval=app.config.get('UPLOAD_GC_INTERVAL', 900),
+    )
+    janitor.start()
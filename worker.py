@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Background job worker for the Document Management System
+
+    python -m worker                 # JOBS_WORKER_PROCESSES processes
+    python -m worker --processes 4   # four processes, one worker each
+    python -m worker --kinds extract_text,remove_file
+
+Run it next to waitress and set JOBS_EMBEDDED_WORKERS=0 so the web process
+only enqueues.
+"""
+
+import os
+import sys
+import signal
+import logging
+import argparse
+import multiprocessing
+
+import config
+import jobs
+# Imported for their @jobs.handler registrations
+import extraction  # noqa: F401
+import conversions  # noqa: F401
+import storage  # noqa: F401
+import partitions  # noqa: F401
+import download_stats  # noqa: F401
+import document_counts  # noqa: F401
+
+logger = logging.getLogger('worker')
+
+
+def run_worker(index, kinds):
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s %(levelname)s %(name)s worker-{index} : %(message)s')
+    worker = jobs.Worker(kinds=kinds, name=f'job-worker-{index}', **jobs.worker_options(vars(config)))
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    logger.info(f'Job worker {index} started (pid {os.getpid()})')
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    logger.info(f'Job worker {index} stopped')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run background job workers')
+    parser.add_argument('--processes', type=int, default=config.JOBS_WORKER_PROCESSES,
+                        help='number of worker processes (default: JOBS_WORKER_PROCESSES)')
+    parser.add_argument('--kinds', default='', help='comma-separated job kinds to run (default: all)')
+    args = parser.parse_args(argv)
+    kinds = [k.strip() for k in args.kinds.split(',') if k.strip()] or None
+
+    if args.processes <= 1:
+        run_worker(1, kinds)
+        return 0
+
+    processes = [multiprocessing.Process(target=run_worker, args=(i + 1, kinds), name=f'job-worker-{i + 1}')
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def shutdown(*_):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())